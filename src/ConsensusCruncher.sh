@@ -26,6 +26,10 @@
 ##
 ##    -c  Consensus cut-off, default: 0.7 (70% of reads must have the same base to form
 ##        a consensus)
+##    -d  Input bamfiles aligned from pre-collapsed FASTQs (fastq_to_bam.sh -c ON),
+##        default: OFF (use "ON" to enable)
+##    -u  Input bamfiles with barcodes in RX tags (fastq_to_bam.sh -u ON),
+##        default: OFF (use "ON" to enable)
 ##    -q  qusb directory, default: output/qsub
 ##    -h  Show this message
 ##
@@ -72,6 +76,10 @@ cat << EOF
 
     -c  Consensus cut-off, default: 0.7 (70% of reads must have the same base to form
         a consensus)
+    -d  Input bamfiles aligned from pre-collapsed FASTQs (fastq_to_bam.sh -c ON),
+        default: OFF (use "ON" to enable)
+    -u  Input bamfiles with barcodes in RX tags (fastq_to_bam.sh -u ON),
+        default: OFF (use "ON" to enable)
     -q  qusb directory, default: output/qsub
     -h  Show this message
 
@@ -96,7 +104,7 @@ EOF
 ################
 #    Set-up    #
 ################
-while getopts "hi:o:s:b:c:q:" OPTION
+while getopts "hi:o:s:b:c:d:u:q:" OPTION
 do
      case $OPTION in
          h)
@@ -118,6 +126,12 @@ do
          c)
              CUTOFF=$OPTARG
              ;;
+         d)
+             COLLAPSED=$OPTARG
+             ;;
+         u)
+             UMITAG=$OPTARG
+             ;;
          q)
              QSUBDIR=$OPTARG
              ;;
@@ -186,6 +200,16 @@ if [[ -z $CUTOFF ]]; then
     CUTOFF=0.7
 fi
 
+# Family sizes of pre-collapsed reads are taken from XF tags
+if [[ $COLLAPSED == "ON" ]]; then
+    SSCS_OPT="--collapsed"
+fi
+
+# Molecular barcodes are taken from RX tags instead of query names
+if [[ $UMITAG == "ON" ]]; then
+    SSCS_OPT="$SSCS_OPT --umi_tag RX"
+fi
+
 
 ################
 #  Create dir  #
@@ -219,9 +243,9 @@ for bamfile in $(ls $INPUT | grep bam | grep -v bai); do
     #     SSCS     #
     ################
     if [[ -z $BEDFILE ]]; then
-        echo -e "python3 $code_dir/SSCS_maker.py  --cutoff $CUTOFF --infile $INPUT/$bamfile --outfile $SAMPDIR/$identifier.sscs.bam\n" >> $QSUBDIR/$identifier.sh
+        echo -e "python3 $code_dir/SSCS_maker.py  --cutoff $CUTOFF --infile $INPUT/$bamfile --outfile $SAMPDIR/$identifier.sscs.bam $SSCS_OPT\n" >> $QSUBDIR/$identifier.sh
     else
-        echo -e "python3 $code_dir/SSCS_maker.py  --cutoff $CUTOFF --infile $INPUT/$bamfile --outfile $SAMPDIR/$identifier.sscs.bam --bedfile $BEDFILE\n" >> $QSUBDIR/$identifier.sh
+        echo -e "python3 $code_dir/SSCS_maker.py  --cutoff $CUTOFF --infile $INPUT/$bamfile --outfile $SAMPDIR/$identifier.sscs.bam --bedfile $BEDFILE $SSCS_OPT\n" >> $QSUBDIR/$identifier.sh
     fi
     # sort and index SSCS
     echo -e "samtools view -bu $identifier.sscs.bam | samtools sort - $identifier.sscs.sorted\n" >> $QSUBDIR/$identifier.sh
@@ -332,6 +356,12 @@ for bamfile in $(ls $INPUT | grep bam | grep -v bai); do
 
     fi
 
+    ##########
+    # Report #
+    ##########
+    # Tag family size plot (separate from SSCS_maker.py so matplotlib isn't loaded for consensus making)
+    echo -e "python3 $code_dir/report.py --prefix $identifier\n" >> $QSUBDIR/$identifier.sh
+
     #########################
     # Organize files by dir #
     #########################
@@ -18,12 +18,17 @@
 ##    -b, --barcode  Barcode length [MANDATORY]
 ##    -s, --spacer   Spacer length [MANDATORY]
 ##    -f, --filter   Spacer Filter (e.g. "T" will filter out spacers that are non-T)
+##    -c, --collapse Pre-alignment duplicate collapsing, default: OFF (use "ON" to enable)
+##                   Only one provisional consensus per barcode family is aligned; run
+##                   ConsensusCruncher.sh with "-d ON" on the resulting bamfiles
+##    -u, --umitag   Store barcodes in RX tags instead of read names, default: OFF (use "ON" to enable)
+##                   Run ConsensusCruncher.sh with "-u ON" on the resulting bamfiles
 ##    -q, --qsub     qusb directory, default: output/qsub
 ##    -h, --help     Show this message
 ##
 ##  DESCRIPTION:
 ##
-##  This script extracts molecular barcode tags and removes spacers from unzipped FASTQ
+##  This script extracts molecular barcode tags and removes spacers from FASTQ (unzipped or gzipped)
 ##  files found in the input directory (file names must contain "R1" or "R2"). Barcode
 ##  extracted FASTQ files are written to the 'fastq_tag' directory and are subsequently
 ##  aligned with BWA mem. Bamfiles are written to the 'bamfile" directory under the
@@ -49,12 +54,17 @@ cat << EOF
     -b, --barcode  Barcode length [MANDATORY]
     -s, --spacer   Spacer length [MANDATORY]
     -f, --filter   Spacer Filter (e.g. "T" will filter out spacers that are non-T)
+    -c, --collapse Pre-alignment duplicate collapsing, default: OFF (use "ON" to enable)
+                   Only one provisional consensus per barcode family is aligned; run
+                   ConsensusCruncher.sh with "-d ON" on the resulting bamfiles
+    -u, --umitag   Store barcodes in RX tags instead of read names, default: OFF (use "ON" to enable)
+                   Run ConsensusCruncher.sh with "-u ON" on the resulting bamfiles
     -q, --qsub     qusb directory, default: output/qsub
     -h, --help     Show this message
 
   DESCRIPTION:
 
-  This script extracts molecular barcode tags and removes spacers from unzipped FASTQ
+  This script extracts molecular barcode tags and removes spacers from FASTQ (unzipped or gzipped)
   files found in the input directory (file names must contain "R1" or "R2"). Barcode
   extracted FASTQ files are written to the 'fastq_tag' directory and are subsequently
   aligned with BWA mem. Bamfiles are written to the 'bamfile" directory under the
@@ -105,7 +115,7 @@ done
 
 
 
-while getopts "hi:o:p:r:b:s:f:q:" OPTION
+while getopts "hi:o:p:r:b:s:f:c:u:q:" OPTION
 do
      case $OPTION in
          h)
@@ -133,6 +143,12 @@ do
          f)
              SPACERFILT=$OPTARG
              ;;
+         c)
+             COLLAPSE=$OPTARG
+             ;;
+         u)
+             UMITAG=$OPTARG
+             ;;
          q)
              QSUBDIR=$OPTARG
              ;;
@@ -217,6 +233,7 @@ for R1_file in $( ls $INPUT | grep R1); do
     ################
     R2_file=${R1_file//R1/R2}
     filename=${R1_file//_R1/}
+    filename=${filename//.gz/}
     filename=${filename//.fastq/}
 
     IFS='_' read -a fname_array<<<"$filename"  # Separate filename by "_"
@@ -227,26 +244,9 @@ for R1_file in $( ls $INPUT | grep R1); do
 
     echo -e "#/bin/bash\n#$ -S /bin/bash\n#$ -cwd\n\nmodule load $python_version\nmodule load $bwa_version\nmodule load $samtools_version\n" > $QSUBDIR/$filename.sh
 
-    #################
-    #  Unzip files  #
-    #################
-    if [[ $R1_file = *"gz" ]]; then
-        # Make unzipped file dir
-        : ${UNZIPDIR:=$OUTPUT/fastq_unzip}
-        [ -d $UNZIPDIR ] || mkdir $UNZIPDIR
-
-        # Create tmp unzipped file
-        R1_unzip=${R1_file//.gz/}
-        echo -e "zcat $INPUT/$R1_file > $UNZIPDIR/$R1_unzip" >> $QSUBDIR/$filename.sh
-        R2_unzip=${R2_file//.gz/}
-        echo -e "zcat $INPUT/$R2_file > $UNZIPDIR/$R2_unzip" >> $QSUBDIR/$filename.sh
-
-        R1="$UNZIPDIR/$R1_unzip"
-        R2="$UNZIPDIR/$R2_unzip"
-    else
-        R1="$INPUT/$R1_file"
-        R2="$INPUT/$R2_file"
-    fi
+    # Gzipped FASTQs are streamed by extract_barcodes.py, no need to unzip to a tmp directory
+    R1="$INPUT/$R1_file"
+    R2="$INPUT/$R2_file"
 
     #################
     #  Remove tags  #
@@ -254,17 +254,43 @@ for R1_file in $( ls $INPUT | grep R1); do
     # Change directory so tag stats file will be created in $TAGDIR
     cd $TAGDIR
 
+    # Barcodes stored as RX tag FASTQ comments (carried over to the BAM file with 'bwa mem -C')
+    if [[ $UMITAG == "ON" ]]; then
+        TAG_OPT="--format tag"
+    else
+        TAG_OPT=""
+    fi
+
     # Check if there's a spacer filter
     if [[ -z $SPACERFILT ]]; then
-        echo -e "python3 $code_dir/helper/extract_barcodes.py --read1 $R1 --read2 $R2 --outfile $TAGDIR/$filename --blen $BARCODELEN --slen $SPACERLEN \n" >> $QSUBDIR/$filename.sh
+        echo -e "python3 $code_dir/helper/extract_barcodes.py --read1 $R1 --read2 $R2 --outfile $TAGDIR/$filename --blen $BARCODELEN --slen $SPACERLEN $TAG_OPT \n" >> $QSUBDIR/$filename.sh
+    else
+        echo -e "python3 $code_dir/helper/extract_barcodes.py --read1 $R1 --read2 $R2 --outfile $TAGDIR/$filename --blen $BARCODELEN --slen $SPACERLEN --sfilt $SPACERFILT $TAG_OPT \n" >> $QSUBDIR/$filename.sh
+    fi
+
+    ####################
+    #  Collapse reads  #
+    ####################
+    if [[ $COLLAPSE == "ON" ]]; then
+        # Group PCR duplicates by barcode and sequence prefix, family sizes kept as FASTQ comments for 'bwa mem -C'
+        echo -e "python3 $code_dir/helper/fastq_collapse.py --read1 $TAGDIR/$filename'_barcode_R1.fastq' --read2 $TAGDIR/$filename'_barcode_R2.fastq' --outfile $TAGDIR/$filename \n" >> $QSUBDIR/$filename.sh
+        FASTQ_R1=$TAGDIR/$filename'_collapsed_R1.fastq'
+        FASTQ_R2=$TAGDIR/$filename'_collapsed_R2.fastq'
+        BWA_OPT="-C"
     else
-        echo -e "python3 $code_dir/helper/extract_barcodes.py --read1 $R1 --read2 $R2 --outfile $TAGDIR/$filename --blen $BARCODELEN --slen $SPACERLEN --sfilt $SPACERFILT \n" >> $QSUBDIR/$filename.sh
+        FASTQ_R1=$TAGDIR/$filename'_barcode_R1.fastq'
+        FASTQ_R2=$TAGDIR/$filename'_barcode_R2.fastq'
+        BWA_OPT=""
+    fi
+
+    if [[ $UMITAG == "ON" ]]; then
+        BWA_OPT="-C"
     fi
 
     #################
     #  Align reads  #
     #################
-    echo -e "bwa mem -M -t4 -R '@RG\tID:1\tSM:$filename\tPL:Illumina\tPU:$barcode.$lane\tLB:$PROJECT' $REF $TAGDIR/$filename'_barcode_R1.fastq' $TAGDIR/$filename'_barcode_R2.fastq' > $BAMDIR/$filename.sam \n" >>$QSUBDIR/$filename.sh
+    echo -e "bwa mem -M $BWA_OPT -t4 -R '@RG\tID:1\tSM:$filename\tPL:Illumina\tPU:$barcode.$lane\tLB:$PROJECT' $REF $FASTQ_R1 $FASTQ_R2 > $BAMDIR/$filename.sam \n" >>$QSUBDIR/$filename.sh
 
     # Convert to BAM format and sort by positions
     echo -e "samtools view -bhS $BAMDIR/$filename.sam | samtools sort -@4 - $BAMDIR/$filename \n" >> $QSUBDIR/$filename.sh
@@ -273,15 +299,6 @@ for R1_file in $( ls $INPUT | grep R1); do
     # Remove sam file
     echo -e "rm $BAMDIR/$filename.sam" >> $QSUBDIR/$filename.sh
 
-    #########################
-    # Remove unzipped files #
-    #########################
-    # Don't want to remove entire folder as there may be other files used by other scripts
-    if [[ $UNZIPDIR ]]; then
-        echo -e "rm $UNZIPDIR/$R1_unzip" >> $QSUBDIR/$filename.sh
-        echo -e "rm $UNZIPDIR/$R2_unzip" >> $QSUBDIR/$filename.sh
-    fi
-
     cd $QSUBDIR
     qsub $QSUBDIR/$filename.sh
 done
@@ -15,13 +15,33 @@
 # Written for Python 3.5.1
 #
 # Usage:
-# Python3 DCS_maker.py [--infile INFILE] [--outfile OUTFILE] [--bedfile BEDFILE]
+# Python3 DCS_maker.py [--infile INFILE] [--outfile OUTFILE] [--bedfile BEDFILE] [--stream] [--prefix PREFIX]
+#                        [--targets TARGETS] [--padding PADDING] [--offtarget] [--profile] [--seed SEED]
+#                        [--family_table [FORMAT]] [--family_index]
 #
 # Arguments:
 # --infile INFILE     input BAM file
 # --outfile OUTFILE   output BAM file
 # --bedfile BEDFILE   Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt -
 #                     See bed_separator.R for making your own bed file based on a target panel / specific coordinates)
+# --stream            Index-free streaming mode: SSCSs are swept sequentially from a coordinate-sorted BAM ('-' for
+#                     stdin, e.g. piped from SSCS_maker.py --stream) and DCSs are written in coordinate order ('-' for
+#                     uncompressed BAM to stdout), sorted through temporary BAM files as in SSCS_maker.py --stream
+# --prefix PREFIX     Prefix for stats, SSCS singleton and tracking files (Default: outfile without '.dcs' extension;
+#                     required when writing to stdout)
+# --targets TARGETS   Target panel BED file (e.g. hybrid capture intervals). Intervals are padded and merged, and only
+#                     target regions are fetched from the BAM file instead of the whole genome (replaces --bedfile)
+# --padding PADDING   Number of bases added to each side of target intervals [0]
+# --offtarget         Also process regions outside targets, with off-target read pairs written to separate BAM files
+#                     (".offtarget.bam", e.g. "dcs.offtarget.bam")
+# --profile           Profile run, writing cProfile stats ("dcs.profile.pstats") and collapsed stacks rooted at each
+#                     phase (decode/group/consensus/write) for flame graphs ("dcs.profile.collapsed"), see profiler.py
+# --seed SEED         Deterministic mode: ties in consensus read fields are broken with given seed instead of randomly
+#                     (see SSCS_maker.py)
+# --family_table FMT  Write a table with one row per SSCS family (outcome DCS or SSCS singleton) as Parquet (default),
+#                     Arrow IPC or compressed TSV ("dcs.families.parquet"/".arrow"/".tsv.gz"), see family_table.py
+# --family_index      Index DCS and SSCS singleton BAM files by family key (barcode and coordinates) to BGZF virtual
+#                     offsets ("<bam>.fidx.npy") for lookups with family_index.py
 #
 # Inputs:
 # 1. A position-sorted BAM file containing paired-end reads with SSCS consensus identifier in the header/query name
@@ -32,6 +52,8 @@
 # 2. A SSCS singleton BAM file containing SSCSs without reads from the complementary strand - "sscs.singleton.bam"
 # 3. A text file containing summary statistics (Total SSCS reads, Unmmaped SSCS reads, Secondary/Supplementary SSCS
 #    reads, DCS reads, and SSCS singletons) - "stats.txt" (Stats pended to same stats file as SSCS)
+# 4. A JSON lines file with per-region metrics and a stage summary - "metrics.jsonl" (Pended to same metrics file as
+#    SSCS, see SSCS_maker.py)
 #
 # Concepts:
 #    - Read family: reads that share the same molecular barcode, chr, and start
@@ -50,6 +72,9 @@ import array
 from random import randint
 from argparse import ArgumentParser
 import math
+import sys
+import os
+import time
 
 from consensus_helper import *
 
@@ -134,32 +159,107 @@ def main():
                         help="Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt - \
                         See bed_separator.R for making your own bed file based on a target panel/specific coordinates)",
                         required=False)
+    parser.add_argument("--stream", action="store_true", dest="stream",
+                        help="Index-free streaming mode for coordinate-sorted input ('-' for stdin/stdout)")
+    parser.add_argument("--prefix", action="store", dest="prefix",
+                        help="Prefix for output files other than DCS BAM (required when --outfile is '-')",
+                        required=False)
+    parser.add_argument("--targets", action="store", dest="targets",
+                        help="Target panel BED file, only (padded and merged) target intervals are fetched",
+                        required=False)
+    parser.add_argument("--padding", action="store", dest="padding", type=int, default=0,
+                        help="Number of bases added to each side of target intervals [0]")
+    parser.add_argument("--offtarget", action="store_true", dest="offtarget",
+                        help="Also process off-target regions, writing off-target reads to separate BAM files")
+    parser.add_argument("--profile", action="store_true", dest="profile",
+                        help="Write cProfile stats and collapsed stacks per phase for flame graphs (see profiler.py)")
+    parser.add_argument("--seed", action="store", dest="seed", type=int,
+                        help="Deterministic mode: break ties of consensus read fields with given seed", required=False)
+    parser.add_argument("--family_table", action="store", dest="family_table", nargs='?', const='parquet',
+                        choices=['parquet', 'arrow', 'tsv'],
+                        help="Write table of families as Parquet (default), Arrow IPC or compressed TSV")
+    parser.add_argument("--family_index", action="store_true", dest="family_index",
+                        help="Index DCS and SSCS singleton BAM files by family key (see family_index.py)")
     args = parser.parse_args()
 
+    if args.prefix is None:
+        if args.outfile == '-':
+            parser.error("--prefix is required when writing DCS to stdout")
+        args.prefix = args.outfile.split('.dcs')[0]
+
+    if args.targets is not None and (args.stream or args.bedfile is not None):
+        parser.error("--targets can't be combined with --stream or --bedfile")
+
+    if args.offtarget and (args.targets is None or args.outfile == '-'):
+        parser.error("--offtarget requires --targets and an output BAM file (not stdout)")
+
+    if args.family_index and args.outfile == '-':
+        parser.error("--family_index requires an output BAM file (not stdout)")
+
+    if args.outfile == '-':
+        # Keep stdout free for BAM output
+        sys.stdout = sys.stderr
+
     ######################
     #       SETUP        #
     ######################
+    if args.seed is not None:
+        set_tie_seed(args.seed)
+
+    profiler = None
+    if args.profile:
+        from profiler import Profiler
+        profiler = Profiler('{}.{}'.format(args.prefix, 'dcs.sc' if re.search('dcs.sc', args.outfile) else 'dcs'))
+        profiler.start()
+
+    if args.family_index:
+        from family_index import IndexedWriter
+
     start_time = time.time()
     # ===== Initialize input and output bam files =====
     args.infile = str(args.infile)
     args.outfile = str(args.outfile)
 
     sscs_bam = pysam.AlignmentFile(args.infile, "rb")
-    dcs_bam = pysam.AlignmentFile(args.outfile, "wb", template=sscs_bam)
+    if args.outfile == '-':
+        dcs_bam = pysam.AlignmentFile(args.outfile, "wbu", template=sscs_bam)
+    else:
+        dcs_bam = pysam.AlignmentFile(args.outfile, "wb", template=sscs_bam)
+    if args.family_index:
+        dcs_bam = IndexedWriter(dcs_bam, args.outfile)
+    if args.stream:
+        dcs_bam = SortedBamWriter(dcs_bam, sscs_bam, os.path.dirname(os.path.abspath(args.prefix)))
     
     if re.search('dcs.sc', args.outfile):
-        sscs_singleton_bam = pysam.AlignmentFile('{}.sscs.sc.singleton.bam'.format(args.outfile.split('.dcs.sc')[0]),
-                                             "wb", template=sscs_bam)
+        sscs_singleton_file = '{}.sscs.sc.singleton.bam'.format(args.prefix)
         dcs_header = "DCS - Singleton Correction"
         sr_header = " SC"
     else:
-        sscs_singleton_bam = pysam.AlignmentFile('{}.sscs.singleton.bam'.format(args.outfile.split('.dcs')[0]),
-                                             "wb", template=sscs_bam)
+        sscs_singleton_file = '{}.sscs.singleton.bam'.format(args.prefix)
         dcs_header = "DCS"
         sr_header = ""
-
-    stats = open('{}.stats.txt'.format(args.outfile.split('.dcs')[0]), 'a')
-    time_tracker = open('{}.time_tracker.txt'.format(args.outfile.split('.dcs')[0]), 'a')
+    sscs_singleton_bam = pysam.AlignmentFile(sscs_singleton_file, "wb", template=sscs_bam)
+    if args.family_index:
+        sscs_singleton_bam = IndexedWriter(sscs_singleton_bam, sscs_singleton_file)
+
+    # Target panel intervals, off-target reads are written to separate BAM files
+    if args.targets is not None:
+        targets = TargetIndex(args.targets, sscs_bam.header, args.padding)
+        if args.offtarget:
+            dcs_bam = TargetSplitWriter(dcs_bam, args.outfile, sscs_bam, targets)
+            sscs_singleton_bam = TargetSplitWriter(sscs_singleton_bam, sscs_singleton_file, sscs_bam, targets)
+
+    stats = open('{}.stats.txt'.format(args.prefix), 'a')
+    metrics = RegionMetrics(dcs_header, '{}.metrics.jsonl'.format(args.prefix), profiler=profiler)
+    dcs_bam = metrics.timed(dcs_bam)
+    sscs_singleton_bam = metrics.timed(sscs_singleton_bam)
+    time_tracker = open('{}.time_tracker.txt'.format(args.prefix), 'a')
+
+    family_table = None
+    if args.family_table is not None:
+        from family_table import FamilyTable, family_size
+        table_prefix = '{}.{}'.format(args.prefix, 'dcs.sc' if re.search('dcs.sc', args.outfile) else 'dcs')
+        family_table = FamilyTable(table_prefix, sscs_bam.references, args.family_table)
 
     # ===== Initialize dictionaries and counters=====
     read_dict = collections.OrderedDict()
@@ -181,23 +281,35 @@ def main():
     #   SPLIT BY REGION   #
     #######################
     # ===== Determine data division coordinates =====
-    # division by bed file if provided
-    if args.bedfile is not None:
+    # division by bed file if provided, streamed chunks are used in place of regions
+    if args.stream:
+        division_coor = metrics.reads(stream_chunks(sscs_bam), counter=None, batch=1)
+    elif args.bedfile is not None:
         division_coor = bed_separator(args.bedfile)
+    elif args.targets is not None:
+        division_coor = targets.regions(offtarget=args.offtarget)
     else:
         division_coor = [1]
 
     # ===== Process data in chunks =====
-    for x in division_coor:
-        if division_coor == [1]:
+    for chunk_number, x in enumerate(division_coor):
+        bam_lines = None
+        if args.stream:
+            bam_lines = x
             read_chr = None
             read_start = None
             read_end = None
+            region_name = 'chunk_{}'.format(chunk_number)
+        elif division_coor == [1]:
+            read_chr = None
+            read_start = None
+            read_end = None
+            region_name = 'all'
         else:
-            read_chr = x.split('_', 1)[0]
-            read_start = division_coor[x][0]
-            read_end = division_coor[x][1]
+            region_name = x
+            read_chr, read_start, read_end = division_coor[x]
 
+        metrics.switch('group')
         chr_data = read_bam(sscs_bam,
                             pair_dict=pair_dict,
                             read_dict=read_dict,
@@ -207,8 +319,11 @@ def main():
                             duplex=True,
                             read_chr=read_chr,
                             read_start=read_start,
-                            read_end=read_end
+                            read_end=read_end,
+                            bam_lines=bam_lines,
+                            metrics=metrics
                             )
+        metrics.switch(None)
 
         read_dict = chr_data[0]
         tag_dict = chr_data[1]
@@ -218,11 +333,13 @@ def main():
         counter += chr_data[4]
         unmapped += chr_data[5]
         multiple_mapping += chr_data[6]
+        metrics.peak(read_dict=len(read_dict), pair_dict=len(pair_dict), csn_pair_dict=len(csn_pair_dict))
 
         ######################
         #     CONSENSUS      #
         ######################
         # ===== Create consenus seq for reads =====
+        metrics.switch('consensus')
         for readPair in list(csn_pair_dict.keys()):
             for tag in csn_pair_dict[readPair]:
                 # Determine tag of duplex read
@@ -247,16 +364,33 @@ def main():
                         duplex_dict[tag] += 1
 
                         dcs_bam.write(dcs_read)
+                        if family_table is not None:
+                            # Both SSCSs of the duplex are recorded, the complementary SSCS isn't processed again
+                            for sscs, duplex_sscs in [(tag, ds), (ds, tag)]:
+                                family_table.add(readPair, sscs, family_size(read_dict[sscs][0]),
+                                                 family_size(read_dict[duplex_sscs][0]), 'DCS',
+                                                 consensus_seq.count('N'))
 
                     else:
                         sscs_singleton_bam.write(read_dict[tag][0])
                         sscs_singletons += 1
+                        if family_table is not None:
+                            family_table.add(readPair, tag, family_size(read_dict[tag][0]), 0, 'SSCS_singleton',
+                                             read_dict[tag][0].query_sequence.count('N'))
 
                     # Remove read from dictionary after writing
                     del read_dict[tag]
 
             # Remove key from dictionary after writing
             del csn_pair_dict[readPair]
+        metrics.switch(None)
+
+        if args.stream:
+            # Release DCSs that can no longer be preceded by reads of pending families
+            metrics.peak(sorted_buffer=dcs_bam.flush(stream_watermark(pair_dict, x, STREAM_MAX_DISTANCE)))
+
+        metrics.finish(region_name, families=duplex_count * 2 + sscs_singletons, singletons=sscs_singletons,
+                       consensus_reads=duplex_count)
 
     ######################
     #       SUMMARY      #
@@ -280,6 +414,12 @@ SSCS{} singletons: {} \n'''.format(dcs_header, sr_header, counter, sr_header, un
     stats.close()
     dcs_bam.close()
     sscs_singleton_bam.close()
+    metrics.close()
+    if family_table is not None:
+        family_table.close()
+
+    if profiler is not None:
+        profiler.stop()
 
     return duplex_dict
 
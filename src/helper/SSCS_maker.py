@@ -15,7 +15,10 @@
 # Written for Python 3.5.1
 #
 # Usage:
-# python3 SSCS_maker.py [--cutoff CUTOFF] [--infile INFILE] [--outfile OUTFILE] [--bedfile BEDFILE]
+# python3 SSCS_maker.py [--cutoff CUTOFF [CUTOFF ...]] [--infile INFILE] [--outfile OUTFILE] [--bedfile BEDFILE] [--stream]
+#                        [--prefix PREFIX] [--collapsed] [--umi_tag UMITAG] [--umi_cluster] [--store STORE]
+#                        [--targets TARGETS] [--padding PADDING] [--offtarget] [--profile] [--seed SEED]
+#                        [--family_table [FORMAT]] [--family_index] [--checkpoint CHECKPOINT]
 #
 # Arguments:
 # --cutoff CUTOFF     Proportion of nucleotides at a given position in a sequence required to be identical to form a
@@ -27,10 +30,50 @@
 #                              Read 3: ACTGATACCT
 #                              Read 4: ACTGATACTT
 #                           The resulting SSCS is: ACTGATACNT
+#                     Multiple cutoffs (e.g. --cutoff 0.6 0.7 0.8) are made in a single pass: bases are counted once
+#                     per family and a SSCS BAM and stats file are written for each cutoff
+#                     ("<prefix>_cutoff<CUTOFF>.sscs.bam", "<prefix>_cutoff<CUTOFF>.stats.txt"). Singletons don't
+#                     depend on the cutoff, so one singleton BAM ("<prefix>.singleton.bam") is shared by all cutoffs
+#                     and named in each stats file (see singleton_correction.py --sscs and --prefix)
 # --infile INFILE     Input BAM file
 # --outfile OUTFILE   Output BAM file
 # --bedfile BEDFILE   Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt -
 #                     See bed_separator.R for making your own bed file based on a target panel / specific coordinates)
+# --stream            Index-free streaming mode: reads are swept sequentially from a coordinate-sorted BAM ('-' for
+#                     stdin) and SSCSs are written in coordinate order ('-' for uncompressed BAM to stdout), so stages
+#                     can be chained with pipes (e.g. SSCS_maker.py --stream ... --outfile - | DCS_maker.py --stream
+#                     --infile - ...). SSCSs are sorted through temporary BAM files in the prefix directory, with SSCSs
+#                     of mates far apart (e.g. translocations) merged in when the input is finished
+# --prefix PREFIX     Prefix for stats, singleton, bad read and tracking files (Default: outfile without '.sscs'
+#                     extension; required when writing to stdout)
+# --collapsed         Input aligned from pre-collapsed FASTQs (fastq_collapse.py with 'bwa mem -C'), where family size
+#                     of each provisional consensus read is carried in the XF tag
+# --umi_tag UMITAG    Read molecular barcode from tag (e.g. RX, see extract_barcodes.py --format) instead of query name
+# --umi_cluster       Merge read families at the same coordinates whose barcodes differ by one base (sequencing errors),
+#                     using the directional method (a barcode absorbs neighbours with count <= (count + 1) / 2)
+# --store STORE       Family store directory (see family_store.py). Read families grouped from the input BAM file are
+#                     saved to the store, and reruns on the same input and grouping parameters (--bedfile, --stream,
+#                     --umi_tag, --umi_cluster) load families from the store instead of reading the BAM file, e.g. to
+#                     try a different --cutoff. New lanes can be added to the run with incremental.py
+# --targets TARGETS   Target panel BED file (e.g. hybrid capture intervals). Intervals are padded and merged, and only
+#                     target regions are fetched from the BAM file instead of the whole genome (replaces --bedfile)
+# --padding PADDING   Number of bases added to each side of target intervals [0]
+# --offtarget         Also process regions outside targets, with consensus reads of off-target read pairs written to
+#                     separate BAM files (".offtarget.bam", e.g. "sscs.offtarget.bam")
+# --profile           Profile run, writing cProfile stats ("sscs.profile.pstats") and collapsed stacks rooted at each
+#                     phase (decode/group/consensus/write) for flame graphs ("sscs.profile.collapsed"), see profiler.py
+# --seed SEED         Deterministic mode: ties in consensus read fields (flag, mapping quality, template length, read
+#                     group) are broken with given seed instead of randomly, so reruns and alternative implementations
+#                     produce identical BAM files (see compare_bams.py)
+# --family_table FMT  Write a table with one row per family (key fields, family size, duplex partner size, outcome and
+#                     N bases) as Parquet (default), Arrow IPC or compressed TSV ("sscs.families.parquet"/".arrow"/
+#                     ".tsv.gz"), see family_table.py. Parquet and Arrow require pyarrow (TSV is written otherwise)
+# --family_index      Index SSCS and singleton BAM files by family key (barcode and coordinates) to BGZF virtual offsets
+#                     ("<bam>.fidx.npy") for lookups with family_index.py
+# --checkpoint DIR    Checkpoint directory: outputs are written as per-region shards and the state carried over between
+#                     regions is saved after each region, so a killed run restarted with the same arguments skips
+#                     completed regions (see checkpoint.py). Regions are from --bedfile or --targets. Checkpoint files
+#                     are kept in "DIR/.sscs_checkpoint", which is removed when the run completes
 #
 # Inputs:
 # 1. A position-sorted BAM file containing paired-end reads with duplex barcode in the header
@@ -42,13 +85,21 @@
 # 3. A bad read BAM file containing unpaired, unmapped, and multiple mapping reads - "badReads.bam"
 # 4. A text file containing summary statistics (Total reads, Unmmaped reads, Secondary/Supplementary reads, SSCS reads,
 #    and singletons) - "stats.txt"
-# 5. A tag family size distribution plot (x-axis: family size, y-axis: number of reads) - "tag_fam_size.png"
+# 5. A text file of tag family sizes and their frequencies, by family size - "read_families.txt" (plotted by report.py,
+#    which is run separately so matplotlib isn't loaded when making consensus sequences)
 # 6. A text file tracking the time to complete each genomic region (based on bed file) - "time_tracker.txt"
+# 7. A JSON lines file with a record per region (reads fetched, bad reads, families, singletons, consensus reads,
+#    wall/CPU time split into decode/group/consensus/write phases, peak dictionary sizes and RSS) and a stage summary
+#    record, appended to by DCS_maker.py and singleton_correction.py - "metrics.jsonl"
 #
 # Concepts:
 #    - Read family: reads that share the same molecular barcode, genome
 #                   coordinates for Read1 and Read2, cigar string, strand, flag, and read number
 #    - Singleton: a read family containing only one member (a single read)
+#    - Family sizes are recorded in a histogram when families are written, and only tags of families written in the
+#      current and previous region are kept for catching reads read twice (memory for stats grows with the largest
+#      family size, not the number of families). No tags are kept for a whole file, --stream or --store, where no read
+#      is read twice (but for --family_table with --store)
 #
 ###############################################################
 
@@ -62,9 +113,10 @@ import array
 from random import *
 from itertools import chain
 import argparse
-import matplotlib.pyplot as plt
-import math
 import time
+import copy
+import sys
+import os
 
 from consensus_helper import *
 
@@ -72,32 +124,21 @@ from consensus_helper import *
 ###############################
 #       Helper Functions      #
 ###############################
-def consensus_maker(readList, cutoff, readLength):
-    """(list, int, int) -> str, list, list
-    Return consensus sequence and quality score.
+def consensus_counts(readList, readLength):
+    """(list, int) -> list
+    Return cutoff-independent base counts for each position of reads from the same family, as tuples of
+    (most frequent nucleotide index, reads supporting it, reads passing Q30, consensus quality).
 
     Arguments:
         - readList: list of reads sharing the same unique molecular identifier
-        - cutoff: Proportion of nucleotides at a given position in a sequence required to be identical to form a consensus
 
-    Concept:
-        Majority rules concept where if no majority is reached above the cutoff, an 'N' is assigned to the position.
-        - At each position, reads supporting each nucleotide is recorded along with the quality score corresponding to
-          each nucleotide
-        - Bases below the Phred quality cutoff (Q30) are excluded from consensus making
-        - The most frequent base is added to the consensus sequence, given that the proportion of reads supporting this
-          base is greater than the cutoff
-        - A molecular phred quality score (consensus quality score) is determined by taking the product of errors of the
-          most frequent base
-        - If a majority can't be determined (i.e. a tie with 2 maximums), N will be assigned as these bases won't pass
-          the proportion cut-off
+    See consensus_maker for concept. Counts are computed once per family, so consensus sequences for multiple cutoffs
+    can be made with consensus_call without recounting bases.
     """
-    # Initialize counters
     nuc_lst = ['A', 'C', 'G', 'T', 'N']
-    consensus_read = ''
-    quality_consensus = []
+    position_counts = []
 
-    # Determine consensus for every position across read length
+    # Determine base counts for every position across read length
     for i in range(readLength):
         # Positions in the following lists corresponds to A, C, G, T, N
         nuc_count = [0, 0, 0, 0, 0]
@@ -125,36 +166,64 @@ def consensus_maker(readList, cutoff, readLength):
         max_nuc_quality = quality_score[max_nuc_index]
 
         # Determine consensus phred quality through addition of quality scores (i.e. product of error probabilities)
-        base_fail = False
-        if max_nuc_quality is not []:
-            mol_qual = sum(max_nuc_quality)
-            # Set to max quality score if sum of qualities is greater than the threshold (Q60) imposed by genomic tools
-            if mol_qual > 60:
-                mol_qual = 60
-        else:
-            mol_qual = 0
-            base_fail = True
+        mol_qual = sum(max_nuc_quality)
+        # Set to max quality score if sum of qualities is greater than the threshold (Q60) imposed by genomic tools
+        if mol_qual > 60:
+            mol_qual = 60
 
-        # Consensus only made if proportion of most common base is > cutoff (e.g. 70%)
         phred_pass_reads = len(readList) - phred_fail  # Remove number of failed bases from total count
-        if phred_pass_reads != 0:
-            prop_score = nuc_count[max_nuc_index]/phred_pass_reads
-            if prop_score >= cutoff:
-                consensus_read += nuc_lst[max_nuc_index]
-                quality_consensus.append(mol_qual)
-            else:
-                base_fail = True
-        else:
-            base_fail = True
+        position_counts.append((max_nuc_index, nuc_count[max_nuc_index], phred_pass_reads, mol_qual))
+
+    return position_counts
+
+
+def consensus_call(position_counts, cutoff):
+    """(list, float) -> str, list
+    Return consensus sequence and quality score from base counts (see consensus_counts) for a given cutoff.
 
-        # Set base to N if no consensus could be made
-        if base_fail:
+    >>> consensus_call([(0, 3, 3, 60), (1, 2, 3, 60), (3, 0, 0, 0)], 0.7)
+    ('ANN', [60, 60, 0])
+    >>> consensus_call([(0, 3, 3, 60), (1, 2, 3, 60), (3, 0, 0, 0)], 0.6)
+    ('ACN', [60, 60, 0])
+    """
+    nuc_lst = ['A', 'C', 'G', 'T', 'N']
+    consensus_read = ''
+    quality_consensus = []
+
+    for max_nuc_index, max_nuc_count, phred_pass_reads, mol_qual in position_counts:
+        # Consensus only made if proportion of most common base is > cutoff (e.g. 70%), otherwise base is set to N
+        if phred_pass_reads != 0 and max_nuc_count/phred_pass_reads >= cutoff:
+            consensus_read += nuc_lst[max_nuc_index]
+        else:
             consensus_read += 'N'
-            quality_consensus.append(mol_qual)
+        quality_consensus.append(mol_qual)
 
     return consensus_read, quality_consensus
 
 
+def consensus_maker(readList, cutoff, readLength):
+    """(list, int, int) -> str, list, list
+    Return consensus sequence and quality score.
+
+    Arguments:
+        - readList: list of reads sharing the same unique molecular identifier
+        - cutoff: Proportion of nucleotides at a given position in a sequence required to be identical to form a consensus
+
+    Concept:
+        Majority rules concept where if no majority is reached above the cutoff, an 'N' is assigned to the position.
+        - At each position, reads supporting each nucleotide is recorded along with the quality score corresponding to
+          each nucleotide
+        - Bases below the Phred quality cutoff (Q30) are excluded from consensus making
+        - The most frequent base is added to the consensus sequence, given that the proportion of reads supporting this
+          base is greater than the cutoff
+        - A molecular phred quality score (consensus quality score) is determined by taking the product of errors of the
+          most frequent base
+        - If a majority can't be determined (i.e. a tie with 2 maximums), N will be assigned as these bases won't pass
+          the proportion cut-off
+    """
+    return consensus_call(consensus_counts(readList, readLength), cutoff)
+
+
 # Improve readability of argument help documentation
 class SmartFormatter(argparse.HelpFormatter):
 
@@ -170,7 +239,7 @@ class SmartFormatter(argparse.HelpFormatter):
 def main():
     # Command-line parameters
     parser = ArgumentParser(formatter_class=SmartFormatter)
-    parser.add_argument("--cutoff", action="store", dest="cutoff", type=float,
+    parser.add_argument("--cutoff", action="store", dest="cutoff", type=float, nargs='+',
                         help="R|Proportion of nucleotides at a given position in a\nsequence required to be identical"
                         " to form a consensus\n(Recommendation: 0.7 - based on previous literature\nKennedy et al.)\n"
                         "   Example (--cutoff = 0.7):\n"
@@ -179,7 +248,9 @@ def main():
                         "       Read 2: ACTGAAACCT\n"
                         "       Read 3: ACTGATACCT\n"
                         "       Read 4: ACTGATACTT\n"
-                        "   The resulting SSCS is: ACTGATACNT",
+                        "   The resulting SSCS is: ACTGATACNT\n"
+                        "Multiple cutoffs are made in a single pass with\noutputs named <prefix>_cutoff<CUTOFF>\n"
+                        "(singletons are shared in <prefix>.singleton.bam)",
                         required=True)
     parser.add_argument("--infile", action="store", dest="infile", help="Input BAM file", required=True)
     parser.add_argument("--outfile", action="store", dest="outfile", help="Output SSCS BAM file", required=True)
@@ -187,25 +258,157 @@ def main():
                         help="Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt - \
                         See bed_separator.R for making your own bed file based on a target panel/specific coordinates)",
                         required=False)
+    parser.add_argument("--stream", action="store_true", dest="stream",
+                        help="Index-free streaming mode for coordinate-sorted input ('-' for stdin/stdout)")
+    parser.add_argument("--prefix", action="store", dest="prefix",
+                        help="Prefix for output files other than SSCS BAM (required when --outfile is '-')",
+                        required=False)
+    parser.add_argument("--collapsed", action="store_true", dest="collapsed",
+                        help="Input aligned from pre-collapsed FASTQs with family sizes in XF tags (fastq_collapse.py)")
+    parser.add_argument("--umi_tag", action="store", dest="umi_tag",
+                        help="Tag containing molecular barcode (e.g. RX) instead of query name", required=False)
+    parser.add_argument("--umi_cluster", action="store_true", dest="umi_cluster",
+                        help="Merge families with barcodes within Hamming distance 1 at the same coordinates")
+    parser.add_argument("--store", action="store", dest="store",
+                        help="Family store directory, created on first run and loaded on reruns with the same input",
+                        required=False)
+    parser.add_argument("--targets", action="store", dest="targets",
+                        help="Target panel BED file, only (padded and merged) target intervals are fetched",
+                        required=False)
+    parser.add_argument("--padding", action="store", dest="padding", type=int, default=0,
+                        help="Number of bases added to each side of target intervals [0]")
+    parser.add_argument("--offtarget", action="store_true", dest="offtarget",
+                        help="Also process off-target regions, writing off-target reads to separate BAM files")
+    parser.add_argument("--profile", action="store_true", dest="profile",
+                        help="Write cProfile stats and collapsed stacks per phase for flame graphs (see profiler.py)")
+    parser.add_argument("--seed", action="store", dest="seed", type=int,
+                        help="Deterministic mode: break ties of consensus read fields with given seed", required=False)
+    parser.add_argument("--family_table", action="store", dest="family_table", nargs='?', const='parquet',
+                        choices=['parquet', 'arrow', 'tsv'],
+                        help="Write table of families as Parquet (default), Arrow IPC or compressed TSV")
+    parser.add_argument("--family_index", action="store_true", dest="family_index",
+                        help="Index SSCS and singleton BAM files by family key (see family_index.py)")
+    parser.add_argument("--checkpoint", action="store", dest="checkpoint",
+                        help="Checkpoint directory, restarted runs skip regions completed before (see checkpoint.py)",
+                        required=False)
     args = parser.parse_args()
 
+    if args.prefix is None:
+        if args.outfile == '-':
+            parser.error("--prefix is required when writing SSCS to stdout")
+        args.prefix = args.outfile.split('.sscs')[0]
+
+    if len(args.cutoff) > 1 and args.outfile == '-':
+        parser.error("SSCS for multiple cutoffs can't be written to stdout")
+
+    if args.targets is not None and (args.stream or args.bedfile is not None):
+        parser.error("--targets can't be combined with --stream or --bedfile")
+
+    if args.offtarget and (args.targets is None or args.outfile == '-'):
+        parser.error("--offtarget requires --targets and an output BAM file (not stdout)")
+
+    if args.family_index and args.outfile == '-':
+        parser.error("--family_index requires an output BAM file (not stdout)")
+
+    if args.checkpoint is not None and (args.stream or args.store is not None or args.offtarget or args.outfile == '-' or
+                                        args.family_table is not None or args.family_index):
+        parser.error("--checkpoint can't be combined with --stream, --store, --offtarget, --family_table, "
+                     "--family_index or output to stdout")
+
+    if args.store is not None and args.infile == '-':
+        parser.error("--store requires an input BAM file to be hashed (not stdin)")
+
+    if args.outfile == '-':
+        # Keep stdout free for BAM output
+        sys.stdout = sys.stderr
+
     ######################
     #       SETUP        #
     ######################
+    if args.seed is not None:
+        set_tie_seed(args.seed)
+
+    profiler = None
+    if args.profile:
+        from profiler import Profiler
+        profiler = Profiler('{}.sscs'.format(args.prefix))
+        profiler.start()
+
+    if args.family_index:
+        from family_index import IndexedWriter
+
+    checkpoint = None
+    if args.checkpoint is not None:
+        from checkpoint import Checkpoint, input_params
+        checkpoint = Checkpoint(args.checkpoint, input_params(args.infile, {
+            'cutoff': args.cutoff, 'outfile': args.outfile, 'prefix': args.prefix, 'bedfile': args.bedfile,
+            'targets': args.targets, 'padding': args.padding, 'collapsed': args.collapsed, 'umi_tag': args.umi_tag,
+            'umi_cluster': args.umi_cluster, 'seed': args.seed}))
+    # Tracking files of a resumed run are appended to
+    tracking_mode = 'a' if checkpoint is not None and checkpoint.resumed else 'w'
+
     start_time = time.time()
+    metrics = RegionMetrics('SSCS', '{}.metrics.jsonl'.format(args.prefix), tracking_mode, profiler=profiler)
     # ===== Initialize input and output bam files =====
     bamfile = pysam.AlignmentFile(args.infile, "rb")
-    SSCS_bam = pysam.AlignmentFile(args.outfile, "wb", template = bamfile)
-    stats = open('{}.stats.txt'.format(args.outfile.split('.sscs')[0]), 'w')
-    singleton_bam = pysam.AlignmentFile('{}.singleton.bam'.format(args.outfile.split('.sscs')[0]), "wb", template = bamfile)
-    badRead_bam = pysam.AlignmentFile('{}.badReads.bam'.format(args.outfile.split('.sscs')[0]), "wb", template = bamfile)
+    if args.targets is not None:
+        targets = TargetIndex(args.targets, bamfile.header, args.padding)
+    # SSCS and stats files for each cutoff (only bases of SSCS differ between cutoffs), singletons are shared
+    singleton_file = '{}.singleton.bam'.format(args.prefix)
+    if checkpoint is not None:
+        singleton_bam = checkpoint.writer(singleton_file, bamfile)
+    else:
+        singleton_bam = pysam.AlignmentFile(singleton_file, "wb", template = bamfile)
+    if args.family_index:
+        singleton_bam = IndexedWriter(singleton_bam, singleton_file)
+    if args.offtarget:
+        singleton_bam = TargetSplitWriter(singleton_bam, singleton_file, bamfile, targets)
+    singleton_bam = metrics.timed(singleton_bam)
+
+    SSCS_bams = []
+    stats_files = []
+    for cutoff in args.cutoff:
+        if len(args.cutoff) == 1:
+            outfile = args.outfile
+            cutoff_prefix = args.prefix
+        else:
+            outfile = '{}_cutoff{}.sscs.bam'.format(args.prefix, cutoff)
+            cutoff_prefix = '{}_cutoff{}'.format(args.prefix, cutoff)
+
+        if checkpoint is not None:
+            SSCS_bam = checkpoint.writer(outfile, bamfile)
+        elif outfile == '-':
+            SSCS_bam = pysam.AlignmentFile(outfile, "wbu", template = bamfile)
+        else:
+            SSCS_bam = pysam.AlignmentFile(outfile, "wb", template = bamfile)
+        if args.family_index:
+            SSCS_bam = IndexedWriter(SSCS_bam, outfile)
+        if args.stream:
+            SSCS_bam = SortedBamWriter(SSCS_bam, bamfile, os.path.dirname(os.path.abspath(args.prefix)))
+        if args.offtarget:
+            SSCS_bam = TargetSplitWriter(SSCS_bam, outfile, bamfile, targets)
+        SSCS_bams.append(metrics.timed(SSCS_bam))
+        stats_files.append(open('{}.stats.txt'.format(cutoff_prefix), 'w'))
+    if checkpoint is not None:
+        badRead_bam = metrics.timed(checkpoint.writer('{}.badReads.bam'.format(args.prefix), bamfile))
+    else:
+        badRead_bam = metrics.timed(pysam.AlignmentFile('{}.badReads.bam'.format(args.prefix), "wb",
+                                                        template = bamfile))
 
     # set up time tracker
-    time_tracker = open('{}.time_tracker.txt'.format(args.outfile.split('.sscs')[0]), 'w')
+    time_tracker = open('{}.time_tracker.txt'.format(args.prefix), tracking_mode)
+
+    family_table = None
+    if args.family_table is not None:
+        from family_table import FamilyTable
+        n_count_fields = ['n_count'] if len(args.cutoff) == 1 else ['n_count_cutoff{}'.format(cutoff)
+                                                                     for cutoff in args.cutoff]
+        family_table = FamilyTable('{}.sscs'.format(args.prefix), bamfile.references, args.family_table,
+                                   n_count_fields)
 
     # ===== Initialize dictionaries =====
     read_dict = collections.OrderedDict()
-    tag_dict = collections.defaultdict(int)
+    tag_dict = collections.defaultdict(int)  # sizes of families being grouped, removed when written
     pair_dict = collections.defaultdict(list)
     csn_pair_dict = collections.defaultdict(list)
 
@@ -215,41 +418,113 @@ def main():
     counter = 0
     singletons = 0
     SSCS_reads = 0
+    N_bases = [0 for cutoff in args.cutoff]  # consensus bases set to N for each cutoff
+
+    # ===== Family store =====
+    # Families are loaded from the store if it matches the input and grouping parameters, otherwise it's (re)built
+    store = None
+    store_writer = None
+    if args.store is not None:
+        from family_store import FamilyStore, FamilyStoreWriter, input_digest, add_stored_families, \
+            stored_watermark
+        store_params = {'bedfile': args.bedfile, 'stream': args.stream, 'umi_tag': args.umi_tag,
+                        'umi_cluster': args.umi_cluster, 'targets': args.targets, 'padding': args.padding,
+                        'offtarget': args.offtarget}
+        digest = input_digest(args.infile, store_params)
+        store = FamilyStore(args.store)
+
+        if store.matches(digest):
+            counter = store.meta['stats']['counter']
+            unmapped = store.meta['stats']['unmapped']
+            multiple_mapping = store.meta['stats']['multiple_mapping']
+            for read in store.bad_reads(bamfile.header):
+                badRead_bam.write(read)
+        else:
+            store = None
+            store_writer = FamilyStoreWriter(args.store, digest, store_params)
 
     #######################
     #   SPLIT BY REGION   #
     #######################
     # ===== Determine data division coordinates =====
-    # division by bed file if provided
-    if args.bedfile is not None:
+    # division by bed file if provided, streamed chunks or stored families are used in place of regions
+    if store is not None:
+        division_coor = metrics.reads(store.chunks(bamfile.header), counter=None, batch=1)
+    elif args.stream:
+        division_coor = metrics.reads(stream_chunks(bamfile), counter=None, batch=1)
+    elif args.bedfile is not None:
         division_coor = bed_separator(args.bedfile)
+    elif args.targets is not None:
+        division_coor = targets.regions(offtarget=args.offtarget)
     else:
         division_coor = [1]
 
     # ===== Process data in chunks =====
     region=0
-    for x in division_coor:
-        if division_coor == [1]:
+
+    # Tags of written families are only kept when regions are fetched (reads near boundaries are read twice) or for
+    # --family_table with stored chunks (duplex complements may be split across chunks), sizes of written families are
+    # otherwise looked up by their pending duplex complement
+    track_tags = (store is None and not args.stream and division_coor != [1]) or \
+        (store is not None and family_table is not None)
+    family_sizes = FamilySizes(track_tags=track_tags)  # histogram of sizes of written families
+    duplex_sizes = {}  # sizes of written families by tag of their pending duplex complement (without track_tags)
+
+    # ===== Checkpoint =====
+    # State of last completed region is restored, and completed regions are skipped
+    if checkpoint is not None and checkpoint.resumed:
+        read_dict, tag_dict, pair_dict, csn_pair_dict, counters = checkpoint.restore(bamfile.header)
+        unmapped, multiple_mapping, counter = counters['unmapped'], counters['multiple_mapping'], counters['counter']
+        singletons, SSCS_reads, N_bases = counters['singletons'], counters['SSCS_reads'], counters['N_bases']
+        region, readLength = counters['region'], counters['readLength']
+        family_sizes = FamilySizes(counters['family_sizes'], counters['written_families'], track_tags)
+        metrics.last_totals.update(families=singletons + SSCS_reads, singletons=singletons, consensus_reads=SSCS_reads)
+        print('Resuming from checkpoint after {} completed regions'.format(checkpoint.completed))
+
+    for chunk_number, x in enumerate(division_coor):
+        if checkpoint is not None:
+            if chunk_number < checkpoint.completed:
+                continue
+            checkpoint.start_region(chunk_number)
+
+        bam_lines = None
+        if args.stream or store is not None:
+            bam_lines = x
             read_chr = None
             read_start = None
             read_end = None
+            region_name = 'chunk_{}'.format(chunk_number)
+        elif division_coor == [1]:
+            read_chr = None
+            read_start = None
+            read_end = None
+            region_name = 'all'
         else:
-            read_chr = x.split('_', 1)[0]
-            read_start = division_coor[x][0]
-            read_end = division_coor[x][1]
+            region_name = x
+            read_chr, read_start, read_end = division_coor[x]
 
         # === Construct dictionaries for consensus making ===
-        chr_data = read_bam(bamfile,
-                            read_dict=read_dict,
-                            tag_dict=tag_dict,
-                            pair_dict=pair_dict,
-                            csn_pair_dict=csn_pair_dict,
-                            badRead_bam=badRead_bam,
-                            duplex=None,  # this indicates bamfile is not for making DCS (thus headers are diff)
-                            read_chr=read_chr,
-                            read_start=read_start,
-                            read_end=read_end
-                            )
+        metrics.switch('group')
+        if store is not None:
+            chr_data = add_stored_families(x, read_dict, tag_dict, pair_dict, csn_pair_dict)
+        else:
+            chr_data = read_bam(bamfile,
+                                read_dict=read_dict,
+                                tag_dict=tag_dict,
+                                pair_dict=pair_dict,
+                                csn_pair_dict=csn_pair_dict,
+                                badRead_bam=badRead_bam,
+                                duplex=None,  # this indicates bamfile is not for making DCS (thus headers are diff)
+                                read_chr=read_chr,
+                                read_start=read_start,
+                                read_end=read_end,
+                                bam_lines=bam_lines,
+                                barcode_tag=args.umi_tag,
+                                umi_cluster=args.umi_cluster,
+                                metrics=metrics,
+                                written_tags=family_sizes
+                                )
+        metrics.switch(None)
 
         # Set dicts and update counters
         read_dict = chr_data[0]
@@ -260,6 +535,7 @@ def main():
         counter += chr_data[4]
         unmapped += chr_data[5]
         multiple_mapping += chr_data[6]
+        metrics.peak(read_dict=len(read_dict), pair_dict=len(pair_dict), csn_pair_dict=len(csn_pair_dict))
 
         # Determine length of sequence
         if region is 0 and bool(read_dict.values()):
@@ -270,58 +546,118 @@ def main():
         #     CONSENSUS      #
         ######################
         # ===== Create consensus sequences for paired reads =====
+        metrics.switch('consensus')
         for readPair in list(csn_pair_dict.keys()):
             if len(csn_pair_dict[readPair]) == 2:
                 for tag in csn_pair_dict[readPair]:
+                    if store_writer is not None:
+                        store_writer.add_family(readPair, tag, read_dict[tag])
+
+                    # Family size of provisional consensus reads carried over from FASTQ collapsing
+                    if args.collapsed:
+                        tag_dict[tag] = sum(read.get_tag('XF') for read in read_dict[tag])
+
+                    if family_table is not None:
+                        # Duplex family is pending or was written in this or the previous region (or before)
+                        duplex_size = tag_dict.get(duplex_tag(tag)) or family_sizes.get(duplex_tag(tag)) or \
+                            duplex_sizes.pop(tag, 0)
+
                     # Check for singletons
                     if tag_dict[tag] == 1:
                         singletons += 1
                         # Assign singletons our unique query name
                         read_dict[tag][0].query_name = readPair + ':' + str(tag_dict[tag])
                         singleton_bam.write(read_dict[tag][0])
+                        if family_table is not None:
+                            family_table.add(readPair, tag, 1, duplex_size, 'singleton',
+                                             *[read_dict[tag][0].query_sequence.count('N')] * len(args.cutoff))
                     else:
-                        # Create collapsed SSCSs
-                        SSCS = consensus_maker(read_dict[tag], float(args.cutoff), readLength)
-
+                        # Create collapsed SSCSs, bases are counted once for all cutoffs
+                        position_counts = consensus_counts(read_dict[tag], readLength)
                         query_name = readPair + ':' + str(tag_dict[tag])
-                        SSCS_read = create_aligned_segment(read_dict[tag], SSCS[0], SSCS[1], query_name)
-
-                        # Write consensus bam
-                        SSCS_bam.write(SSCS_read)
+                        n_counts = []
+
+                        for i, cutoff in enumerate(args.cutoff):
+                            SSCS = consensus_call(position_counts, cutoff)
+                            N_bases[i] += SSCS[0].count('N')
+                            n_counts.append(SSCS[0].count('N'))
+
+                            if i == 0:
+                                SSCS_read = create_aligned_segment(read_dict[tag], SSCS[0], SSCS[1], query_name)
+                            else:
+                                # Same template fields for all cutoffs, only bases differ
+                                SSCS_read = copy.copy(SSCS_read)
+                                SSCS_read.query_sequence = SSCS[0]
+                                SSCS_read.query_qualities = SSCS[1]
+
+                            # Write consensus bam
+                            SSCS_bams[i].write(SSCS_read)
                         SSCS_reads += 1
+                        if family_table is not None:
+                            family_table.add(readPair, tag, tag_dict[tag], duplex_size, 'SSCS', *n_counts)
 
-                    # Remove read from dictionary after writing
+                    # Remove read from dictionaries after writing, family size is kept in histogram
                     del read_dict[tag]
+                    if family_table is not None and not track_tags and duplex_tag(tag) in tag_dict:
+                        duplex_sizes[duplex_tag(tag)] = tag_dict[tag]
+                    family_sizes.add(tag, tag_dict.pop(tag))
 
                 # Remove key from dictionary after writing
                 del csn_pair_dict[readPair]
+        metrics.switch(None)
+
+        if args.stream:
+            # Release SSCSs that can no longer be preceded by reads of pending families
+            watermark = stream_watermark(pair_dict, x, STREAM_MAX_DISTANCE) if store is None else stored_watermark(x)
+            for SSCS_bam in SSCS_bams:
+                metrics.peak(sorted_buffer=SSCS_bam.flush(watermark))
+
+        metrics.finish(region_name, families=singletons + SSCS_reads, singletons=singletons,
+                       consensus_reads=SSCS_reads)
 
         try:
             time_tracker.write(x + ': ')
             time_tracker.write(str((time.time() - start_time)/60) + '\n')
         except:
-            # When no genomic coordinates (x) provided for data division
-            continue
+            # When no genomic coordinates (x) provided for data division (or streamed/stored chunks)
+            pass
+
+        family_sizes.next_region()
+
+        if checkpoint is not None:
+            time_tracker.flush()
+            checkpoint.finish_region(chunk_number, read_dict, tag_dict, pair_dict, csn_pair_dict, {
+                'unmapped': unmapped, 'multiple_mapping': multiple_mapping, 'counter': counter,
+                'singletons': singletons, 'SSCS_reads': SSCS_reads, 'N_bases': N_bases, 'region': region,
+                'readLength': readLength if region else None, 'family_sizes': family_sizes.histogram.tolist(),
+                'written_families': family_sizes.previous})
 
     ######################
     #       SUMMARY      #
     ######################
     # === STATS ===
     # Note: total reads = unmapped + secondary + SSCS uncollapsed + singletons
-    summary_stats = '''# === SSCS MAKER ===
+    for i, cutoff in enumerate(args.cutoff):
+        summary_stats = '''# === SSCS MAKER ===
+Consensus cut-off: {}
 Uncollapsed - Total reads: {}
 Uncollapsed - Unmapped reads: {}
 Uncollapsed - Secondary/Supplementary reads: {}
 SSCS reads: {}
-Singletons: {} \n'''.format(counter, unmapped, multiple_mapping, SSCS_reads, singletons)
+SSCS N bases: {}
+Singletons: {} \n'''.format(cutoff, counter, unmapped, multiple_mapping, SSCS_reads, N_bases[i], singletons)
+        if len(args.cutoff) > 1:
+            # Singleton BAM file is shared by all cutoffs
+            summary_stats += 'Singleton BAM: {}\n'.format(singleton_file)
 
-    stats.write(summary_stats)
-    print(summary_stats)
+        stats_files[i].write(summary_stats)
+        print(summary_stats)
 
     # === QC to see if there's remaining reads ===
     print('# QC: Total uncollapsed reads should be equivalent to mapped reads in bam file.')
     print('Total uncollapsed reads: {}'.format(counter))
-    print('Total mapped reads in bam file: {}'.format(bamfile.mapped))
+    if bamfile.has_index():
+        print('Total mapped reads in bam file: {}'.format(bamfile.mapped))
 
     print("QC: check dictionaries to see if there are any remaining reads")
     print('=== pair_dict remaining ===')
@@ -355,29 +691,38 @@ Singletons: {} \n'''.format(counter, unmapped, multiple_mapping, SSCS_reads, sin
             except ValueError:
                 print("Mate not found")
 
-    # ===== write tag family size dictionary to file =====
-    tags_per_fam = collections.Counter([i for i in tag_dict.values()])  # count of tags within each family size
-    lst_tags_per_fam = list(tags_per_fam.items())  # convert to list [(fam, numTags)]
-    with open(args.outfile.split('.sscs')[0] + '.read_families.txt', "w") as stat_file:
+    # ===== write tag family size histogram to file =====
+    # Families left in tag_dict (see read_dict remaining above) are counted too
+    for tag, size in tag_dict.items():
+        family_sizes.add(tag, size)
+    lst_tags_per_fam = family_sizes.items()  # [(fam, numTags)] by family size
+    with open(args.prefix + '.read_families.txt', "w") as stat_file:
         stat_file.write('family_size\tfrequency\n')
         stat_file.write('\n'.join('%s\t%s' % x for x in lst_tags_per_fam))
 
-    # ===== Create tag family size plot =====
-    total_reads = sum(tag_dict.values())
-    # Read fraction = family size * frequency of family / total reads
-    read_fraction = [(i*j)/total_reads for i, j in lst_tags_per_fam]
-
-    plt.bar(list(tags_per_fam), read_fraction)
-    # Determine read family size range to standardize plot axis
-    plt.xlim([0, math.ceil(lst_tags_per_fam[-1][0]/10) * 10])
-    plt.savefig(args.outfile.split('.sscs')[0]+'_tag_fam_size.png')
-
     # ===== Close files =====
     time_tracker.close()
-    stats.close()
+    for stats in stats_files:
+        stats.close()
     bamfile.close()
-    SSCS_bam.close()
+    for SSCS_bam in SSCS_bams:
+        SSCS_bam.close()
+    singleton_bam.close()
     badRead_bam.close()
+    metrics.close()
+    if family_table is not None:
+        family_table.close()
+
+    if store_writer is not None:
+        with pysam.AlignmentFile('{}.badReads.bam'.format(args.prefix), "rb", check_sq=False) as bad_reads:
+            store_writer.close({'counter': counter, 'unmapped': unmapped, 'multiple_mapping': multiple_mapping},
+                               bad_reads.fetch(until_eof=True))
+
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    if profiler is not None:
+        profiler.stop()
 
 
 ###############################
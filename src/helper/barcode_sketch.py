@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                      Barcode Sketch
+#
+###############################################################
+# Function:
+# Bounded-memory estimates of barcode family sizes for library QC before alignment (tag_to_header.py --sketch).
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Barcodes are 2-bit packed integers (tag1 + tag2, see tag_to_header.pack_barcode), hashed with splitmix64
+#   - Count-min sketch: family size of any barcode, overestimated by at most e/width * total reads with probability
+#                       1 - e^-depth
+#   - HyperLogLog: number of distinct barcodes (families), relative standard error 1.04/sqrt(2^precision)
+#   - Bottom-k sample: uniform sample of distinct barcodes (k smallest hashes), whose family sizes and duplex partner
+#                      family sizes are looked up in the count-min sketch to estimate the family size distribution,
+#                      SSCS count and DCS yield
+#
+# Memory is fixed by the sketch parameters (~16 MB with defaults), regardless of the number of reads.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import math
+import numpy as np
+
+
+###############################
+#          Functions          #
+###############################
+def mix64(values, seed=0):
+    """(numpy.ndarray, int) -> numpy.ndarray
+    Return 64-bit hashes of uint64 values (splitmix64 finalizer), with seed selecting an independent hash function.
+
+    >>> mix64(np.array([0, 1], dtype=np.uint64)).tolist()
+    [16294208416658607535, 10451216379200822465]
+    """
+    with np.errstate(over='ignore'):
+        z = values + np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) & 0xFFFFFFFFFFFFFFFF)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def duplex_partners(packed, taglen):
+    """(numpy.ndarray, int) -> numpy.ndarray
+    Return packed barcodes of duplex partners (tag1 + tag2 -> tag2 + tag1) by swapping the two halves.
+
+    >>> duplex_partners(np.array([0b0001, 0b1110], dtype=np.uint64), 1).tolist()
+    [4, 11]
+    """
+    half_bits = np.uint64(2 * taglen)
+    return ((packed & np.uint64((1 << (2 * taglen)) - 1)) << half_bits) | (packed >> half_bits)
+
+
+class BarcodeSketch(object):
+    """Count-min sketch, HyperLogLog and bottom-k sample over packed barcodes.
+
+    Barcodes are added in batches (numpy uint64 arrays) with update(), and estimates are returned by summary().
+    """
+    def __init__(self, taglen, width=2**20, depth=4, precision=14, sample_size=100000):
+        if 4 * taglen > 64:
+            raise ValueError("Duplex barcodes longer than 32 bases can't be packed into 64 bits")
+        self.taglen = taglen
+        self.width = width
+        self.depth = depth
+        self.precision = precision
+        self.sample_size = sample_size
+        self.total = 0
+        self.counts = np.zeros((depth, width), dtype=np.uint32)
+        self.registers = np.zeros(2**precision, dtype=np.uint8)
+        self.sample_hashes = np.zeros(0, dtype=np.uint64)
+        self.sample_barcodes = np.zeros(0, dtype=np.uint64)
+
+    def update(self, packed):
+        """Add batch of packed barcodes (one per read pair)."""
+        packed = np.asarray(packed, dtype=np.uint64)
+        self.total += len(packed)
+
+        # Count-min sketch
+        for row in range(self.depth):
+            index = mix64(packed, row + 1) % np.uint64(self.width)
+            self.counts[row] += np.bincount(index.astype(np.intp), minlength=self.width).astype(np.uint32)
+
+        # HyperLogLog: register from leading bits, rank from position of first 1 bit in the remaining bits
+        hashes = mix64(packed)
+        low_bits = 64 - self.precision
+        index = (hashes >> np.uint64(low_bits)).astype(np.intp)
+        remainder = hashes & np.uint64((1 << low_bits) - 1)
+        # frexp exponent is the exact bit length, as remainders (< 2^53) are represented exactly as floats
+        rank = (low_bits - np.frexp(remainder.astype(np.float64))[1] + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+        # Bottom-k sample of distinct barcodes
+        if len(self.sample_hashes) == self.sample_size:
+            keep = hashes < self.sample_hashes[-1]
+            hashes, packed = hashes[keep], packed[keep]
+        sample_hashes, first = np.unique(np.concatenate((self.sample_hashes, hashes)), return_index=True)
+        self.sample_hashes = sample_hashes[:self.sample_size]
+        self.sample_barcodes = np.concatenate((self.sample_barcodes, packed))[first[:self.sample_size]]
+
+    def query(self, packed):
+        """Return count-min estimates of family sizes for array of packed barcodes."""
+        packed = np.asarray(packed, dtype=np.uint64)
+        estimates = [self.counts[row][(mix64(packed, row + 1) % np.uint64(self.width)).astype(np.intp)]
+                     for row in range(self.depth)]
+        return np.min(estimates, axis=0)
+
+    def distinct(self):
+        """Return HyperLogLog estimate of number of distinct barcodes."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # Small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return estimate
+
+    def sample_family_sizes(self):
+        """Return family sizes of sampled barcodes and of their duplex partners."""
+        return self.query(self.sample_barcodes), self.query(duplex_partners(self.sample_barcodes, self.taglen))
+
+    def summary(self, min_size=3, z=1.96):
+        """Return dictionary of estimates with lower and upper bounds (95% confidence with z=1.96).
+
+        Bounds combine the HyperLogLog standard error and the binomial sampling error of the bottom-k sample. Family
+        sizes from the count-min sketch are upper bounds, overestimated by at most cms_error reads each with
+        probability cms_confidence.
+        """
+        sizes, partner_sizes = self.sample_family_sizes()
+        sample_size = max(len(sizes), 1)
+        # Sample is exhaustive (exact number of families, no sampling error) if it holds every distinct barcode seen
+        exhaustive = len(sizes) < self.sample_size
+        if exhaustive:
+            families, hll_error = len(sizes), 0
+        else:
+            families, hll_error = self.distinct(), 1.04 / math.sqrt(len(self.registers))
+
+        report = {'reads': self.total,
+                  'families': (families, families * (1 - z * hll_error), families * (1 + z * hll_error)),
+                  'cms_error': math.e / self.width * self.total,
+                  'cms_confidence': 1 - math.exp(-self.depth),
+                  'sample_size': len(sizes)}
+
+        sscs = sizes >= min_size
+        for name, passing in [('sscs', sscs), ('dcs', sscs & (partner_sizes >= min_size))]:
+            p = np.count_nonzero(passing) / sample_size
+            sample_error = 0 if exhaustive or p == 0 else math.sqrt(p * (1 - p) / sample_size) / p
+            error = z * math.sqrt(hll_error ** 2 + sample_error ** 2)
+            report[name] = (families * p, families * p * max(1 - error, 0), families * p * (1 + error))
+
+        return report
+
+
+def write_report(report, filename):
+    """(dict, str) -> None
+    Write sketch estimates (BarcodeSketch.summary) with 95% bounds to tab separated file.
+    """
+    with open(filename, 'w') as f:
+        f.write('# Estimate\tValue\tLower\tUpper\n')
+        f.write('Passing Reads\t{}\t{}\t{}\n'.format(report['reads'], report['reads'], report['reads']))
+        for name, key in [('Families', 'families'), ('SSCS Reads', 'sscs'), ('DCS Reads', 'dcs')]:
+            f.write('{}\t{:.0f}\t{:.0f}\t{:.0f}\n'.format(name, *report[key]))
+        f.write('# Sampled families: {}\n'.format(report['sample_size']))
+        f.write('# Family sizes overestimated by at most {:.1f} reads with probability {:.3f}\n'.format(
+            report['cms_error'], report['cms_confidence']))
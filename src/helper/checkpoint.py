@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                         Checkpoint
+#
+###############################################################
+# Function:
+# Region-granular checkpoints of SSCS_maker.py (--checkpoint), so a run killed part way (e.g. by the scheduler) is
+# restarted from the last completed region instead of from the start of the genome.
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Checkpoint files are kept in a subdirectory of the --checkpoint directory (".sscs_checkpoint"), so the directory
+#     can be shared with outputs and other files
+#   - Output BAM files are written as one shard per region in the checkpoint subdirectory ("<output>.<region>.bam") and
+#     concatenated in region order when the run completes, so outputs are the same as without checkpoints
+#   - After each region, the state carried over to the next region (read_dict, tag_dict, pair_dict, csn_pair_dict,
+#     counters, family size histogram) is saved ("state.json", replaced atomically), with pending reads as SAM lines
+#   - A restarted run with the same parameters loads the state and skips completed regions. Shards of the region
+#     that was interrupted are overwritten. Checkpoints of runs with other parameters (or input) are discarded
+#   - Only files of the checkpoint are removed (shards of the run's outputs, "state.json"), when the run completes or
+#     the checkpoint is discarded. The checkpoint subdirectory is then removed if it's empty
+#   - Only imported when --checkpoint is set
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import collections
+import glob
+import json
+import os
+import pysam
+
+CHECKPOINT_DIR = '.sscs_checkpoint'
+
+
+###############################
+#          Functions          #
+###############################
+def input_params(infile, params):
+    """(str, dict) -> dict
+    Return run parameters with size and modification time of input file, to identify checkpoints of the same run.
+    """
+    stat = os.stat(infile)
+    return dict(params, infile=os.path.abspath(infile), infile_size=stat.st_size, infile_mtime=stat.st_mtime)
+
+
+def encode_reads(reads_dict):
+    """(dict) -> list
+    Return [key, [SAM line, ...]] pairs of dictionary of read lists, in dictionary order.
+    """
+    return [[key, [read.to_string() for read in reads]] for key, reads in reads_dict.items()]
+
+
+def decode_reads(pairs, header, dict_type):
+    """(list, pysam.AlignmentHeader, type) -> dict
+    Return dictionary of read lists (of dict_type) from [key, [SAM line, ...]] pairs.
+    """
+    reads_dict = dict_type()
+    for key, lines in pairs:
+        reads_dict[key] = [pysam.AlignedSegment.fromstring(line, header) for line in lines]
+
+    return reads_dict
+
+
+def shards(shard_prefix):
+    """(str) -> list
+    Return sorted shard files of output BAM file (see ShardedBamWriter).
+    """
+    return sorted(glob.glob('{}.[0-9]*.bam'.format(shard_prefix)))
+
+
+class ShardedBamWriter(object):
+    """BAM writer with one shard per region in the checkpoint directory, concatenated into filename by close()."""
+    def __init__(self, filename, template, directory):
+        self.filename = filename
+        self.header = template.header
+        self.shard_prefix = os.path.join(directory, os.path.basename(filename).rsplit('.bam', 1)[0])
+        self.bam = None
+
+    def open_shard(self, region):
+        self.bam = pysam.AlignmentFile('{}.{:06d}.bam'.format(self.shard_prefix, region), "wb", header=self.header)
+
+    def close_shard(self):
+        if self.bam is not None:
+            self.bam.close()
+            self.bam = None
+
+    def write(self, read):
+        self.bam.write(read)
+
+    def close(self):
+        self.close_shard()
+        with pysam.AlignmentFile(self.filename, "wb", header=self.header) as bam:
+            for shard in shards(self.shard_prefix):
+                with pysam.AlignmentFile(shard, "rb", check_sq=False) as shard_bam:
+                    for read in shard_bam.fetch(until_eof=True):
+                        bam.write(read)
+
+
+class Checkpoint(object):
+    """Checkpoint of a run with given parameters (see input_params), kept in CHECKPOINT_DIR of directory.
+
+    resumed is True if a checkpoint of the same run was found, its state is returned by restore().
+    """
+    def __init__(self, directory, params):
+        self.directory = os.path.join(directory, CHECKPOINT_DIR)
+        self.params = params
+        self.writers = []
+        self.state = None
+        state_file = os.path.join(self.directory, 'state.json')
+
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if state['params'] == params:
+                self.state = state
+            else:
+                print('Checkpoint in {} is from a run with other parameters, starting from the first region'.format(
+                    directory))
+                self.remove_files([os.path.join(self.directory, name) for name in state.get('shards', [])])
+        os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def resumed(self):
+        return self.state is not None
+
+    @property
+    def completed(self):
+        """Number of completed regions."""
+        return self.state['completed'] if self.resumed else 0
+
+    def writer(self, filename, template):
+        """Return sharded writer of output BAM file."""
+        writer = ShardedBamWriter(filename, template, self.directory)
+        self.writers.append(writer)
+        return writer
+
+    def start_region(self, region):
+        for writer in self.writers:
+            writer.open_shard(region)
+
+    def finish_region(self, region, read_dict, tag_dict, pair_dict, csn_pair_dict, counters):
+        """Close shards of region and save state carried over to the next region (counters is a dict)."""
+        for writer in self.writers:
+            writer.close_shard()
+
+        state = {'params': self.params,
+                 'completed': region + 1,
+                 'shards': [os.path.basename(writer.shard_prefix) for writer in self.writers],
+                 'read_dict': encode_reads(read_dict),
+                 'tag_dict': list(tag_dict.items()),
+                 'pair_dict': encode_reads(pair_dict),
+                 'csn_pair_dict': list(csn_pair_dict.items()),
+                 'counters': counters}
+        state_file = os.path.join(self.directory, 'state.json')
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_file + '.tmp', state_file)
+
+    def restore(self, header):
+        """(pysam.AlignmentHeader) -> dict, dict, dict, dict, dict
+        Return read_dict, tag_dict, pair_dict, csn_pair_dict and counters of last completed region.
+        """
+        read_dict = decode_reads(self.state['read_dict'], header, collections.OrderedDict)
+        tag_dict = collections.defaultdict(int, self.state['tag_dict'])
+        pair_dict = decode_reads(self.state['pair_dict'], header, lambda: collections.defaultdict(list))
+        csn_pair_dict = collections.defaultdict(list, self.state['csn_pair_dict'])
+
+        return read_dict, tag_dict, pair_dict, csn_pair_dict, self.state['counters']
+
+    def remove_files(self, shard_prefixes):
+        """(list) -> None
+        Remove shards of shard prefixes and state files, and the checkpoint directory if nothing else is left in it.
+        """
+        for shard_prefix in shard_prefixes:
+            for shard in shards(shard_prefix):
+                os.remove(shard)
+        for state_file in ['state.json', 'state.json.tmp']:
+            if os.path.exists(os.path.join(self.directory, state_file)):
+                os.remove(os.path.join(self.directory, state_file))
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass  # Not empty (e.g. checkpoint of another run)
+
+    def remove(self):
+        self.remove_files([writer.shard_prefix for writer in self.writers])
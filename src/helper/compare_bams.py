@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        BAM Comparison
+#
+###############################################################
+# Function:
+# To check that two BAM files contain the same records regardless of order, e.g. to validate a faster implementation
+# of a consensus step against the reference implementation (run both with --seed for deterministic tie-breaking).
+# - Records are compared as SAM lines (all fields and optional tags), as a multiset (duplicate records are counted)
+# - Reference sequences (@SQ) of headers must match, other header lines (e.g. @PG) are ignored
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 compare_bams.py [--bam1 BAM1] [--bam2 BAM2] [--ignore_tags TAG [TAG ...]] [--max_diffs MAXDIFFS]
+#
+# Arguments:
+# --bam1 BAM1               First BAM file
+# --bam2 BAM2               Second BAM file
+# --ignore_tags TAG         Optional tags to ignore (e.g. PG)
+# --max_diffs MAXDIFFS      Maximum number of differing records reported from each file [10]
+#
+# Outputs:
+# Number of records in each file and records only found in one of them (stdout). Exit status is 1 if BAM files differ.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import collections
+import hashlib
+import pysam
+import sys
+
+
+###############################
+#          Functions          #
+###############################
+def record_string(read, ignore_tags=()):
+    """(pysam.AlignedSegment, tuple) -> str
+    Return SAM line of read with optional tags sorted (and ignored tags removed), so tag order doesn't matter.
+    """
+    fields = read.to_string().split('\t')
+    tags = sorted(tag for tag in fields[11:] if tag[:2] not in ignore_tags)
+    return '\t'.join(fields[:11] + tags)
+
+
+def record_digests(filename, ignore_tags=()):
+    """(str, tuple) -> Counter, list
+    Return count of each record (MD5 digest of SAM line) and reference sequences of BAM file.
+    """
+    digests = collections.Counter()
+    with pysam.AlignmentFile(filename, "rb", check_sq=False) as bam:
+        references = list(zip(bam.references, bam.lengths))
+        for read in bam.fetch(until_eof=True):
+            digests[hashlib.md5(record_string(read, ignore_tags).encode()).digest()] += 1
+
+    return digests, references
+
+
+def find_records(filename, digests, ignore_tags=(), max_records=10):
+    """(str, Counter, tuple, int) -> list
+    Return up to max_records SAM lines of BAM file matching digests.
+    """
+    records = []
+    digests = digests.copy()
+    with pysam.AlignmentFile(filename, "rb", check_sq=False) as bam:
+        for read in bam.fetch(until_eof=True):
+            record = record_string(read, ignore_tags)
+            digest = hashlib.md5(record.encode()).digest()
+            if digests[digest] > 0:
+                digests[digest] -= 1
+                records.append(record)
+                if len(records) == max_records:
+                    break
+
+    return records
+
+
+def compare_bams(bam1, bam2, ignore_tags=(), max_diffs=10):
+    """(str, str, tuple, int) -> dict
+    Compare records of two BAM files regardless of order and return dictionary of results:
+    identical (bool), records (counts in each file), references (bool, if @SQ lines match) and only1/only2 (number and
+    examples of records only found in one file).
+    """
+    digests1, references1 = record_digests(bam1, ignore_tags)
+    digests2, references2 = record_digests(bam2, ignore_tags)
+    only1 = digests1 - digests2
+    only2 = digests2 - digests1
+
+    return {'identical': not only1 and not only2 and references1 == references2,
+            'records': (sum(digests1.values()), sum(digests2.values())),
+            'references': references1 == references2,
+            'only1': (sum(only1.values()), find_records(bam1, only1, ignore_tags, max_diffs) if only1 else []),
+            'only2': (sum(only2.values()), find_records(bam2, only2, ignore_tags, max_diffs) if only2 else [])}
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--bam1", action="store", dest="bam1", help="First BAM file", required=True)
+    parser.add_argument("--bam2", action="store", dest="bam2", help="Second BAM file", required=True)
+    parser.add_argument("--ignore_tags", action="store", dest="ignore_tags", nargs='+', default=[],
+                        help="Optional tags to ignore (e.g. PG)")
+    parser.add_argument("--max_diffs", action="store", dest="max_diffs", type=int, default=10,
+                        help="Maximum number of differing records reported from each file [10]")
+    args = parser.parse_args()
+
+    result = compare_bams(args.bam1, args.bam2, tuple(args.ignore_tags), args.max_diffs)
+
+    print('Records: {} {}, {} {}'.format(args.bam1, result['records'][0], args.bam2, result['records'][1]))
+    if not result['references']:
+        print('Reference sequences (@SQ) differ')
+    for filename, (count, records) in [(args.bam1, result['only1']), (args.bam2, result['only2'])]:
+        if count:
+            print('Records only in {}: {}'.format(filename, count))
+            for record in records:
+                print('  ' + record)
+    print('Identical' if result['identical'] else 'Different')
+
+    sys.exit(0 if result['identical'] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Consensus API
+#
+###############################################################
+# Function:
+# Library interface to consensus making, for composing stages in one process without temporary BAM files. Each stage
+# takes iterators of coordinate-sorted reads (pysam.AlignedSegment, e.g. from pysam.AlignmentFile.fetch) and returns
+# an iterator of consensus records and a stats object:
+#   make_sscs(reads, cutoff)                    -> records labelled 'sscs', 'singleton', 'badReads'
+#   make_dcs(sscs_reads)                        -> records labelled 'dcs', 'sscs.singleton'
+#   correct_singletons(singletons, sscs_reads)  -> records labelled 'sscs.correction', 'singleton.correction',
+#                                                  'uncorrected'
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Records are (label, read) tuples, with labels named after the output files of SSCS_maker.py, DCS_maker.py and
+#     singleton_correction.py
+#   - Reads are grouped in chunks broken where the start coordinate changes, as in streaming mode (see
+#     consensus_helper.stream_chunks), so memory is bounded by the reads pending between mates rather than the input
+#   - Records are returned in coordinate order (see consensus_helper.SortedBamWriter), so the output of a stage can be
+#     passed straight to the next stage
+#   - Stats are complete once all records have been consumed
+#   - Ties of consensus read fields are broken randomly unless a seed is set with consensus_helper.set_tie_seed
+#
+# Example:
+#   with pysam.AlignmentFile('sample.bam') as bam:
+#       records, sscs_stats = make_sscs(bam.fetch(until_eof=True), 0.7)
+#       sscs_reads = [read for label, read in records if label == 'sscs']
+#   dcs_records, dcs_stats = make_dcs(sscs_reads)
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import collections
+import heapq
+
+from consensus_helper import *
+import SSCS_maker
+import DCS_maker
+import singleton_correction
+
+
+###############################
+#          Functions          #
+###############################
+class ConsensusStats(object):
+    """Counts of a consensus stage (e.g. stats.sscs_reads), updated as records are consumed.
+
+    >>> stats = ConsensusStats('DCS', ['total_reads', 'dcs_reads'])
+    >>> stats.dcs_reads += 2
+    >>> stats
+    ConsensusStats('DCS', total_reads=0, dcs_reads=2)
+    """
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+        for field in fields:
+            setattr(self, field, 0)
+
+    def as_dict(self):
+        return collections.OrderedDict((field, getattr(self, field)) for field in self.fields)
+
+    def __repr__(self):
+        return 'ConsensusStats({!r}, {})'.format(self.stage, ', '.join('{}={}'.format(field, count)
+                                                                       for field, count in self.as_dict().items()))
+
+
+class SortedRecords(object):
+    """Labelled records buffered in coordinate order and released below the streaming watermark (see
+    consensus_helper.SortedBamWriter).
+    """
+    def __init__(self):
+        self.heap = []
+        self.counter = 0  # Tie-breaker to keep order of records sharing the same coordinate
+
+    def add(self, label, read):
+        heapq.heappush(self.heap, (read_coordinate(read), self.counter, label, read))
+        self.counter += 1
+
+    def release(self, watermark=None):
+        """Yield buffered records positioned before watermark (all records if watermark is None)."""
+        while self.heap and (watermark is None or self.heap[0][0] < watermark):
+            coordinate, counter, label, read = heapq.heappop(self.heap)
+            yield label, read
+
+
+class LabelledWriter(object):
+    """Add reads written by read_bam (e.g. bad reads) to SortedRecords with a label."""
+    def __init__(self, records, label):
+        self.records = records
+        self.label = label
+
+    def write(self, read):
+        self.records.add(self.label, read)
+
+
+def make_sscs(reads, cutoff=0.7, umi_tag=None, umi_cluster=False, collapsed=False, chunk_size=10000):
+    """(iterable, float, str, bool, bool, int) -> generator, ConsensusStats
+    Return single-strand consensus records ('sscs', 'singleton' and 'badReads') of coordinate-sorted uncollapsed reads
+    and stats of SSCS making (stats.family_sizes counts tags of each family size, as in "read_families.txt").
+
+    Arguments are the same as SSCS_maker.py (a single cutoff; umi_tag, umi_cluster and collapsed for --umi_tag,
+    --umi_cluster and --collapsed).
+    """
+    stats = ConsensusStats('SSCS', ['total_reads', 'unmapped', 'multiple_mapping', 'sscs_reads', 'n_bases',
+                                    'singletons'])
+    stats.family_sizes = collections.Counter()
+
+    return _sscs_records(reads, cutoff, umi_tag, umi_cluster, collapsed, chunk_size, stats), stats
+
+
+def _sscs_records(reads, cutoff, umi_tag, umi_cluster, collapsed, chunk_size, stats):
+    records = SortedRecords()
+    bad_reads = LabelledWriter(records, 'badReads')
+    read_dict = collections.OrderedDict()
+    tag_dict = collections.defaultdict(int)
+    pair_dict = collections.defaultdict(list)
+    csn_pair_dict = collections.defaultdict(list)
+    family_sizes = FamilySizes(track_tags=False)  # streamed chunks, no read is read twice
+    read_length = None
+
+    for chunk in chunk_reads(reads, chunk_size):
+        chr_data = read_bam(None,
+                            read_dict=read_dict,
+                            tag_dict=tag_dict,
+                            pair_dict=pair_dict,
+                            csn_pair_dict=csn_pair_dict,
+                            badRead_bam=bad_reads,
+                            duplex=None,
+                            bam_lines=chunk,
+                            barcode_tag=umi_tag,
+                            umi_cluster=umi_cluster)
+        stats.total_reads += chr_data[4]
+        stats.unmapped += chr_data[5]
+        stats.multiple_mapping += chr_data[6]
+
+        # Determine length of sequence
+        if read_length is None and read_dict:
+            read_length = next(iter(read_dict.values()))[0].infer_query_length()
+
+        for readPair in list(csn_pair_dict.keys()):
+            if len(csn_pair_dict[readPair]) == 2:
+                for tag in csn_pair_dict[readPair]:
+                    # Family size of provisional consensus reads carried over from FASTQ collapsing
+                    if collapsed:
+                        tag_dict[tag] = sum(read.get_tag('XF') for read in read_dict[tag])
+
+                    query_name = readPair + ':' + str(tag_dict[tag])
+                    if tag_dict[tag] == 1:
+                        stats.singletons += 1
+                        read_dict[tag][0].query_name = query_name
+                        records.add('singleton', read_dict[tag][0])
+                    else:
+                        consensus_seq, consensus_qual = SSCS_maker.consensus_maker(read_dict[tag], cutoff, read_length)
+                        stats.n_bases += consensus_seq.count('N')
+                        stats.sscs_reads += 1
+                        records.add('sscs', create_aligned_segment(read_dict[tag], consensus_seq, consensus_qual,
+                                                                   query_name))
+                    del read_dict[tag]
+                    family_sizes.add(tag, tag_dict.pop(tag))
+
+                del csn_pair_dict[readPair]
+
+        yield from records.release(stream_watermark(pair_dict, chunk))
+
+    yield from records.release()
+    for tag, size in tag_dict.items():
+        family_sizes.add(tag, size)
+    stats.family_sizes.update(dict(family_sizes.items()))
+
+
+def make_dcs(sscs_reads, chunk_size=10000):
+    """(iterable, int) -> generator, ConsensusStats
+    Return duplex consensus records ('dcs' and 'sscs.singleton') of coordinate-sorted SSCS reads (e.g. 'sscs' records
+    of make_sscs) and stats of DCS making.
+    """
+    stats = ConsensusStats('DCS', ['total_reads', 'unmapped', 'multiple_mapping', 'dcs_reads', 'sscs_singletons'])
+
+    return _dcs_records(sscs_reads, chunk_size, stats), stats
+
+
+def _dcs_records(sscs_reads, chunk_size, stats):
+    records = SortedRecords()
+    read_dict = collections.OrderedDict()
+    tag_dict = collections.defaultdict(int)
+    pair_dict = collections.defaultdict(list)
+    csn_pair_dict = collections.defaultdict(list)
+    duplex_dict = collections.defaultdict(int)
+
+    for chunk in chunk_reads(sscs_reads, chunk_size):
+        chr_data = read_bam(None,
+                            pair_dict=pair_dict,
+                            read_dict=read_dict,
+                            csn_pair_dict=csn_pair_dict,
+                            tag_dict=tag_dict,
+                            badRead_bam=None,
+                            duplex=True,
+                            bam_lines=chunk)
+        stats.total_reads += chr_data[4]
+        stats.unmapped += chr_data[5]
+        stats.multiple_mapping += chr_data[6]
+
+        for readPair in list(csn_pair_dict.keys()):
+            for tag in csn_pair_dict[readPair]:
+                ds = duplex_tag(tag)
+
+                # Duplex pairs are only made once (from the first tag of the pair)
+                if ds not in duplex_dict:
+                    if tag in tag_dict and ds in tag_dict:
+                        stats.dcs_reads += 1
+                        consensus_seq, consensus_qual = DCS_maker.duplex_consensus(read_dict[tag][0], read_dict[ds][0])
+                        dcs_query_name = DCS_maker.dcs_consensus_tag(read_dict[tag][0].qname, read_dict[ds][0].qname)
+                        records.add('dcs', create_aligned_segment([read_dict[tag][0], read_dict[ds][0]], consensus_seq,
+                                                                  consensus_qual, dcs_query_name))
+                        duplex_dict[tag] += 1
+                    else:
+                        stats.sscs_singletons += 1
+                        records.add('sscs.singleton', read_dict[tag][0])
+
+                    del read_dict[tag]
+
+            del csn_pair_dict[readPair]
+
+        yield from records.release(stream_watermark(pair_dict, chunk))
+
+    yield from records.release()
+
+
+def correct_singletons(singletons, sscs_reads, chunk_size=10000):
+    """(iterable, iterable, int) -> generator, ConsensusStats
+    Return corrected singleton records ('sscs.correction', 'singleton.correction' and 'uncorrected') of coordinate-
+    sorted singletons and SSCS reads (e.g. 'singleton' and 'sscs' records of make_sscs) and stats of singleton
+    correction.
+
+    Singletons are corrected by their complementary SSCS first, then by their complementary singleton.
+    """
+    stats = ConsensusStats('Singleton Correction', ['total_singletons', 'sscs_correction', 'singleton_correction',
+                                                    'uncorrected'])
+
+    return _corrected_records(singletons, sscs_reads, chunk_size, stats), stats
+
+
+def _corrected_records(singletons, sscs_reads, chunk_size, stats):
+    records = SortedRecords()
+    singleton_dict = collections.OrderedDict()
+    singleton_tag = collections.defaultdict(int)
+    singleton_pair = collections.defaultdict(list)
+    singleton_csn_pair = collections.defaultdict(list)
+    correction_dict = collections.OrderedDict()
+    last_chr = None
+
+    # Singletons and SSCSs are swept together, so complementary strands (same coordinates) are in the same chunk
+    merged = heapq.merge((('singleton', read) for read in singletons), (('sscs', read) for read in sscs_reads),
+                         key=lambda item: read_coordinate(item[1]))
+    for chunk in chunk_reads(merged, chunk_size, key=lambda item: item[1]):
+        # SSCS dicts are cleared for each chromosome, as correction can only be done within the same coordinates
+        if chunk[0][1].reference_id != last_chr:
+            singleton_tag = collections.defaultdict(int)
+            sscs_dict = collections.OrderedDict()
+            sscs_tag = collections.defaultdict(int)
+            sscs_pair = collections.defaultdict(list)
+            sscs_csn_pair = collections.defaultdict(list)
+            last_chr = chunk[0][1].reference_id
+
+        read_bam(None,
+                 pair_dict=singleton_pair,
+                 read_dict=singleton_dict,
+                 tag_dict=singleton_tag,
+                 csn_pair_dict=singleton_csn_pair,
+                 badRead_bam=None,
+                 duplex=True,
+                 bam_lines=[read for source, read in chunk if source == 'singleton'])
+        read_bam(None,
+                 pair_dict=sscs_pair,
+                 read_dict=sscs_dict,
+                 tag_dict=sscs_tag,
+                 csn_pair_dict=sscs_csn_pair,
+                 badRead_bam=None,
+                 duplex=True,
+                 bam_lines=[read for source, read in chunk if source == 'sscs'])
+
+        for readPair in list(singleton_csn_pair.keys()):
+            for tag in singleton_csn_pair[readPair]:
+                stats.total_singletons += 1
+                duplex = duplex_tag(tag)
+                query_name = readPair + ':1'  # Reflect corrected singleton (uncorrected won't have our unique ID tag)
+
+                # 1) Singleton correction by complementary SSCS
+                if duplex in sscs_dict:
+                    records.add('sscs.correction', singleton_correction.strand_correction(
+                        tag, duplex, query_name, singleton_dict, sscs_dict=sscs_dict))
+                    stats.sscs_correction += 1
+                    del sscs_dict[duplex]
+                    del singleton_dict[tag]
+
+                # 2) Singleton correction by complementary singletons
+                elif duplex in singleton_dict:
+                    records.add('singleton.correction', singleton_correction.strand_correction(
+                        tag, duplex, query_name, singleton_dict))
+                    stats.singleton_correction += 1
+                    correction_dict[tag] = duplex
+
+                    if duplex in correction_dict:
+                        del singleton_dict[tag]
+                        del singleton_dict[duplex]
+                        del correction_dict[tag]
+                        del correction_dict[duplex]
+
+                # 3) Uncorrected if neither SSCS or singleton duplex correction was possible
+                else:
+                    records.add('uncorrected', singleton_dict[tag][0])
+                    stats.uncorrected += 1
+                    del singleton_dict[tag]
+
+            del singleton_csn_pair[readPair]
+
+        reads = [read for source, read in chunk]
+        yield from records.release(min(stream_watermark(singleton_pair, reads), stream_watermark(sscs_pair, reads)))
+
+    yield from records.release()
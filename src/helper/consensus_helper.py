@@ -30,15 +30,35 @@ from random import randint
 from argparse import ArgumentParser
 import os
 import inspect
+import heapq
+import itertools
+import bisect
+import sys
+import json
+import time
+import resource
+import zlib
+import shutil
+import tempfile
 
 
 ###############################
 #          Functions          #
 ###############################
+# Parsed bed files by (path, modification time), kept warm across jobs by consensus_worker.py
+BED_CACHE = {}
+
+
 def bed_separator(bedfile):
     """(str) -> dict
-    Return dictionary of coordinates based on bed file.
+    Return dictionary of coordinates based on bed file {'chr_name': (chr, start, end)}, where name is the fourth column
+    (e.g. chromosome arm). Chromosome is kept with coordinates as chromosome names may contain '_' (e.g.
+    chr1_KI270706v1_random).
     """
+    key = (os.path.abspath(bedfile), os.path.getmtime(bedfile))
+    if key in BED_CACHE:
+        return collections.OrderedDict(BED_CACHE[key])
+
     coor = collections.OrderedDict()
 
     with open(bedfile) as f:
@@ -47,11 +67,411 @@ def bed_separator(bedfile):
             chr_key = '{}_{}'.format(chr_arm[0], chr_arm[3])
             start = int(chr_arm[1])
             end = int(chr_arm[2])
-            chr_val = (start, end)
+            chr_val = (chr_arm[0], start, end)
 
             coor[chr_key] = chr_val
 
-    return coor
+    BED_CACHE[key] = coor
+    return collections.OrderedDict(coor)
+
+
+class TargetIndex(object):
+    """Merged and padded target intervals (e.g. hybrid capture panel BED file) indexed by reference id.
+
+    Intervals overlapping or touching after padding are merged, and lookups use binary search on interval starts.
+    Chromosomes not found in the BAM header are skipped.
+    """
+    def __init__(self, bedfile, header, padding=0):
+        intervals = collections.defaultdict(list)
+        with open(bedfile) as f:
+            for line in f:
+                if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                    continue
+                chr_name, start, end = line.rstrip('\n').split('\t')[:3]
+                tid = header.get_tid(chr_name)
+                if tid < 0:
+                    continue
+                intervals[tid].append((max(int(start) - padding, 0),
+                                       min(int(end) + padding, header.get_reference_length(chr_name))))
+
+        self.header = header
+        self.intervals = collections.OrderedDict()
+        for tid in sorted(intervals):
+            merged = []
+            for start, end in sorted(intervals[tid]):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.intervals[tid] = [tuple(interval) for interval in merged]
+        self.starts = {tid: [start for start, end in merged] for tid, merged in self.intervals.items()}
+
+    def contains(self, tid, pos):
+        """Return True if 0-based position on reference id falls within a target interval."""
+        i = bisect.bisect_right(self.starts.get(tid, []), pos) - 1
+        return i >= 0 and pos < self.intervals[tid][i][1]
+
+    def regions(self, offtarget=False):
+        """Return dictionary of regions to fetch in genome order, in the same format as bed_separator
+        {'chr_start-end': (chr, start, end)}.
+
+        Off-target regions (gaps between targets and chromosomes without targets) are included if offtarget is True.
+        """
+        coor = collections.OrderedDict()
+        for tid in range(self.header.nreferences):
+            chr_name = self.header.get_reference_name(tid)
+            last_end = 0
+            for start, end in self.intervals.get(tid, []):
+                if offtarget and start > last_end:
+                    coor['{}_{}-{}'.format(chr_name, last_end, start)] = (chr_name, last_end, start)
+                coor['{}_{}-{}'.format(chr_name, start, end)] = (chr_name, start, end)
+                last_end = end
+
+            chr_length = self.header.get_reference_length(chr_name)
+            if offtarget and last_end < chr_length:
+                coor['{}_{}-{}'.format(chr_name, last_end, chr_length)] = (chr_name, last_end, chr_length)
+
+        return coor
+
+
+class TargetSplitWriter(object):
+    """Route reads to on-target BAM file or off-target BAM file ("<filename>.offtarget.bam").
+
+    Read pairs are kept together: a read is on-target if either the read or its mate starts within a target interval.
+    """
+    def __init__(self, bam, filename, template, targets):
+        self.bam = bam
+        self.offtarget_bam = pysam.AlignmentFile('{}.offtarget.bam'.format(filename.rsplit('.bam', 1)[0]), "wb",
+                                                 template=template)
+        self.targets = targets
+
+    def write(self, read):
+        if self.targets.contains(read.reference_id, read.reference_start) or \
+                self.targets.contains(read.next_reference_id, read.next_reference_start):
+            self.bam.write(read)
+        else:
+            self.offtarget_bam.write(read)
+
+    def close(self):
+        self.bam.close()
+        self.offtarget_bam.close()
+
+
+class RegionMetrics(object):
+    """Per-region metrics of a consensus making stage, appended as JSON lines to a per-sample file ("metrics.jsonl").
+
+    Each region record holds read counters, wall/CPU time split into phases and peak dictionary sizes:
+    - decode: reading BAM records (time spent in the fetch iterator, see reads())
+    - group: filtering reads and grouping them into families (read_bam), excluding decode and write
+    - consensus: consensus making, excluding write
+    - write: writing BAM records (see timed())
+    A stage summary record (totals, throughput and slowest regions) is written on close().
+
+    Time is charged to the active phase (see switch), nested phases (e.g. decode within group) pause the enclosing
+    phase. The active phase is also the profiling scope of profiler (see profiler.py) if provided.
+
+    Reads and writes are too short to switch phases on each of them without slowing down the stage, so unless
+    profiling, reads are decoded in batches (see reads()) and writes are timed with the wall clock only, which is
+    moved from the enclosing phase to write on the next switch (see TimedWriter). It is also charged as CPU time
+    (process_time is much slower, and writing BAM records is compression bound).
+    """
+    PHASES = ('decode', 'group', 'consensus', 'write')
+    BATCH = 64
+
+    def __init__(self, stage, filename, mode='a', profiler=None):
+        self.stage = stage
+        self.profiler = profiler
+        self.file = open(filename, mode)
+        self.regions = []
+        self.totals = collections.Counter()
+        self.last_totals = collections.Counter()
+        self.phase_totals = {'wall': dict.fromkeys(self.PHASES, 0.0), 'cpu': dict.fromkeys(self.PHASES, 0.0)}
+        self.peaks = {}
+        self.start_wall, self.start_cpu = time.perf_counter(), time.process_time()
+        self._phase = None
+        self.write_time = 0.0  # wall time of writes within the active phase, not charged yet (see TimedWriter)
+        self._reset()
+
+    def _reset(self):
+        self.counts = collections.Counter(fetched=0, bad_reads=0)
+        self.wall = dict.fromkeys(self.PHASES, 0.0)
+        self.cpu = dict.fromkeys(self.PHASES, 0.0)
+        self.region_peaks = {}
+        self.region_wall, self.region_cpu = time.perf_counter(), time.process_time()
+        self._wall, self._cpu = self.region_wall, self.region_cpu
+
+    def switch(self, phase):
+        """Charge time since last switch to active phase, activate phase (None to stop charging time) and return
+        previously active phase.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        if self._phase is not None:
+            self.wall[self._phase] += wall - self._wall - self.write_time
+            self.cpu[self._phase] += cpu - self._cpu - self.write_time
+        self._charge_writes()
+        self._wall, self._cpu = wall, cpu
+        previous, self._phase = self._phase, phase
+        if self.profiler is not None:
+            self.profiler.scope = phase or 'other'
+        return previous
+
+    def _charge_writes(self):
+        self.wall['write'] += self.write_time
+        self.cpu['write'] += self.write_time
+        self.write_time = 0.0
+
+    def reads(self, reads, counter='fetched', batch=BATCH):
+        """Yield items from iterable (e.g. bamfile.fetch or stream_chunks), charging iteration to decode and counting
+        items with counter (None to skip counting). Items are decoded in batches of batch items (1 for chunks).
+        """
+        iterator = iter(reads)
+        while True:
+            previous = self.switch('decode')
+            items = list(itertools.islice(iterator, batch))
+            self.switch(previous)
+            if not items:
+                return
+            if counter is not None:
+                self.counts[counter] += len(items)
+            yield from items
+
+    def timed(self, bam):
+        """Return BAM writer charging writes to write phase."""
+        return TimedWriter(bam, self)
+
+    def count(self, name, value=1):
+        self.counts[name] += value
+
+    def peak(self, **sizes):
+        """Record peak sizes (e.g. read_dict=len(read_dict)) for region and stage."""
+        for name, size in sizes.items():
+            self.region_peaks[name] = max(self.region_peaks.get(name, 0), size)
+            self.peaks[name] = max(self.peaks.get(name, 0), size)
+
+    def finish(self, region, **totals):
+        """Write record for region. Totals are cumulative stage counters (e.g. singletons=singletons), region values
+        are the differences from the previous call.
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        self._charge_writes()  # writes outside of phases
+        for name, total in totals.items():
+            self.counts[name] += total - self.last_totals[name]
+            self.last_totals[name] = total
+        self.totals.update(self.counts)
+        for phase in self.PHASES:
+            self.phase_totals['wall'][phase] += self.wall[phase]
+            self.phase_totals['cpu'][phase] += max(self.cpu[phase], 0.0)
+
+        record = collections.OrderedDict([('type', 'region'), ('stage', self.stage), ('region', str(region).strip())])
+        record.update(sorted(self.counts.items()))
+        record['wall'] = dict(self.wall, total=wall - self.region_wall)
+        # Write CPU time (charged as wall clock time, see TimedWriter) may exceed CPU time of the enclosing phase
+        record['cpu'] = dict({phase: max(value, 0.0) for phase, value in self.cpu.items()}, total=cpu - self.region_cpu)
+        record['peak'] = dict(self.region_peaks, rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        self.file.write(json.dumps(record) + '\n')
+        self.regions.append((record['wall']['total'], record['region']))
+        self._reset()
+
+    def close(self, slowest=10):
+        """Write stage summary record and close file."""
+        wall = time.perf_counter() - self.start_wall
+        record = collections.OrderedDict([('type', 'summary'), ('stage', self.stage), ('regions', len(self.regions))])
+        record.update(sorted(self.totals.items()))
+        record['wall'] = dict(self.phase_totals['wall'], total=wall)
+        record['cpu'] = dict(self.phase_totals['cpu'], total=time.process_time() - self.start_cpu)
+        record['peak'] = dict(self.peaks, rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        record['reads_per_second'] = self.totals['fetched'] / wall if wall > 0 else 0
+        record['slowest_regions'] = [{'region': region, 'wall': region_wall} for region_wall, region in
+                                     sorted(self.regions, reverse=True)[:slowest]]
+        self.file.write(json.dumps(record) + '\n')
+        self.file.close()
+
+
+class TimedWriter(object):
+    """BAM writer wrapper charging writes and flushes of buffered writers to the write phase of RegionMetrics."""
+    def __init__(self, bam, metrics):
+        self.bam = bam
+        self.metrics = metrics
+
+    def write(self, read):
+        if self.metrics.profiler is not None:
+            previous = self.metrics.switch('write')
+            self.bam.write(read)
+            self.metrics.switch(previous)
+        else:
+            start = time.perf_counter()
+            self.bam.write(read)
+            self.metrics.write_time += time.perf_counter() - start
+
+    def flush(self, *args):
+        previous = self.metrics.switch('write')
+        buffered = self.bam.flush(*args)
+        self.metrics.switch(previous)
+        return buffered
+
+    def close(self):
+        self.bam.close()
+
+
+def stream_chunks(bamfile, chunk_size=10000):
+    """(pysam.AlignmentFile, int) -> generator
+    Yield lists of reads from a coordinate-sorted bamfile read sequentially (no index required, e.g. stdin).
+
+    Chunks are only broken where the read start coordinate changes. All reads of a family share the same start and
+    their pairs are completed at the same mate coordinate, so every consensus pair completed within a chunk has all of
+    its family members within that chunk (sweep-based family completion).
+    """
+    return chunk_reads(bamfile.fetch(until_eof=True), chunk_size)
+
+
+def chunk_reads(reads, chunk_size=10000, key=None):
+    """(iterable, int, function) -> generator
+    Yield lists of coordinate-sorted reads, broken where the read start coordinate changes (see stream_chunks).
+
+    key returns the read of each item (e.g. labelled reads), items are reads if key is None.
+    """
+    chunk = []
+    last_coor = None
+
+    for item in reads:
+        line = item if key is None else key(item)
+        coor = read_coordinate(line)
+        if last_coor is not None and coor < last_coor:
+            raise ValueError("Streaming requires coordinate-sorted reads (read {} out of order)".format(
+                line.query_name))
+
+        if len(chunk) >= chunk_size and coor != last_coor:
+            yield chunk
+            chunk = []
+
+        chunk.append(item)
+        last_coor = coor
+
+    if chunk:
+        yield chunk
+
+
+def read_coordinate(read):
+    """(pysam.calignedsegment.AlignedSegment) -> tuple
+    Return sort key (reference id, start) of read in coordinate order, with unplaced reads (reference id -1) last.
+    """
+    if read.reference_id < 0:
+        return sys.maxsize, read.reference_start
+
+    return read.reference_id, read.reference_start
+
+
+# Distance (bp) behind the last streamed read beyond which pending reads no longer hold back the streaming watermark
+STREAM_MAX_DISTANCE = 10000
+
+
+def stream_watermark(pair_dict, chunk, max_distance=None):
+    """(dict, list, int) -> tuple
+    Return lowest coordinate at which a consensus read can still be created after processing a streamed chunk.
+
+    Pending reads in pair_dict are stored in order of insertion (i.e. coordinate order for sorted input), so the first
+    entry holds the lowest coordinate still awaiting its mate. Otherwise, reads can only come from the next chunk.
+
+    With max_distance, pending reads more than max_distance behind the last read of the chunk (e.g. mates on another
+    reference) don't hold back the watermark, their consensus reads are spilled by SortedBamWriter.
+
+    >>> class Read(object):
+    ...     def __init__(self, reference_id, reference_start):
+    ...         self.reference_id, self.reference_start = reference_id, reference_start
+    >>> pair_dict = {'translocated': [Read(0, 100)], 'pending': [Read(1, 40000)]}
+    >>> stream_watermark(pair_dict, [Read(1, 50000)])
+    (0, 100)
+    >>> stream_watermark(pair_dict, [Read(1, 50000)], max_distance=STREAM_MAX_DISTANCE)
+    (1, 40000)
+    """
+    ref, start = read_coordinate(chunk[-1])
+    watermark = (ref, start + 1)
+
+    for reads in pair_dict.values():
+        watermark = min(watermark, read_coordinate(reads[0]))
+        break
+
+    if max_distance is not None:
+        watermark = min((ref, start + 1), max(watermark, (ref, start - max_distance)))
+
+    return watermark
+
+
+class SortedBamWriter(object):
+    """Write consensus reads to a BAM file in coordinate order.
+
+    Consensus reads are created out of order as families are completed at the coordinate of their last mate. Reads are
+    buffered in a heap and only released once they fall below the streaming watermark (see stream_watermark).
+
+    With a spill directory (and template for the header of temporary BAM files), released reads are written to a
+    temporary BAM file, and reads created below an already released watermark (see stream_watermark max_distance) are
+    sorted in runs of run_size reads written to the directory. Both are merged into bamfile on close, so the heap stays
+    bounded when pending reads are left behind the watermark.
+    """
+    def __init__(self, bamfile, template=None, directory=None, run_size=100000):
+        self.bamfile = bamfile
+        self.heap = []
+        self.counter = 0  # Tie-breaker to keep write order for reads sharing the same coordinate
+        self.header = None
+        self.directory = None
+        self.released = None  # watermark of last flush
+        self.late = []  # reads created below released watermark
+        self.runs = []
+        self.run_size = run_size
+        self.part = None
+
+        if template is not None:
+            self.header = template.header  # template may be closed before close()
+            self.directory = tempfile.mkdtemp(prefix='sorted_bam_', dir=directory)
+            self.part = pysam.AlignmentFile(os.path.join(self.directory, 'part.bam'), "wbu", header=self.header)
+
+    def write(self, read):
+        coordinate = read_coordinate(read)
+        if self.part is not None and self.released is not None and coordinate < self.released:
+            self.late.append(read)
+            if len(self.late) >= self.run_size:
+                self._write_run()
+        else:
+            heapq.heappush(self.heap, (coordinate, self.counter, read))
+            self.counter += 1
+
+    def _write_run(self):
+        # Stable sort keeps write order of reads sharing the same coordinate
+        filename = os.path.join(self.directory, 'late{}.bam'.format(len(self.runs)))
+        with pysam.AlignmentFile(filename, "wbu", header=self.header) as run:
+            for read in sorted(self.late, key=read_coordinate):
+                run.write(read)
+        self.runs.append(filename)
+        self.late = []
+
+    def flush(self, watermark=None):
+        """Write buffered reads positioned before watermark (all reads if watermark is None), and return number of
+        reads buffered before flushing.
+        """
+        buffered = len(self.heap)
+        output = self.part if self.part is not None else self.bamfile
+        while self.heap and (watermark is None or self.heap[0][0] < watermark):
+            output.write(heapq.heappop(self.heap)[2])
+        if watermark is not None and (self.released is None or watermark > self.released):
+            self.released = watermark
+
+        return buffered
+
+    def close(self):
+        self.flush()
+        if self.part is not None:
+            # Released reads precede late reads of the same coordinate (late reads are created after their release)
+            self.part.close()
+            if self.late:
+                self._write_run()
+            bams = [pysam.AlignmentFile(filename, "rb", check_sq=False) for filename in
+                    [os.path.join(self.directory, 'part.bam')] + self.runs]
+            for read in heapq.merge(*[bam.fetch(until_eof=True) for bam in bams], key=read_coordinate):
+                self.bamfile.write(read)
+            for bam in bams:
+                bam.close()
+            shutil.rmtree(self.directory)
+        self.bamfile.close()
 
 
 def which_read(flag):
@@ -307,9 +727,152 @@ def unique_tag(read, barcode, cigar):
     return tag
 
 
+def umi_neighbours(barcodes):
+    """(list) -> dict
+    Return dictionary of barcodes within Hamming distance 1 of each barcode (barcodes of the same length).
+
+    Barcodes are indexed by their deletion neighbourhood (barcode with one position removed, keyed with the position),
+    so barcodes differing at a single position share a key and only barcodes sharing a key are compared. This avoids
+    comparing all pairs of barcodes at a coordinate.
+
+    >>> neighbours = umi_neighbours(['AAAA', 'AAAT', 'AATT', 'CCCC'])
+    >>> neighbours['AAAT']
+    ['AAAA', 'AATT']
+    >>> neighbours['CCCC']
+    []
+    """
+    deletion_index = collections.defaultdict(list)
+    for barcode in barcodes:
+        for i in range(len(barcode)):
+            deletion_index[(i, barcode[:i] + barcode[i + 1:])].append(barcode)
+
+    neighbours = {barcode: [] for barcode in barcodes}
+    for group in deletion_index.values():
+        for barcode in group:
+            neighbours[barcode].extend(other for other in group if other != barcode)
+
+    return {barcode: sorted(set(others)) for barcode, others in neighbours.items()}
+
+
+def directional_clusters(counts):
+    """(dict) -> dict
+    Return dictionary assigning each barcode to the barcode of its cluster (directional method, Smith et al. 2017).
+
+    A barcode absorbs a neighbour within Hamming distance 1 if its count >= 2 * neighbour count - 1, so sequencing
+    errors (rare variants of an abundant barcode) are merged while two abundant barcodes stay separate. Barcodes are
+    visited from most to least abundant (ties broken alphabetically) and clusters are grown through absorbed barcodes.
+
+    >>> sorted(directional_clusters({'AAAA': 10, 'AAAT': 2, 'AATT': 1, 'CCCC': 1}).items())
+    [('AAAA', 'AAAA'), ('AAAT', 'AAAA'), ('AATT', 'AAAA'), ('CCCC', 'CCCC')]
+    >>> directional_clusters({'AAAA': 3, 'AAAT': 3})
+    {'AAAA': 'AAAA', 'AAAT': 'AAAT'}
+    """
+    neighbours = umi_neighbours(list(counts))
+    cluster = {}
+
+    for root in sorted(counts, key=lambda barcode: (-counts[barcode], barcode)):
+        if root in cluster:
+            continue
+        cluster[root] = root
+        queue = [root]
+        while queue:
+            barcode = queue.pop()
+            for other in neighbours[barcode]:
+                if other not in cluster and counts[barcode] >= 2 * counts[other] - 1:
+                    cluster[other] = root
+                    queue.append(other)
+
+    return cluster
+
+
+def cluster_umis(consensus_tags, read_dict, tag_dict, csn_pair_dict):
+    """(list, dict, dict, dict) -> int
+    Merge read families of paired consensus tags whose barcodes cluster together at the same coordinates, cigar and
+    strand (see directional_clusters), and return number of consensus tags merged into another.
+
+    Reads of absorbed families are appended to the matching unique tag (same read number/orientation) of the cluster's
+    most abundant barcode, and absorbed tags are removed from read_dict, tag_dict and csn_pair_dict.
+    """
+    # Group consensus tags by everything but the barcode: [Read Chr]_[Read Start]_[Mate Chr]_[Mate Start]_[Cigar]_[Strand]
+    positions = collections.defaultdict(dict)
+    for consensus_tag in consensus_tags:
+        if consensus_tag in csn_pair_dict and len(csn_pair_dict[consensus_tag]) == 2:
+            barcode, position = consensus_tag.split('_', 1)
+            positions[position][barcode] = tag_dict[csn_pair_dict[consensus_tag][0]]
+
+    merged = 0
+    for position, counts in positions.items():
+        if len(counts) == 1:
+            continue
+
+        for barcode, root in directional_clusters(counts).items():
+            if barcode == root:
+                continue
+            root_tags = {tag.split('_', 1)[1]: tag for tag in csn_pair_dict['{}_{}'.format(root, position)]}
+
+            for tag in csn_pair_dict.pop('{}_{}'.format(barcode, position)):
+                root_tag = root_tags[tag.split('_', 1)[1]]
+                read_dict[root_tag].extend(read_dict.pop(tag))
+                tag_dict[root_tag] += tag_dict.pop(tag)
+            merged += 1
+
+    return merged
+
+
+class FamilySizes(object):
+    """Sizes of written read families, in place of keeping tag_dict entries of every family until the end of the run.
+
+    - histogram: number of tags of each family size (indexed by family size), grows to the largest family size
+    - Tags and sizes of families written in the current and previous region are kept (next_region() drops the older
+      region), for detecting reads read twice near region boundaries (see read_bam written_tags) and for sizes of
+      duplex families written before their complement
+    - With track_tags False, no tags are kept, for runs where no read is read twice (whole file, streamed chunks or
+      stored families), as the only region of a whole-file run would keep every family
+
+    >>> sizes = FamilySizes()
+    >>> sizes.add('A', 3); sizes.add('B', 1); sizes.add('C', 3)
+    >>> sizes.items()
+    [(1, 1), (3, 2)]
+    >>> sizes.next_region(); sizes.next_region()
+    >>> 'A' in sizes, sizes.get('A', 0)
+    (False, 0)
+    >>> sizes = FamilySizes(track_tags=False)
+    >>> sizes.add('A', 3)
+    >>> 'A' in sizes, sizes.items()
+    (False, [(3, 1)])
+    """
+    def __init__(self, histogram=(), previous=None, track_tags=True):
+        self.histogram = array.array('q', histogram)
+        self.track_tags = track_tags
+        self.current = {}
+        self.previous = dict(previous or {})
+
+    def add(self, tag, size):
+        if size >= len(self.histogram):
+            self.histogram.extend([0] * (size + 1 - len(self.histogram)))
+        self.histogram[size] += 1
+        if self.track_tags:
+            self.current[tag] = size
+
+    def __contains__(self, tag):
+        return tag in self.current or tag in self.previous
+
+    def get(self, tag, default=None):
+        return self.current.get(tag, self.previous.get(tag, default))
+
+    def next_region(self):
+        self.previous = self.current
+        self.current = {}
+
+    def items(self):
+        """Return (family size, frequency) pairs of family sizes with at least one tag, by family size."""
+        return [(size, frequency) for size, frequency in enumerate(self.histogram) if frequency]
+
+
 def read_bam(bamfile, pair_dict, read_dict, csn_pair_dict, tag_dict, badRead_bam, duplex,
-             read_chr=None, read_start=None, read_end=None):
-    """(bamfile, dict, dict, dict, dict, bamfile, bool, str, int, int) ->
+             read_chr=None, read_start=None, read_end=None, bam_lines=None, barcode_tag=None, umi_cluster=False,
+             metrics=None, written_tags=()):
+    """(bamfile, dict, dict, dict, dict, bamfile, bool, str, int, int, list, str, bool, RegionMetrics, FamilySizes) ->
     dict, dict, dict, dict, int, int, int
 
     === Input ===
@@ -332,6 +895,22 @@ def read_bam(bamfile, pair_dict, read_dict, csn_pair_dict, tag_dict, badRead_bam
     - read_start (int): starting position to fetch reads
     - read_end (int): stopping position to fetch reads
 
+    # For index-free streaming of coordinate-sorted bamfiles
+    - bam_lines (list): reads to process instead of fetching from bamfile (see stream_chunks)
+
+    # For uncollapsed reads with barcodes stored in a tag (extract_barcodes.py --format tag/ubam)
+    - barcode_tag (str): tag containing molecular barcode (e.g. RX) instead of read name
+
+    # For error-tolerant grouping of uncollapsed reads
+    - umi_cluster (bool): merge families of read pairs completed in this call whose barcodes are within Hamming
+                          distance 1 at the same coordinates (see cluster_umis)
+
+    # For performance metrics
+    - metrics (RegionMetrics): charge fetching reads to decode phase and count fetched and bad reads
+
+    # For callers removing written families from tag_dict
+    - written_tags (FamilySizes): tags of recently written families, reads of these tags are not grouped again
+
     # For duplex consensus making
     - duplex: any string or bool [that is not None] specifying duplex consensus making [e.g. TRUE], necessary for
               parsing barcode as query name for Uncollapsed and SSCS differ
@@ -363,16 +942,22 @@ def read_bam(bamfile, pair_dict, read_dict, csn_pair_dict, tag_dict, badRead_bam
                          - supplementary reads: multiple parts of sequence align to multiple locations
     """
     # Fetch data given genome coordinates
-    if read_chr is None:
+    if bam_lines is not None:
+        bamLines = bam_lines
+    elif read_chr is None:
         bamLines = bamfile.fetch(until_eof=True)
     else:
         bamLines = bamfile.fetch(read_chr, read_start, read_end)
 
+    if metrics is not None:
+        bamLines = metrics.reads(bamLines)
+
     # Initialize counters
     unmapped = 0
     unmapped_mate = 0
     multiple_mapping = 0  # secondary/supplementary reads
     counter = 0
+    completed = []  # consensus tags of read pairs completed in this call (for UMI clustering)
 
     for line in bamLines:
         # Parse out reads that don't fall within region
@@ -405,6 +990,8 @@ def read_bam(bamfile, pair_dict, read_dict, csn_pair_dict, tag_dict, badRead_bam
 
         # Write bad reads to file
         if badRead:
+            if metrics is not None:
+                metrics.count('bad_reads')
             if badRead_bam is not None:
                 badRead_bam.write(line)
         else:
@@ -419,7 +1006,10 @@ def read_bam(bamfile, pair_dict, read_dict, csn_pair_dict, tag_dict, badRead_bam
                 mate = pair_dict[line.qname][1]
                 # === Create consensus identifier ===
                 # Extract molecular barcode, barcodes in diff position for SSCS vs DCS generation
-                if duplex == None or duplex == False:
+                if (duplex == None or duplex == False) and barcode_tag is not None:
+                    # SSCS barcode tag: RX:Z:CACT
+                    barcode = read.get_tag(barcode_tag)
+                elif duplex == None or duplex == False:
                     # SSCS query name: H1080:278:C8RE3ACXX:6:1308:18882:18072|CACT
                     barcode = read.qname.split("|")[1]
                 else:
@@ -440,7 +1030,7 @@ def read_bam(bamfile, pair_dict, read_dict, csn_pair_dict, tag_dict, badRead_bam
                     #   Assign to Dict   #
                     ######################
                     # === 3) ADD READ PAIRS TO DICTIONARIES ===
-                    if tag not in read_dict and tag not in tag_dict:
+                    if tag not in read_dict and tag not in tag_dict and tag not in written_tags:
                         read_dict[tag] = [read_i]
                         tag_dict[tag] += 1
 
@@ -461,21 +1051,62 @@ def read_bam(bamfile, pair_dict, read_dict, csn_pair_dict, tag_dict, badRead_bam
                             # Manual inspection should be done on these reads,
                         else:
                             csn_pair_dict[consensus_tag].append(tag)
+                            completed.append(consensus_tag)
                     elif tag in tag_dict and read not in read_dict[tag]:
                         # Append reads sharing the same unique tag together (PCR dupes)
                         read_dict[tag].append(read_i)
                         tag_dict[tag] += 1
                     else:
-                        # Data fetch error - line read twice (if its found in tag_dict and read_dict)
+                        # Data fetch error - line read twice (if its found in tag_dict and read_dict, or written)
                         print('Pair already written: line read twice - check to see if read overlapping / near cytoband'
                               ' region (point of data division)')
 
                 # remove read pair qname from pair_dict once reads added to read_dict
                 pair_dict.pop(line.qname)
 
+    # Families sharing coordinates are completed by the same mate coordinate, so all candidates for merging are found
+    # among the read pairs completed here (also with regions and streamed chunks)
+    if umi_cluster and (duplex == None or duplex == False):
+        cluster_umis(completed, read_dict, tag_dict, csn_pair_dict)
+
     return read_dict, tag_dict, pair_dict, csn_pair_dict, counter, unmapped_mate, multiple_mapping
 
 
+# Seed for deterministic tie-breaking (see set_tie_seed), ties are broken randomly if None
+TIE_SEED = None
+
+
+def set_tie_seed(seed):
+    """(int) -> None
+    Set seed for deterministic tie-breaking in read_mode and consensus_flag (None for random tie-breaking).
+    """
+    global TIE_SEED
+    TIE_SEED = seed
+
+
+def break_tie(candidates, bam_reads):
+    """(list, list) -> object
+    Return one of tied candidates for a consensus field of reads from the same family.
+
+    Choice is random, unless a seed is set (set_tie_seed). The seeded choice only depends on the seed, candidates and
+    query names of reads (not on their order or the order families are processed in), so outputs are reproducible and
+    can be compared record by record between implementations (see compare_bams.py).
+
+    >>> Read = collections.namedtuple('Read', 'query_name')
+    >>> reads = [Read('H1080:278:C8RE3ACXX:6:1308:18882:18072|CACT'), Read('H1080:278:C8RE3ACXX:6:1101:1332:2193|CACT')]
+    >>> set_tie_seed(1)
+    >>> break_tie([20, 60], reads) == break_tie([60, 20], reads[::-1])
+    True
+    >>> set_tie_seed(None)
+    """
+    if TIE_SEED is None:
+        return candidates[randint(0, len(candidates)-1)]
+
+    candidates = sorted(candidates, key=repr)
+    key = '{}:{}:{}'.format(TIE_SEED, min(read.query_name for read in bam_reads), candidates)
+    return candidates[zlib.crc32(key.encode()) % len(candidates)]
+
+
 def read_mode(field, bam_reads):
     """(str, lst) -> str
     Return mode (most common occurrence) of a specified field
@@ -487,8 +1118,8 @@ def read_mode(field, bam_reads):
     field_lst = collections.Counter(eval(field) for i in bam_reads).most_common()
     # Take max occurrences
     common_field_lst = [i for i, j in field_lst if j == field_lst[0][1]]
-    # Randomly select max if there's multiple
-    common_field = common_field_lst[randint(0, len(common_field_lst)-1)]
+    # Randomly select max if there's multiple (seeded in deterministic mode)
+    common_field = break_tie(common_field_lst, bam_reads)
 
     return common_field
 
@@ -524,7 +1155,7 @@ def consensus_flag(bam_reads):
         elif 163 in max_flag:
             flag = 163
         else:
-            flag = max_flag[randint(0, len(max_flag)-1)]  # If flag not properly paired/mapped, randomly select from max
+            flag = break_tie(max_flag, bam_reads)  # If flag not properly paired/mapped, randomly select from max
     else:
         flag = max_flag[0]
 
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                       Consensus Worker
+#
+###############################################################
+# Function:
+# To run SSCS_maker.py, DCS_maker.py and singleton_correction.py jobs in a long-running worker, instead of starting a
+# new Python process (importing pysam, matplotlib, numpy, etc. and parsing the cytoband bed file) for every stage of
+# every sample.
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Jobs are JSON files ({"script": ..., "args": [...], "cwd": ...}) submitted to a job directory:
+#       pending/   submitted jobs, claimed by renaming into running/ (several workers can share a job directory)
+#       running/   jobs being run
+#       done/      finished jobs with exit status ("status": 0) and log file ("log")
+#       failed/    finished jobs with non-zero exit status
+#       logs/      stdout and stderr of each job
+#   - The worker imports the consensus scripts once and parses bed files given with --bedfile (cached by path and
+#     modification time in consensus_helper.bed_separator). Each job runs main() of its script in a process forked
+#     from the worker, so imports and bed files are already loaded, while state (e.g. matplotlib figures, tie-breaking
+#     seed) isn't shared between jobs
+#   - Jobs run with the same arguments as the command line scripts and write the same outputs
+#   - The worker stops after running jobs finish when a "stop" file is created in the job directory
+#
+# Usage:
+# Start worker:
+#   python3 consensus_worker.py --jobdir JOBDIR [--processes PROCESSES] [--bedfile BEDFILE [BEDFILE ...]]
+#                               [--poll POLL]
+# Submit job (arguments after the script name are passed to the script):
+#   python3 consensus_worker.py --jobdir JOBDIR [--wait] --submit SCRIPT [ARGS ...]
+#   e.g. python3 consensus_worker.py --jobdir JOBDIR --wait --submit SSCS_maker.py --cutoff 0.7 --infile ...
+#
+# Arguments:
+# --jobdir JOBDIR         Job directory
+# --processes PROCESSES   Number of jobs run at the same time [1]
+# --bedfile BEDFILE       Bed files loaded when the worker starts (e.g. cytoBand.txt)
+# --poll POLL             Seconds between checks for new jobs [0.5]
+# --submit SCRIPT ARGS    Submit job (SSCS_maker.py, DCS_maker.py or singleton_correction.py and its arguments)
+# --wait                  Wait for submitted job to finish, print its log and exit with its exit status
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser, REMAINDER
+import multiprocessing
+import traceback
+import uuid
+import json
+import time
+import sys
+import os
+
+import consensus_helper
+import SSCS_maker
+import DCS_maker
+import singleton_correction
+
+SCRIPTS = {'SSCS_maker': SSCS_maker, 'DCS_maker': DCS_maker, 'singleton_correction': singleton_correction}
+JOB_DIRS = ['pending', 'running', 'done', 'failed', 'logs']
+
+
+###############################
+#          Functions          #
+###############################
+def script_name(script):
+    """(str) -> str
+    Return name of consensus script from script name or path.
+
+    >>> script_name('/path/to/SSCS_maker.py')
+    'SSCS_maker'
+    >>> script_name('singleton_correction')
+    'singleton_correction'
+    """
+    name = os.path.basename(script)
+    return name[:-len('.py')] if name.endswith('.py') else name
+
+
+def write_json(filename, data):
+    """Write JSON file atomically (written to temporary file and renamed), so it's never read half written."""
+    tmp = '{}.tmp'.format(filename)
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, filename)
+
+
+def submit(jobdir, script, args, cwd=None):
+    """(str, str, list, str) -> str
+    Submit job to job directory and return job ID.
+    """
+    name = script_name(script)
+    if name not in SCRIPTS:
+        raise ValueError("Unknown script {}, choose from {}".format(script, ', '.join(sorted(SCRIPTS))))
+
+    for subdir in JOB_DIRS:
+        os.makedirs(os.path.join(jobdir, subdir), exist_ok=True)
+    job_id = '{}_{}_{}'.format(int(time.time() * 1000), name, uuid.uuid4().hex[:8])
+    write_json(os.path.join(jobdir, 'pending', job_id + '.json'),
+               {'script': name, 'args': args, 'cwd': os.path.abspath(cwd or os.getcwd())})
+
+    return job_id
+
+
+def wait(jobdir, job_id, poll=0.5):
+    """(str, str, float) -> dict
+    Wait for job to finish and return job (with exit status and log file).
+    """
+    while True:
+        for state in ['done', 'failed']:
+            filename = os.path.join(jobdir, state, job_id + '.json')
+            if os.path.exists(filename):
+                with open(filename) as f:
+                    return json.load(f)
+        time.sleep(poll)
+
+
+def run_job(job, log):
+    """(dict, str) -> int
+    Run main() of consensus script with job arguments (as sys.argv) and return exit status. stdout and stderr (including
+    output of pysam/htslib) are written to log file.
+    """
+    with open(log, 'w') as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+    sys.stdout = os.fdopen(1, 'w', buffering=1)
+    sys.stderr = os.fdopen(2, 'w', buffering=1)
+
+    status = 0
+    try:
+        os.chdir(job['cwd'])
+        sys.argv = [job['script'] + '.py'] + job['args']
+        start_time = time.time()
+        SCRIPTS[job['script']].main()
+        print((time.time() - start_time)/60)
+    except SystemExit as e:
+        # argparse errors and sys.exit() in scripts
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    return status
+
+
+def finish_job(jobdir, job_id, job, log, status):
+    """Move job from running/ to done/ or failed/ with exit status and log file."""
+    job.update({'status': status, 'log': log})
+    write_json(os.path.join(jobdir, 'done' if status == 0 else 'failed', job_id + '.json'), job)
+    os.remove(os.path.join(jobdir, 'running', job_id + '.json'))
+
+
+def claim_jobs(jobdir):
+    """(str) -> list
+    Claim pending jobs (oldest first) by moving them to running/, and return list of (job ID, job).
+    """
+    claimed = []
+    for filename in sorted(os.listdir(os.path.join(jobdir, 'pending'))):
+        if not filename.endswith('.json'):
+            continue
+        job_id = filename[:-len('.json')]
+        running = os.path.join(jobdir, 'running', filename)
+        try:
+            os.rename(os.path.join(jobdir, 'pending', filename), running)
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+        with open(running) as f:
+            claimed.append((job_id, json.load(f)))
+
+    return claimed
+
+
+def serve(jobdir, processes=1, bedfiles=(), poll=0.5):
+    """Run jobs submitted to job directory until a "stop" file is created in it."""
+    for subdir in JOB_DIRS:
+        os.makedirs(os.path.join(jobdir, subdir), exist_ok=True)
+    for bedfile in bedfiles:
+        consensus_helper.bed_separator(bedfile)
+
+    # New process forked from worker for each job (imports and bed files loaded, no state shared between jobs)
+    pool = multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=1)
+    running = {}
+    try:
+        while not os.path.exists(os.path.join(jobdir, 'stop')):
+            for job_id, job in claim_jobs(jobdir):
+                log = os.path.abspath(os.path.join(jobdir, 'logs', job_id + '.log'))
+                if job.get('script') not in SCRIPTS:
+                    with open(log, 'w') as f:
+                        f.write('Unknown script {}\n'.format(job.get('script')))
+                    finish_job(jobdir, job_id, job, log, 1)
+                    continue
+                running[job_id] = (job, log, pool.apply_async(run_job, (job, log)))
+                print('Started {}'.format(job_id))
+
+            for job_id, (job, log, result) in list(running.items()):
+                if result.ready():
+                    try:
+                        status = result.get()
+                    except Exception:
+                        # Job process died (e.g. killed by out of memory)
+                        status = 1
+                    finish_job(jobdir, job_id, job, log, status)
+                    del running[job_id]
+                    print('Finished {} ({})'.format(job_id, status))
+
+            time.sleep(poll)
+    finally:
+        pool.close()
+        pool.join()
+        for job_id, (job, log, result) in running.items():
+            finish_job(jobdir, job_id, job, log, result.get() if result.successful() else 1)
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--jobdir", action="store", dest="jobdir", help="Job directory", required=True)
+    parser.add_argument("--processes", action="store", dest="processes", type=int, default=1,
+                        help="Number of jobs run at the same time [1]")
+    parser.add_argument("--bedfile", action="store", dest="bedfile", nargs='+', default=[],
+                        help="Bed files loaded when the worker starts (e.g. cytoBand.txt)")
+    parser.add_argument("--poll", action="store", dest="poll", type=float, default=0.5,
+                        help="Seconds between checks for new jobs [0.5]")
+    parser.add_argument("--wait", action="store_true", dest="wait",
+                        help="Wait for submitted job to finish, print its log and exit with its exit status")
+    parser.add_argument("--submit", action="store", dest="submit", nargs=REMAINDER,
+                        help="Submit job: script name followed by its arguments")
+    args = parser.parse_args()
+
+    if args.submit is None:
+        serve(args.jobdir, args.processes, args.bedfile, args.poll)
+        return
+
+    if not args.submit:
+        parser.error("--submit requires a script name")
+    try:
+        job_id = submit(args.jobdir, args.submit[0], args.submit[1:])
+    except ValueError as e:
+        parser.error(str(e))
+    print(job_id)
+
+    if args.wait:
+        job = wait(args.jobdir, job_id, args.poll)
+        with open(job['log']) as f:
+            sys.stdout.write(f.read())
+        sys.exit(job['status'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                       ConsensusCruncher
+#
+###############################################################
+# Function:
+# Single entry point for the ConsensusCruncher tools. Each subcommand only imports the module it runs, so e.g. DCS_maker
+# doesn't load numpy and no consensus step loads matplotlib (plots are made by the separate report step).
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 consensuscruncher.py SUBCOMMAND [ARGS ...]
+# python3 consensuscruncher.py SUBCOMMAND --help
+#
+# Subcommands (arguments are the same as the scripts):
+# extract_barcodes      extract_barcodes.py: extract molecular barcodes from FASTQs
+# sscs                  SSCS_maker.py: single-strand consensus sequences
+# dcs                   DCS_maker.py: duplex consensus sequences
+# singleton_correction  singleton_correction.py: correct singletons with complementary SSCS/singletons
+# report                report.py: tag family size plot
+# worker                consensus_worker.py: resident worker for sscs/dcs/singleton_correction jobs
+# compare_bams          compare_bams.py: compare BAM files regardless of record order
+# family_index          family_index.py: index BAM files by family key and look up families
+# incremental           incremental.py: add a new lane to a previous SSCS run
+# partition             partition.py: hash-partition a sample (scatter) and merge outputs of partitions (gather)
+#
+# Startup time of each subcommand (time to '--help') can be checked against its budget with
+# test/benchmark/startup_time.py.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser, RawDescriptionHelpFormatter, REMAINDER
+import collections
+import importlib
+import sys
+
+# Subcommand: (module, description)
+SUBCOMMANDS = collections.OrderedDict([
+    ('extract_barcodes', ('extract_barcodes', 'Extract molecular barcodes from FASTQs')),
+    ('sscs', ('SSCS_maker', 'Make single-strand consensus sequences (SSCS)')),
+    ('dcs', ('DCS_maker', 'Make duplex consensus sequences (DCS)')),
+    ('singleton_correction', ('singleton_correction', 'Correct singletons with complementary SSCS/singletons')),
+    ('report', ('report', 'Plot tag family size distribution')),
+    ('worker', ('consensus_worker', 'Resident worker for sscs/dcs/singleton_correction jobs')),
+    ('compare_bams', ('compare_bams', 'Compare BAM files regardless of record order')),
+    ('family_index', ('family_index', 'Index BAM files by family key and look up families')),
+    ('incremental', ('incremental', 'Add a new lane to a previous SSCS run')),
+    ('partition', ('partition', 'Hash-partition a sample and merge outputs of partitions'))
+])
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser(prog='consensuscruncher', formatter_class=RawDescriptionHelpFormatter,
+                            epilog='Subcommands:\n' + '\n'.join('  {:<22}{}'.format(name, description)
+                                                               for name, (module, description) in SUBCOMMANDS.items()))
+    parser.add_argument("subcommand", choices=list(SUBCOMMANDS), metavar='SUBCOMMAND',
+                        help="Subcommand to run (see below)")
+    parser.add_argument("args", nargs=REMAINDER, help="Arguments of subcommand ('SUBCOMMAND --help' for details)")
+    args = parser.parse_args()
+
+    # Only the module of the subcommand is imported
+    module = importlib.import_module(SUBCOMMANDS[args.subcommand][0])
+    sys.argv = ['consensuscruncher {}'.format(args.subcommand)] + args.args
+    module.main()
+
+
+if __name__ == "__main__":
+    main()
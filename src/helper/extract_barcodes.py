@@ -12,15 +12,28 @@
 #
 # USAGE:
 # python3 extract_barcodes.py [--read1 READ1] [--read2 READ2] [--outfile OUTFILE] [--blen BARCODELEN] [--slen SPACERLEN]
-#                            [--sfilt SPACERFILT]
+#                            [--sfilt SPACERFILT] [--threads THREADS] [--batch BATCH] [--compress]
+#                            [--format {header,tag,ubam}] [--profile]
 #
 # Arguments:
-# --read1 READ1       Input FASTQ file for Read 1 (unzipped)
-# --read2 READ2       Input FASTQ file for Read 2 (unzipped)
+# --read1 READ1       Input FASTQ file for Read 1 (unzipped or gzip/BGZF compressed)
+# --read2 READ2       Input FASTQ file for Read 2 (unzipped or gzip/BGZF compressed)
 # --outfile OUTFILE   Output FASTQ files for Read 1 and Read 2 using given filename
 # --blen BARCODELEN   Barcode length
 # --slen SPACERLEN    Spacer length (This region is removed and only the barcode will be added to the header)
 # --sfilt SPACERFILT  Filter that excludes reads without the specified base(s) in the spacer region
+# --threads THREADS   Number of worker processes; read pairs are extracted in batches and written in input order [1]
+# --batch BATCH       Number of read pairs per batch [50000]
+# --compress          Write BGZF compressed output FASTQ files ("_barcode_R1.fastq.gz")
+# --format FORMAT     Where barcodes are stored [header]:
+#                       header - read name in FASTQ header (e.g. @H1080:278:C8RE3ACXX:6:1308:18882:18072|TTTG/1)
+#                       tag    - RX tag as FASTQ comment (e.g. @H1080:278:C8RE3ACXX:6:1308:18882:18072/1 RX:Z:TTTG),
+#                                carried over to the BAM file when aligning with 'bwa mem -C'
+#                       ubam   - RX tag in a paired unmapped BAM file ("_barcode.bam", requires pysam), which can be
+#                                aligned with 'samtools fastq -T RX | bwa mem -p -C'
+# --profile           Profile run, writing cProfile stats ("_barcode.profile.pstats") and collapsed stacks rooted at each
+#                     phase (extract/write/stats) for flame graphs ("_barcode.profile.collapsed"), see profiler.py.
+#                     Worker processes are not profiled (use --threads 1 to profile extraction)
 #
 # Inputs:
 # 1. A FASTQ file containing first-in-pair (Read 1) reads
@@ -30,6 +43,7 @@
 # 1. A Read 1 FASTQ file with barcodes added to the FASTQ header
 # 2. A Read 2 FASTQ file with barcodes added to the FASTQ header
 # 3. A text file summarizing barcode stats
+# (1 and 2 are replaced by an unmapped BAM file with "--format ubam")
 #
 ###############################################################
 
@@ -37,40 +51,91 @@
 #    Modules   #
 ################
 from argparse import ArgumentParser
-from itertools import zip_longest
-import pandas as pd
+from functools import partial
+from multiprocessing import Pool
 import numpy as np
 import sys
 
+from fastq_helper import *
+
+
+# Byte lookup table for base counting: A, C, G, T, N -> 0-4, padding of short reads -> 5, any other byte -> 6
+NUC_LOOKUP = np.full(256, 6, dtype=np.intp)
+for nuc_index, nuc in enumerate(b'ACGTN'):
+    NUC_LOOKUP[nuc] = nuc_index
+NUC_LOOKUP[0] = 5
+
 
 ###############################
-#        Main Function        #
+#       Helper Functions      #
 ###############################
-def main():
-    # Command-line parameters
-    parser = ArgumentParser()
-    parser.add_argument("--read1", action="store", dest="read1", type=str,
-                        help="Input FASTQ file for Read 1 (unzipped)", required=True)
-    parser.add_argument("--read2", action="store", dest="read2", type=str,
-                        help="Input FASTQ file for Read 2 (unzipped)", required=True)
-    parser.add_argument("--outfile", action="store", dest="outfile", help="Output SSCS BAM file", type=str,
-                        required=True)
-    parser.add_argument("--blen", action="store", dest="blen", help="Barcode length", type=int, required=True)
-    parser.add_argument("--slen", action="store", dest="slen", help="Spacer length", type=int, required=True)
-    parser.add_argument("--sfilt", action="store", dest="sfilt", type=str,
-                        help="Spacer filter that excludes reads without the specified base(s) in the spacer region",
-                        required=False)
-    args = parser.parse_args()
+def count_bases(seqs, length):
+    """(list, int) -> numpy.ndarray
+    Return position x base (A, C, G, T, N) count table for a batch of barcode or spacer sequences.
 
-    ######################
-    #       SETUP        #
-    ######################
-    # === Initialize input and output files ===
-    read1 = open(args.read1, "r")
-    read2 = open(args.read2, "r")
-    r1_output = open('{}_barcode_R1.fastq'.format(args.outfile), "w")
-    r2_output = open('{}_barcode_R2.fastq'.format(args.outfile), "w")
-    stats = open('{}_barcode_stats.txt'.format(args.outfile.rsplit(sep="/", maxsplit=1)[0]), 'a')
+    Sequences are concatenated into a single byte buffer of fixed-length slices and counted with a byte lookup table,
+    positions missing from sequences shorter than length are ignored.
+
+    >>> count_bases([b'ACG', b'AAT', b'A'], 3).tolist()
+    [[3, 0, 0, 0, 0], [1, 1, 0, 0, 0], [0, 0, 1, 1, 0]]
+    """
+    counts = np.zeros((length, 5), dtype=np.int64)
+    if not seqs or length == 0:
+        return counts
+
+    buffer = b''.join(seqs)
+    if len(buffer) != len(seqs) * length:
+        buffer = b''.join(seq.ljust(length, b'\0') for seq in seqs)
+
+    nuc_index = NUC_LOOKUP[np.frombuffer(buffer, dtype=np.uint8)]
+    if (nuc_index == 6).any():
+        raise ValueError("Unexpected base in barcode/spacer region (expected A, C, G, T or N)")
+
+    # Offset base index by position, so all positions are counted with a single bincount
+    nuc_index = nuc_index.reshape(len(seqs), length) + np.arange(length) * 6
+    counts += np.bincount(nuc_index.ravel(), minlength=length * 6).reshape(length, 6)[:, :5]
+
+    return counts
+
+
+def count_table(counts, name):
+    """(numpy.ndarray, str) -> str
+    Return position x base (A, C, G, T, N) count table as text, with positions labelled by name.
+
+    >>> print(count_table(np.array([[3, 0, 0, 0, 0], [1, 12, 0, 0, 0]]), 'R1_barcode'))
+                A   C  G  T  N
+    R1_barcode                
+    0           3   0  0  0  0
+    1           1  12  0  0  0
+    """
+    nuc_lst = ['A', 'C', 'G', 'T', 'N']
+    if len(counts) == 0:
+        return 'Empty DataFrame\nColumns: [{}]\nIndex: []'.format(', '.join(nuc_lst))
+
+    index_width = max(len(name), len(str(len(counts) - 1)))
+    widths = [max(len(nuc), len(str(counts[:, i].max()))) for i, nuc in enumerate(nuc_lst)]
+    lines = [' ' * index_width + ''.join('  ' + nuc.rjust(width) for nuc, width in zip(nuc_lst, widths)),
+             name.ljust(index_width) + ' ' * sum(width + 2 for width in widths)]
+    for position, row in enumerate(counts):
+        lines.append(str(position).ljust(index_width) +
+                     ''.join('  ' + str(count).rjust(width) for count, width in zip(row, widths)))
+
+    return '\n'.join(lines)
+
+
+def extract_batch(batch, blen, slen, sfilt, barcode_tag=False):
+    """(tuple, int, int, bytes, bool) -> bytes, bytes, list, list
+    Return barcode extracted Read 1 and Read 2 FASTQ records, read counts and base counts for a batch of read pairs.
+
+    Batches are lists of FASTQ lines as bytes (see fastq_helper.paired_batches). Barcodes are added to the read name,
+    or as a RX tag formatted FASTQ comment if barcode_tag is True.
+
+    Read counts: [total read pairs, missing spacer, bad barcodes, passing barcodes]
+    Base counts: position x base (A, C, G, T, N) arrays for R1 spacer, R2 spacer, R1 barcode and R2 barcode
+    """
+    r1_lines, r2_lines = batch
+    r1_out = []
+    r2_out = []
 
     # === Initialize counters ===
     readpair_count = 0
@@ -78,78 +143,215 @@ def main():
     bad_barcode = 0
     good_barcode = 0
 
-    nuc_lst = ['A', 'C', 'G', 'T', 'N']
-    # Column in the following  corresponds to A, C, G, T, N
-    r1_spacer_counter = pd.DataFrame(0, index=np.arange(args.slen), columns=nuc_lst)
-    r2_spacer_counter = pd.DataFrame(0, index=np.arange(args.slen), columns=nuc_lst)
-    r1_base_counter = pd.DataFrame(0, index=np.arange(args.blen), columns=nuc_lst)
-    r2_base_counter = pd.DataFrame(0, index=np.arange(args.blen), columns=nuc_lst)
-
-    # Rename rows
-    r1_spacer_counter.index.names = ['R1_spacer']
-    r2_spacer_counter.index.names = ['R2_spacer']
-    r1_base_counter.index.names = ['R1_barcode']
-    r2_base_counter.index.names = ['R2_barcode']
+    # Barcode and spacer sequences collected for base counting
+    r1_spacers = []
+    r2_spacers = []
+    r1_barcodes = []
+    r2_barcodes = []
 
     ######################
     #  Extract barcodes  #
     ######################
-    for r1, r2 in zip(zip_longest(*[read1] * 4), zip_longest(*[read2] * 4)):
+    for j in range(0, len(r1_lines), 4):
         readpair_count += 1
 
-        # Remove new line '\n' from str and separate using variables
-        r1_header = r1[0].rstrip()
-        r1_seq = r1[1].rstrip()
-        r1_qual = r1[3].rstrip()
+        # Separate lines of record using variables (new lines already removed)
+        r1_header = r1_lines[j]
+        r1_seq = r1_lines[j + 1]
+        r1_qual = r1_lines[j + 3]
+
+        r2_header = r2_lines[j]
+        r2_seq = r2_lines[j + 1]
+        r2_qual = r2_lines[j + 3]
 
-        r2_header = r2[0].rstrip()
-        r2_seq = r2[1].rstrip()
-        r2_qual = r2[3].rstrip()
+        check_pair(r1_header, r2_header)
 
         # Isolate spacer
-        r1_spacer = r1_seq[args.blen:args.blen + args.slen]
-        r2_spacer = r2_seq[args.blen:args.blen + args.slen]
+        r1_spacer = r1_seq[blen:blen + slen]
+        r2_spacer = r2_seq[blen:blen + slen]
 
-        # Count spacer bases
-        for i in range(len(r1_spacer)):
-            r1_spacer_counter.iloc[i, nuc_lst.index(r1_spacer[i])] += 1
-            r2_spacer_counter.iloc[i, nuc_lst.index(r2_spacer[i])] += 1
+        r1_spacers.append(r1_spacer)
+        r2_spacers.append(r2_spacer)
 
         # Check spacer filter
-        if args.sfilt is not None and (r1_spacer is not args.sfilt or r2_spacer is not args.sfilt):
+        if sfilt is not None and (r1_spacer != sfilt or r2_spacer != sfilt):
             nospacer += 1
         else:
             # Isolate barcodes
-            r1_barcode = r1_seq[:args.blen]
-            r2_barcode = r2_seq[:args.blen]
+            r1_barcode = r1_seq[:blen]
+            r2_barcode = r2_seq[:blen]
 
-            # Count barcode bases
-            for i in range(len(r1_barcode)):
-                r1_base_counter.iloc[i, nuc_lst.index(r1_barcode[i])] += 1
-                r2_base_counter.iloc[i, nuc_lst.index(r2_barcode[i])] += 1
+            r1_barcodes.append(r1_barcode)
+            r2_barcodes.append(r2_barcode)
 
-            if r1_barcode.count("N") == 0 and r2_barcode.count("N") == 0:
+            if r1_barcode.count(b"N") == 0 and r2_barcode.count(b"N") == 0:
                 good_barcode += 1
                 # Extract barcode from sequence and quality scores
-                r1_seq = r1_seq[args.blen + args.slen:]
-                r2_seq = r2_seq[args.blen + args.slen:]
+                r1_seq = r1_seq[blen + slen:]
+                r2_seq = r2_seq[blen + slen:]
 
-                r1_qual = r1_qual[args.blen + args.slen:]
-                r2_qual = r2_qual[args.blen + args.slen:]
+                r1_qual = r1_qual[blen + slen:]
+                r2_qual = r2_qual[blen + slen:]
 
                 # Add barcode and read number to header
-                r1_header = '{}|{}{}/{}'.format(r1_header.split(" ")[0], r1_barcode, r2_barcode, "1")
-                r2_header = '{}|{}{}/{}'.format(r2_header.split(" ")[0], r1_barcode, r2_barcode, "2")
+                if barcode_tag:
+                    r1_header = b'%s/1\tRX:Z:%s%s' % (r1_header.split(b" ")[0], r1_barcode, r2_barcode)
+                    r2_header = b'%s/2\tRX:Z:%s%s' % (r2_header.split(b" ")[0], r1_barcode, r2_barcode)
+                else:
+                    r1_header = b'%s|%s%s/1' % (r1_header.split(b" ")[0], r1_barcode, r2_barcode)
+                    r2_header = b'%s|%s%s/2' % (r2_header.split(b" ")[0], r1_barcode, r2_barcode)
 
-                # Write read to output file
-                r1_output.write('{}\n{}\n+\n{}\n'.format(r1_header, r1_seq, r1_qual))
-                r2_output.write('{}\n{}\n+\n{}\n'.format(r2_header, r2_seq, r2_qual))
+                # Write read to output
+                r1_out.append(b'%s\n%s\n+\n%s\n' % (r1_header, r1_seq, r1_qual))
+                r2_out.append(b'%s\n%s\n+\n%s\n' % (r2_header, r2_seq, r2_qual))
 
             else:
                 bad_barcode += 1
 
-    r1_output.close()
-    r2_output.close()
+    # Count spacer and barcode bases
+    base_counts = [count_bases(r1_spacers, slen), count_bases(r2_spacers, slen),
+                   count_bases(r1_barcodes, blen), count_bases(r2_barcodes, blen)]
+
+    return b''.join(r1_out), b''.join(r2_out), [readpair_count, nospacer, bad_barcode, good_barcode], base_counts
+
+
+def write_unmapped_pairs(bamfile, r1_out, r2_out):
+    """(pysam.AlignmentFile, bytes, bytes) -> None
+    Write barcode extracted read pairs (FASTQ records with RX comments) to an unmapped BAM file.
+    """
+    import pysam
+
+    r1_lines = r1_out.split(b'\n')
+    r2_lines = r2_out.split(b'\n')
+
+    for j in range(0, len(r1_lines) - 1, 4):
+        for lines, flag in ((r1_lines, 77), (r2_lines, 141)):  # paired, unmapped, mate unmapped, first/second in pair
+            name, barcode = lines[j].split(b'\t')
+            read = pysam.AlignedSegment()
+            read.query_name = name[1:-2].decode()
+            read.flag = flag
+            read.query_sequence = lines[j + 1].decode()
+            read.query_qualities = pysam.qualitystring_to_array(lines[j + 3].decode())
+            read.set_tag('RX', barcode[5:].decode())
+            bamfile.write(read)
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    # Command-line parameters
+    parser = ArgumentParser()
+    parser.add_argument("--read1", action="store", dest="read1", type=str,
+                        help="Input FASTQ file for Read 1 (unzipped or gzip/BGZF compressed)", required=True)
+    parser.add_argument("--read2", action="store", dest="read2", type=str,
+                        help="Input FASTQ file for Read 2 (unzipped or gzip/BGZF compressed)", required=True)
+    parser.add_argument("--outfile", action="store", dest="outfile", help="Output SSCS BAM file", type=str,
+                        required=True)
+    parser.add_argument("--blen", action="store", dest="blen", help="Barcode length", type=int, required=True)
+    parser.add_argument("--slen", action="store", dest="slen", help="Spacer length", type=int, required=True)
+    parser.add_argument("--sfilt", action="store", dest="sfilt", type=str,
+                        help="Spacer filter that excludes reads without the specified base(s) in the spacer region",
+                        required=False)
+    parser.add_argument("--threads", action="store", dest="threads", type=int, default=1,
+                        help="Number of worker processes for barcode extraction [1]")
+    parser.add_argument("--batch", action="store", dest="batch", type=int, default=50000,
+                        help="Number of read pairs processed per batch [50000]")
+    parser.add_argument("--compress", action="store_true", dest="compress",
+                        help="Write BGZF compressed output FASTQ files")
+    parser.add_argument("--format", action="store", dest="format", choices=['header', 'tag', 'ubam'],
+                        default='header',
+                        help="Store barcodes in read name (header), as RX tag FASTQ comment for 'bwa mem -C' (tag), or "
+                             "as RX tag in a paired unmapped BAM file (ubam) [header]")
+    parser.add_argument("--profile", action="store_true", dest="profile",
+                        help="Write cProfile stats and collapsed stacks per phase for flame graphs (see profiler.py)")
+    args = parser.parse_args()
+
+    profiler = None
+    if args.profile:
+        from profiler import Profiler
+        profiler = Profiler('{}_barcode'.format(args.outfile))
+        profiler.start()
+
+    ######################
+    #       SETUP        #
+    ######################
+    # === Initialize input and output files ===
+    read1 = FastqReader(open_fastq(args.read1))
+    read2 = FastqReader(open_fastq(args.read2))
+    if args.format == 'ubam':
+        import pysam
+        ubam_output = pysam.AlignmentFile('{}_barcode.bam'.format(args.outfile), 'wb',
+                                          header={'HD': {'VN': '1.6', 'SO': 'unsorted'}})
+    else:
+        fastq_ext = '.fastq.gz' if args.compress else '.fastq'
+        r1_output = open_output('{}_barcode_R1{}'.format(args.outfile, fastq_ext), compress=args.compress)
+        r2_output = open_output('{}_barcode_R2{}'.format(args.outfile, fastq_ext), compress=args.compress)
+    stats = open('{}_barcode_stats.txt'.format(args.outfile.rsplit(sep="/", maxsplit=1)[0]), 'a')
+
+    # === Initialize counters ===
+    readpair_count = 0
+    nospacer = 0
+    bad_barcode = 0
+    good_barcode = 0
+
+    # Column in the following corresponds to A, C, G, T, N
+    r1_spacer_counter = np.zeros((args.slen, 5), dtype=np.int64)
+    r2_spacer_counter = np.zeros((args.slen, 5), dtype=np.int64)
+    r1_base_counter = np.zeros((args.blen, 5), dtype=np.int64)
+    r2_base_counter = np.zeros((args.blen, 5), dtype=np.int64)
+
+    ######################
+    #  Extract barcodes  #
+    ######################
+    # Batches are extracted by worker processes and written in input order, so output is identical to a serial run
+    sfilt = args.sfilt.encode() if args.sfilt is not None else None
+    extract = partial(extract_batch, blen=args.blen, slen=args.slen, sfilt=sfilt, barcode_tag=args.format != 'header')
+    batches = paired_batches(read1, read2, args.batch)
+
+    if args.threads > 1:
+        pool = Pool(args.threads)
+        results = pool.imap(extract, batches)
+    else:
+        pool = None
+        results = map(extract, batches)
+
+    if profiler is not None:
+        # Batches are read and extracted while iterating over results, the remaining loop body writes output
+        results = profiler.scoped(results, 'extract')
+        profiler.scope = 'write'
+
+    for r1_out, r2_out, read_counts, base_counts in results:
+        if args.format == 'ubam':
+            write_unmapped_pairs(ubam_output, r1_out, r2_out)
+        else:
+            r1_output.write(r1_out)
+            r2_output.write(r2_out)
+
+        readpair_count += read_counts[0]
+        nospacer += read_counts[1]
+        bad_barcode += read_counts[2]
+        good_barcode += read_counts[3]
+
+        r1_spacer_counter += base_counts[0]
+        r2_spacer_counter += base_counts[1]
+        r1_base_counter += base_counts[2]
+        r2_base_counter += base_counts[3]
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if profiler is not None:
+        profiler.scope = 'stats'
+
+    read1.close()
+    read2.close()
+    if args.format == 'ubam':
+        ubam_output.close()
+    else:
+        r1_output.close()
+        r2_output.close()
 
     # System output
     sys.stderr.write("Total sequences: {}\n".format(readpair_count))
@@ -157,6 +359,12 @@ def main():
     sys.stderr.write("Bad barcodes: {}\n".format(bad_barcode))
     sys.stderr.write("Passing barcodes: {}\n".format(good_barcode))
 
+    # Base count tables (rows: position, columns: A, C, G, T, N)
+    r1_spacer_counter = count_table(r1_spacer_counter, 'R1_spacer')
+    r2_spacer_counter = count_table(r2_spacer_counter, 'R2_spacer')
+    r1_base_counter = count_table(r1_base_counter, 'R1_barcode')
+    r2_base_counter = count_table(r2_base_counter, 'R2_barcode')
+
     # Output stats file
     stats.write("##########\n{}\n##########".format(args.outfile.split(sep="/")[-1]))
     stats.write('\nTotal sequences: {}\nMissing spacer: {}\nBad barcodes: {}\nPassing barcodes: {}\n'.format(readpair_count,
@@ -168,6 +376,9 @@ def main():
 
     stats.close()
 
+    if profiler is not None:
+        profiler.stop()
+
 
 if __name__ == "__main__":
     main()
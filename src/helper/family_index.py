@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Family Index
+#
+###############################################################
+# Function:
+# Sidecar index of BAM files from family key (barcode and coordinates) to BGZF virtual offsets, so consensus reads of
+# a family and the reads they were made from can be fetched directly instead of searching whole BAM files.
+# - Consensus BAM files are indexed as they're written (SSCS_maker.py, DCS_maker.py and singleton_correction.py
+#   --family_index)
+# - Any BAM file (e.g. the uncollapsed input BAM, or sorted consensus BAM files) can be indexed with --mode build
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Index ("<bam>.fidx.npy") is a numpy structured array with one entry per read, sorted by read coordinate, mate
+#     coordinate and barcode, loaded memory-mapped for lookups:
+#       pos_key     Read coordinate ((reference id + 1) << 32 | start), unplaced reads have reference id -1
+#       mate_key    Mate coordinate
+#       barcode     Molecular barcode (from query name: '|' separated in uncollapsed reads, first field of consensus
+#                   reads, or from a tag)
+#       offset      BGZF virtual offset of read
+#   - Lookups by coordinate are binary searches, lookups by barcode only are vectorised scans
+#   - Families are looked up with the barcode of both strands (duplex barcode has swapped halves, e.g. AT|GC -> GC|AT),
+#     so consensus reads and reads of both strands are found
+#   - Off-target BAM files (--offtarget) aren't indexed
+#
+# Usage:
+# python3 family_index.py --mode build --bam BAM [BAM ...] [--umi_tag UMITAG]
+# python3 family_index.py --mode lookup --bam BAM [BAM ...] [--family FAMILY] [--barcode BARCODE] [--position POSITION]
+#
+# Arguments:
+# --mode MODE           build: index BAM files; lookup: print reads of family from indexed BAM files
+# --bam BAM             BAM files
+# --umi_tag UMITAG      Tag containing molecular barcode (e.g. RX) instead of query name (build mode)
+# --family FAMILY       Family or consensus query name, e.g. TTTG_24_58847416_24_58847448_137M10S_147M_pos:5 or
+#                       CATT_TTCA_7_55259315_7_55259454_98M_98M:6_3 (coordinates are reference ids and 0-based starts)
+# --barcode BARCODE     Molecular barcode
+# --position POSITION   Read start (CHR:POS, 1-based)
+#
+# Outputs:
+# Index files ("<bam>.fidx.npy", build mode) or SAM lines of matching reads for each BAM file (lookup mode).
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+from array import array
+import numpy as np
+import pysam
+import sys
+
+
+###############################
+#          Functions          #
+###############################
+def index_filename(bamfile):
+    return '{}.fidx.npy'.format(bamfile)
+
+
+def coordinate_key(reference_id, start):
+    """(int, int) -> int
+    Return sortable key of coordinate.
+
+    >>> coordinate_key(0, 100)
+    4294967396
+    >>> coordinate_key(-1, -1) < coordinate_key(0, 0)
+    True
+    """
+    return ((reference_id + 1) << 32) | (start & 0xffffffff) if start >= 0 else (reference_id + 1) << 32
+
+
+def read_barcode(read, barcode_tag=None):
+    """(pysam.calignedsegment.AlignedSegment, str) -> str
+    Return molecular barcode of uncollapsed (H1080:278:C8RE3ACXX:6:1308:18882:18072|TTTG) or consensus
+    (TTTG_24_58847416_24_58847448_137M10S_147M_pos:5) read.
+    """
+    if barcode_tag is not None:
+        return read.get_tag(barcode_tag)
+    if '|' in read.query_name:
+        return read.query_name.rsplit('|', 1)[1]
+
+    return read.query_name.split('_', 1)[0]
+
+
+def duplex_barcode(barcode):
+    """(str) -> str
+    Return barcode of complementary strand (see consensus_helper.duplex_tag).
+
+    >>> duplex_barcode('ATGC')
+    'GCAT'
+    """
+    barcode_bases = int(len(barcode) / 2)
+    return barcode[barcode_bases:] + barcode[:barcode_bases]
+
+
+def parse_family(family):
+    """(str) -> list, tuple
+    Return barcodes and coordinates (reference id, start, mate reference id, mate start) of family or consensus query
+    name.
+
+    >>> parse_family('TTTG_24_58847416_24_58847448_137M10S_147M_pos:5')
+    (['TTTG'], (24, 58847416, 24, 58847448))
+    >>> parse_family('CATT_TTCA_7_55259315_7_55259454_98M_98M:6_3')
+    (['CATT', 'TTCA'], (7, 55259315, 7, 55259454))
+    """
+    fields = family.split(':')[0].split('_')
+    barcodes = []
+    while not fields[0].lstrip('-').isdigit():
+        barcodes.append(fields.pop(0))
+
+    return barcodes, tuple(int(field) for field in fields[:4])
+
+
+class FamilyIndexWriter(object):
+    """Collect family keys and virtual offsets of reads and save them as a sorted index."""
+    def __init__(self, filename, barcode_tag=None):
+        self.filename = filename
+        self.barcode_tag = barcode_tag
+        self.pos_keys = array('q')
+        self.mate_keys = array('q')
+        self.barcodes = bytearray()  # Barcodes padded to fixed width (longest barcode so far)
+        self.width = 1
+        self.offsets = array('Q')
+
+    def add(self, read, offset):
+        self.pos_keys.append(coordinate_key(read.reference_id, read.reference_start))
+        self.mate_keys.append(coordinate_key(read.next_reference_id, read.next_reference_start))
+        barcode = read_barcode(read, self.barcode_tag).encode()
+        if len(barcode) > self.width:
+            self.widen(len(barcode))
+        self.barcodes += barcode.ljust(self.width, b'\0')
+        self.offsets.append(offset)
+
+    def widen(self, width):
+        """(int) -> None
+        Pad barcodes collected so far to width (barcodes are usually all the same length, so this is rare).
+        """
+        barcodes = np.frombuffer(self.barcodes, dtype='S{}'.format(self.width)) if self.barcodes else []
+        self.barcodes = bytearray(np.array(barcodes, dtype='S{}'.format(width)).tobytes())
+        self.width = width
+
+    def close(self):
+        barcodes = np.frombuffer(self.barcodes, dtype='S{}'.format(self.width)) if self.barcodes else \
+            np.zeros(0, dtype='S{}'.format(self.width))
+        index = np.zeros(len(self.offsets), dtype=[('pos_key', '<i8'), ('mate_key', '<i8'),
+                                                   ('barcode', barcodes.dtype), ('offset', '<u8')])
+        index['pos_key'] = self.pos_keys
+        index['mate_key'] = self.mate_keys
+        index['barcode'] = barcodes
+        index['offset'] = self.offsets
+
+        order = np.lexsort((index['barcode'], index['mate_key'], index['pos_key']))
+        np.save(self.filename, index[order])
+
+
+class IndexedWriter(object):
+    """Write reads to a BAM file (pysam.AlignmentFile) and index them by family key ("<bam>.fidx.npy")."""
+    def __init__(self, bam, filename):
+        self.bam = bam
+        self.index = FamilyIndexWriter(index_filename(filename))
+
+    def write(self, read):
+        self.index.add(read, self.bam.tell())
+        self.bam.write(read)
+
+    def close(self):
+        self.bam.close()
+        self.index.close()
+
+
+def build_index(bamfile, barcode_tag=None):
+    """(str, str) -> int
+    Index all reads of BAM file, and return number of reads indexed.
+    """
+    index = FamilyIndexWriter(index_filename(bamfile), barcode_tag)
+    with pysam.AlignmentFile(bamfile, "rb", check_sq=False) as bam:
+        reads = bam.fetch(until_eof=True)
+        while True:
+            offset = bam.tell()
+            try:
+                read = next(reads)
+            except StopIteration:
+                break
+            index.add(read, offset)
+    index.close()
+
+    return len(index.offsets)
+
+
+def lookup(index, barcodes=None, coordinates=None):
+    """(numpy.ndarray, list, list) -> numpy.ndarray
+    Return sorted virtual offsets of index entries matching any of barcodes and any of coordinates ((reference id,
+    start) or (reference id, start, mate reference id, mate start)).
+    """
+    if coordinates is None:
+        entries = index
+    else:
+        matches = []
+        for coordinate in coordinates:
+            key = coordinate_key(coordinate[0], coordinate[1])
+            start, end = np.searchsorted(index['pos_key'], [key, key + 1])
+            entries = index[start:end]
+            if len(coordinate) == 4:
+                entries = entries[entries['mate_key'] == coordinate_key(coordinate[2], coordinate[3])]
+            matches.append(entries)
+        entries = np.concatenate(matches) if matches else index[:0]
+
+    if barcodes is not None:
+        entries = entries[np.isin(entries['barcode'], [barcode.encode() for barcode in barcodes])]
+
+    return np.unique(entries['offset'])
+
+
+def fetch_reads(bam, offsets):
+    """Yield reads of BAM file (pysam.AlignmentFile) at virtual offsets."""
+    for offset in offsets:
+        bam.seek(int(offset))
+        yield next(bam)
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--mode", action="store", dest="mode", choices=['build', 'lookup'], required=True,
+                        help="Index BAM files (build) or print reads of family from indexed BAM files (lookup)")
+    parser.add_argument("--bam", action="store", dest="bam", nargs='+', help="BAM files", required=True)
+    parser.add_argument("--umi_tag", action="store", dest="umi_tag",
+                        help="Tag containing molecular barcode (e.g. RX) instead of query name (build mode)")
+    parser.add_argument("--family", action="store", dest="family", help="Family or consensus query name")
+    parser.add_argument("--barcode", action="store", dest="barcode", help="Molecular barcode")
+    parser.add_argument("--position", action="store", dest="position", help="Read start (CHR:POS, 1-based)")
+    args = parser.parse_args()
+
+    if args.mode == 'build':
+        for bamfile in args.bam:
+            print('{}: {} reads indexed'.format(bamfile, build_index(bamfile, args.umi_tag)))
+        return
+
+    if args.family is None and args.barcode is None and args.position is None:
+        parser.error("--family, --barcode or --position is required in lookup mode")
+
+    barcodes = None
+    coordinates = None
+    if args.family is not None:
+        barcodes, (reference_id, start, mate_reference_id, mate_start) = parse_family(args.family)
+        # Both reads of the pair
+        coordinates = [(reference_id, start, mate_reference_id, mate_start),
+                       (mate_reference_id, mate_start, reference_id, start)]
+    if args.barcode is not None:
+        barcodes = [args.barcode]
+    if barcodes is not None:
+        barcodes = sorted(set(barcodes + [duplex_barcode(barcode) for barcode in barcodes]))
+
+    for bamfile in args.bam:
+        index = np.load(index_filename(bamfile), mmap_mode='r')
+        with pysam.AlignmentFile(bamfile, "rb", check_sq=False) as bam:
+            bam_coordinates = coordinates
+            if args.position is not None:
+                chrom, position = args.position.rsplit(':', 1)
+                if chrom not in bam.references:
+                    sys.exit("Reference {} not found in {}".format(chrom, bamfile))
+                bam_coordinates = [(bam.get_tid(chrom), int(position) - 1)]
+
+            offsets = lookup(index, barcodes, bam_coordinates)
+            print('# {}: {} reads'.format(bamfile, len(offsets)))
+            for read in fetch_reads(bam, offsets):
+                print(read.to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Family Store
+#
+###############################################################
+# Function:
+# Persistent cache of read families grouped by SSCS_maker.py (read_bam), so reruns with different consensus
+# parameters (e.g. --cutoff) skip BAM decoding, filtering and grouping.
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Store is a directory of columnar binary files (one file per field), loaded memory-mapped
+#   - Columns are written in blocks as they fill, so building a store takes memory independent of the number of reads
+#   - Families are stored in the order they were consumed for consensus making, with their consensus tag, unique tag
+#     and member reads
+#   - Variable-length fields (tags, query names, cigars, optional fields, bases and qualities) are stored as
+#     concatenated bytes with per-value offsets
+#   - Reads that failed filtering (badReads) and read counters are stored to reproduce all outputs
+#   - Store is keyed by a content hash (SHA-1) of the input BAM file and the grouping parameters, a store with a
+#     different key (or layout version) is rebuilt
+#   - Stores updated with new lanes (incremental.py) copy unchanged families column by column (add_stored) and are
+#     keyed by the hash of the previous key and the lane
+#
+# Layout:
+#   meta.json               Layout version, content hash, parameters, read counters and number of families/reads
+#   consensus_tags.bin      Consensus tag of each family (2 consecutive families per consensus tag)
+#   tags.bin                Unique tag of each family
+#   family_offsets.bin      Index of first member read of each family (n families + 1)
+#   <field>.bin             Per-read integer columns (flag, coordinates, mapping quality, template length)
+#   query_name.bin, cigarstring.bin, optional_fields.bin, seq.bin, qual.bin
+#                           Per-read variable-length columns (bases in ASCII, phred qualities)
+#   <name>_offsets.bin      Offsets of values of variable-length column <name> (n values + 1)
+#   Integer columns and offsets are int64, variable-length columns are bytes. Bad reads follow family member reads (from
+#   meta.json 'bad_reads_start')
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import pysam
+import numpy as np
+import hashlib
+import json
+import os
+from array import array
+
+from consensus_helper import read_coordinate, STREAM_MAX_DISTANCE
+
+
+STORE_VERSION = 2
+INT_FIELDS = ['flag', 'reference_id', 'reference_start', 'mapping_quality', 'next_reference_id',
+              'next_reference_start', 'template_length']
+READ_BLOBS = ['query_name', 'cigarstring', 'optional_fields', 'seq', 'qual']
+FAMILY_BLOBS = ['consensus_tags', 'tags']
+COPY_CHUNK = 100000  # families or reads copied from a store at a time
+
+
+###############################
+#          Functions          #
+###############################
+def input_digest(infile, params, block_size=4 * 1024 * 1024):
+    """(str, dict) -> str
+    Return SHA-1 hex digest of input file contents and parameters affecting read grouping.
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    with open(infile, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class ColumnWriter(object):
+    """Column file of fixed-width values (array typecode), appended in blocks of buffer_size values."""
+    def __init__(self, filename, typecode, buffer_size=1 << 16):
+        self.file = open(filename, 'wb')
+        self.typecode = typecode
+        self.buffer = array(typecode)
+        self.buffer_size = buffer_size
+        self.written = 0
+
+    def __len__(self):
+        return self.written + len(self.buffer)
+
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def extend(self, values):
+        """Append values of numpy array."""
+        self.buffer.frombytes(np.ascontiguousarray(values, dtype=self.buffer.typecode).tobytes())
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.buffer.tofile(self.file)
+        self.written += len(self.buffer)
+        self.buffer = array(self.typecode)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class BlobWriter(object):
+    """Variable-length column: concatenated bytes ("<name>.bin") and offsets of each value ("<name>_offsets.bin")."""
+    def __init__(self, directory, name):
+        self.data = ColumnWriter(os.path.join(directory, name + '.bin'), 'B')
+        self.offsets = ColumnWriter(os.path.join(directory, name + '_offsets.bin'), 'q')
+        self.offsets.append(0)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, value):
+        self.data.buffer.frombytes(value)
+        self.offsets.append(len(self.data))
+        if len(self.data.buffer) >= self.data.buffer_size:
+            self.data.flush()
+
+    def copy(self, store, name, start, end, mask):
+        """Append values start to end of store column selected by boolean mask."""
+        offsets = store._column(name + '_offsets')[start:end + 1]
+        lengths = np.diff(offsets)
+        base = len(self.data)
+        self.data.extend(store._column(name)[offsets[0]:offsets[-1]][np.repeat(mask, lengths)])
+        self.offsets.extend(base + np.cumsum(lengths[mask]))
+
+    def close(self):
+        self.data.close()
+        self.offsets.close()
+
+
+class FamilyStoreWriter(object):
+    """Write read families (and bad reads) to a family store directory, column by column as they fill.
+
+    add_family() must be called before reads are modified for output (e.g. singleton query names).
+    """
+    def __init__(self, directory, digest, params):
+        self.directory = directory
+        self.digest = digest
+        self.params = params
+        os.makedirs(directory, exist_ok=True)
+        # Store is incomplete until metadata is written by close()
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            os.remove(os.path.join(directory, 'meta.json'))
+
+        self.blobs = {name: BlobWriter(directory, name) for name in FAMILY_BLOBS + READ_BLOBS}
+        self.family_offsets = ColumnWriter(os.path.join(directory, 'family_offsets.bin'), 'q')
+        self.family_offsets.append(0)
+        self.int_fields = {field: ColumnWriter(os.path.join(directory, field + '.bin'), 'q') for field in INT_FIELDS}
+        self.reads = 0
+
+    def _add_read(self, read):
+        self.blobs['query_name'].append(read.query_name.encode())
+        self.blobs['cigarstring'].append((read.cigarstring or '*').encode())
+        # Optional fields (e.g. RG:Z:1, XF:i:3) in SAM format
+        self.blobs['optional_fields'].append('\t'.join(read.to_string().split('\t')[11:]).encode())
+        for field in INT_FIELDS:
+            self.int_fields[field].append(getattr(read, field))
+        # Sequence and qualities may be missing (e.g. secondary reads)
+        self.blobs['seq'].append((read.query_sequence or '').encode())
+        self.blobs['qual'].append(bytes(read.query_qualities or b''))
+        self.reads += 1
+
+    def add_family(self, consensus_tag, tag, reads):
+        """Add family of reads sharing unique tag."""
+        self.blobs['consensus_tags'].append(consensus_tag.encode())
+        self.blobs['tags'].append(tag.encode())
+        for read in reads:
+            self._add_read(read)
+        self.family_offsets.append(self.reads)
+
+    def _add_stored_reads(self, store, start, end, read_mask):
+        """Copy reads start to end of store selected by boolean mask from store columns."""
+        for name in READ_BLOBS:
+            self.blobs[name].copy(store, name, start, end, read_mask)
+        for field in INT_FIELDS:
+            self.int_fields[field].extend(store._column(field)[start:end][read_mask])
+        self.reads += int(read_mask.sum())
+
+    def add_stored(self, store, family_mask):
+        """Copy families selected by boolean mask from store (FamilyStore) without rebuilding their reads."""
+        family_offsets = store._column('family_offsets')
+        for start in range(0, store.meta['families'], COPY_CHUNK):
+            end = min(start + COPY_CHUNK, store.meta['families'])
+            mask = family_mask[start:end]
+            sizes = np.diff(family_offsets[start:end + 1])
+            reads = self.reads
+            self._add_stored_reads(store, int(family_offsets[start]), int(family_offsets[end]), np.repeat(mask, sizes))
+            for name in FAMILY_BLOBS:
+                self.blobs[name].copy(store, name, start, end, mask)
+            self.family_offsets.extend(reads + np.cumsum(sizes[mask]))
+
+    def close(self, stats, bad_reads=(), stored_bad_reads=None):
+        """Write store with read counters (dict) and bad reads (bad reads of stored_bad_reads store are copied first),
+        metadata is written last to mark store as complete.
+        """
+        bad_reads_start = self.reads
+        if stored_bad_reads is not None:
+            for start in range(stored_bad_reads.meta['bad_reads_start'], stored_bad_reads.meta['reads'], COPY_CHUNK):
+                end = min(start + COPY_CHUNK, stored_bad_reads.meta['reads'])
+                self._add_stored_reads(stored_bad_reads, start, end, np.ones(end - start, dtype=bool))
+        for read in bad_reads:
+            self._add_read(read)
+
+        families = len(self.blobs['tags'])
+        for column in list(self.blobs.values()) + list(self.int_fields.values()) + [self.family_offsets]:
+            column.close()
+
+        with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+            json.dump({'version': STORE_VERSION,
+                       'digest': self.digest,
+                       'params': self.params,
+                       'stats': stats,
+                       'families': families,
+                       'bad_reads_start': bad_reads_start,
+                       'reads': self.reads}, f, indent=2)
+
+
+class FamilyStore(object):
+    """Memory-mapped family store written by FamilyStoreWriter.
+
+    Reads are rebuilt as pysam.AlignedSegment objects with the header of the input BAM file.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.meta = None
+        self.columns = {}
+        meta_file = os.path.join(directory, 'meta.json')
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                self.meta = json.load(f)
+            # Stores of an older layout are treated as missing (rebuilt)
+            if self.meta.get('version') != STORE_VERSION:
+                self.meta = None
+
+    def matches(self, digest):
+        """Return True if store is complete and was built from the same input and parameters."""
+        return self.meta is not None and self.meta['digest'] == digest
+
+    def _column(self, name):
+        if name not in self.columns:
+            filename = os.path.join(self.directory, name + '.bin')
+            dtype = np.uint8 if name in FAMILY_BLOBS + READ_BLOBS else np.int64
+            # Empty files can't be memory-mapped
+            self.columns[name] = np.memmap(filename, dtype=dtype, mode='r') if os.path.getsize(filename) else \
+                np.zeros(0, dtype=dtype)
+        return self.columns[name]
+
+    def _strings(self, name, start, end, add=0):
+        """(str, int, int, int) -> list
+        Return values start to end of variable-length column as strings (with add added to each byte).
+        """
+        offsets = self._column(name + '_offsets')[start:end + 1]
+        data = self._column(name)[offsets[0]:offsets[-1]]
+        data = (data + add if add else data).tobytes().decode()
+        offsets = (offsets - offsets[0]).tolist()
+        return [data[offsets[i]:offsets[i + 1]] for i in range(end - start)]
+
+    def _reads(self, header, start, end):
+        columns = {name: self._column(name)[start:end].tolist() for name in INT_FIELDS}
+        for name in ['query_name', 'cigarstring', 'optional_fields', 'seq']:
+            columns[name] = self._strings(name, start, end)
+        columns['qual'] = self._strings('qual', start, end, add=33)
+
+        reads = []
+        for i in range(end - start):
+            ref_id = int(columns['reference_id'][i])
+            mate_ref_id = int(columns['next_reference_id'][i])
+            fields = [columns['query_name'][i],
+                      str(columns['flag'][i]),
+                      header.get_reference_name(ref_id) if ref_id >= 0 else '*',
+                      str(columns['reference_start'][i] + 1),
+                      str(columns['mapping_quality'][i]),
+                      columns['cigarstring'][i],
+                      '=' if mate_ref_id == ref_id and ref_id >= 0 else
+                      (header.get_reference_name(mate_ref_id) if mate_ref_id >= 0 else '*'),
+                      str(columns['next_reference_start'][i] + 1),
+                      str(columns['template_length'][i]),
+                      columns['seq'][i] or '*',
+                      columns['qual'][i] or '*']
+            if columns['optional_fields'][i]:
+                fields.append(columns['optional_fields'][i])
+            reads.append(pysam.AlignedSegment.fromstring('\t'.join(fields), header))
+
+        return reads
+
+    def chunks(self, header, chunk_size=10000):
+        """(pysam.AlignmentHeader, int) -> generator
+        Yield lists of (consensus_tag, [(tag, reads), (tag, reads)]) with up to chunk_size consensus tags, in the order
+        families were stored.
+        """
+        family_offsets = self._column('family_offsets')
+
+        for chunk_start in range(0, self.meta['families'], 2 * chunk_size):
+            chunk_end = min(chunk_start + 2 * chunk_size, self.meta['families'])
+            consensus_tags = self._strings('consensus_tags', chunk_start, chunk_end)
+            tags = self._strings('tags', chunk_start, chunk_end)
+            offsets = (family_offsets[chunk_start:chunk_end + 1] - family_offsets[chunk_start]).tolist()
+            reads = self._reads(header, int(family_offsets[chunk_start]), int(family_offsets[chunk_end]))
+
+            chunk = []
+            for i in range(chunk_end - chunk_start):
+                family = (tags[i], reads[offsets[i]:offsets[i + 1]])
+                if chunk and chunk[-1][0] == consensus_tags[i]:
+                    chunk[-1][1].append(family)
+                else:
+                    chunk.append((consensus_tags[i], [family]))
+            yield chunk
+
+    def family(self, header, index):
+        """(pysam.AlignmentHeader, int) -> str, str, list
+        Return consensus tag, unique tag and reads of stored family.
+        """
+        family_offsets = self._column('family_offsets')
+        return (self._strings('consensus_tags', index, index + 1)[0], self._strings('tags', index, index + 1)[0],
+                self._reads(header, int(family_offsets[index]), int(family_offsets[index + 1])))
+
+    def bad_reads(self, header):
+        """(pysam.AlignmentHeader) -> list
+        Return reads that failed filtering (unmapped, multiple mapping, unpaired).
+        """
+        return self._reads(header, self.meta['bad_reads_start'], self.meta['reads'])
+
+
+def stored_watermark(chunk, max_distance=STREAM_MAX_DISTANCE):
+    """(list, int) -> tuple
+    Return streaming watermark (see consensus_helper.stream_watermark) after a chunk of stored families.
+
+    Families were stored as they were completed in a coordinate sweep, so families of later chunks are completed near
+    or after the last read of the chunk. Consensus reads of families completed further back are spilled by
+    SortedBamWriter.
+    """
+    ref, start = max(read_coordinate(read) for tag, reads in chunk[-1][1] for read in reads)
+    return ref, start - max_distance
+
+
+def add_stored_families(chunk, read_dict, tag_dict, pair_dict, csn_pair_dict):
+    """(list, dict, dict, dict, dict) -> dict, dict, dict, dict, int, int, int
+    Add chunk of stored families (FamilyStore.chunks) to dictionaries, in place of read_bam.
+
+    Returns the same values as read_bam, read counters are 0 as they're restored from the store metadata.
+    """
+    for consensus_tag, families in chunk:
+        for tag, reads in families:
+            read_dict[tag] = reads
+            tag_dict[tag] = len(reads)
+            csn_pair_dict[consensus_tag].append(tag)
+
+    return read_dict, tag_dict, pair_dict, csn_pair_dict, 0, 0, 0
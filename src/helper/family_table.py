@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Family Table
+#
+###############################################################
+# Function:
+# Per-family table of consensus making (--family_table), for analyses of duplex recovery, strand bias or family sizes
+# per target without parsing consensus query names.
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - One row per family (unique tag) consumed by a stage, written in batches during the run:
+#       SSCS_maker.py            "sscs.families.*"  (outcome: SSCS, singleton)
+#       DCS_maker.py             "dcs.families.*" or "dcs.sc.families.*"  (outcome: DCS, SSCS_singleton; families are
+#                                SSCSs, so both SSCSs of a DCS have a row)
+#       singleton_correction.py  "singleton_correction.families.*"  (outcome: SSCS_corrected, singleton_corrected,
+#                                uncorrected)
+#   - Columns:
+#       barcode, chrom, start, mate_chrom, mate_start, cigar, orientation, read
+#                       Key fields of unique tag (0-based start)
+#       strand          Strand of molecule (pos/neg) from consensus tag
+#       family_size     Reads in family (DCS/singleton correction: family size of SSCS from query name, 1 for
+#                       singletons)
+#       duplex_size     Family size of complementary strand family, 0 if not found
+#       outcome         Consensus outcome of family
+#       n_count         N bases in consensus read (n_count_cutoff<CUTOFF> for each cutoff of SSCS_maker.py)
+#   - Format: Parquet (".parquet") or Arrow IPC (".arrow") with pyarrow, gzip compressed TSV (".tsv.gz") otherwise.
+#     pyarrow is only imported when the table is written in these formats
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import gzip
+import sys
+
+
+KEY_FIELDS = ['barcode', 'chrom', 'start', 'mate_chrom', 'mate_start', 'cigar', 'orientation', 'read', 'strand']
+INT_FIELDS = ['start', 'mate_start', 'family_size', 'duplex_size']
+EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow', 'tsv': 'tsv.gz'}
+
+
+###############################
+#          Functions          #
+###############################
+def tag_fields(tag, consensus_tag, references):
+    """(str, str, list) -> list
+    Return key fields of unique tag (see consensus_helper.unique_tag) and strand of consensus tag, with reference ids
+    replaced by reference names.
+
+    >>> tag_fields('TTTG_0_58847416_0_58847448_137M10S_147M_fwd_R1', 'TTTG_0_58847416_0_58847448_137M10S_147M_pos',
+    ...            ['chr1'])
+    ['TTTG', 'chr1', 58847416, 'chr1', 58847448, '137M10S_147M', 'fwd', 'R1', 'pos']
+    """
+    split_tag = tag.split('_')
+    barcode, chrom, start, mate_chrom, mate_start = split_tag[:5]
+    cigar = '_'.join(split_tag[5:-2])
+
+    return [barcode, reference_name(chrom, references), int(start), reference_name(mate_chrom, references),
+            int(mate_start), cigar, split_tag[-2], split_tag[-1], consensus_tag.rsplit('_', 1)[1]]
+
+
+def reference_name(reference_id, references):
+    """(str, list) -> str
+    Return name of reference id ('*' for unplaced reads).
+    """
+    reference_id = int(reference_id)
+    return references[reference_id] if reference_id >= 0 else '*'
+
+
+def family_size(read):
+    """(pysam.calignedsegment.AlignedSegment) -> int
+    Return family size from consensus query name (e.g. CCTG_12_25398000_12_25398118_137M10S_147M_neg:5).
+    """
+    return int(read.query_name.rsplit(':', 1)[1])
+
+
+class FamilyTable(object):
+    """Table of families written to "<prefix>.families.<parquet/arrow/tsv.gz>" in batches of batch_size rows.
+
+    Parquet and Arrow IPC require pyarrow, the table is written as compressed TSV if it isn't installed.
+    """
+    def __init__(self, prefix, references, fmt='parquet', n_count_fields=('n_count',), batch_size=100000):
+        if fmt != 'tsv':
+            try:
+                import pyarrow
+            except ImportError:
+                sys.stderr.write("pyarrow not installed, writing family table as compressed TSV\n")
+                fmt = 'tsv'
+
+        self.references = references
+        self.fmt = fmt
+        self.fields = KEY_FIELDS + ['family_size', 'duplex_size', 'outcome'] + list(n_count_fields)
+        self.batch_size = batch_size
+        self.filename = '{}.families.{}'.format(prefix, EXTENSIONS[fmt])
+        self.rows = []
+        self.writer = None
+
+        if fmt == 'tsv':
+            self.writer = gzip.open(self.filename, 'wt', compresslevel=6)
+            self.writer.write('\t'.join(self.fields) + '\n')
+
+    def add(self, consensus_tag, tag, family_size, duplex_size, outcome, *n_counts):
+        self.rows.append(tag_fields(tag, consensus_tag, self.references) + [family_size, duplex_size, outcome] +
+                         list(n_counts))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write batch of rows."""
+        if self.fmt == 'tsv':
+            self.writer.write(''.join('\t'.join(str(value) for value in row) + '\n' for row in self.rows))
+        elif self.rows or self.writer is None:
+            self._write_batch()
+        self.rows = []
+
+    def _write_batch(self):
+        import pyarrow as pa
+
+        schema = pa.schema([(field, pa.int64() if field in INT_FIELDS or field.startswith('n_count') else pa.string())
+                            for field in self.fields])
+        columns = list(zip(*self.rows)) if self.rows else [[] for field in self.fields]
+        batch = pa.RecordBatch.from_arrays([pa.array(column, type=schema.field(i).type)
+                                            for i, column in enumerate(columns)], schema=schema)
+
+        if self.writer is None:
+            if self.fmt == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.filename, schema)
+            else:
+                self.writer = pa.ipc.new_file(self.filename, schema)
+        if self.fmt == 'parquet':
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
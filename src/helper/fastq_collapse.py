@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                  Pre-alignment FASTQ Collapser
+#
+###############################################################
+# Function:
+# To collapse PCR duplicates in barcode extracted FASTQ files prior to alignment, so only one provisional consensus
+# read pair per family is aligned.
+# - Read pairs are grouped by molecular barcode and a short prefix of the Read 1 and Read 2 sequences
+# - Groups are spilled to hash partitions on disk, so memory is bounded by the size of a single partition
+# - Provisional consensus from most common base with quality score >= Q30 and greater than <cutoff> representation
+#   (same rules as SSCS_maker.py consensus_maker)
+#
+# Written for Python 3.5.1
+#
+# USAGE:
+# python3 fastq_collapse.py [--read1 READ1] [--read2 READ2] [--outfile OUTFILE] [--plen PREFIXLEN] [--cutoff CUTOFF]
+#                           [--partitions PARTITIONS] [--tmpdir TMPDIR]
+#
+# Arguments:
+# --read1 READ1             Barcode extracted FASTQ file for Read 1 (extract_barcodes.py output)
+# --read2 READ2             Barcode extracted FASTQ file for Read 2 (extract_barcodes.py output)
+# --outfile OUTFILE         Output FASTQ files for Read 1 and Read 2 using given filename
+# --plen PREFIXLEN          Length of sequence prefix from each read used with the barcode to group reads [8]
+# --cutoff CUTOFF           Proportion of bases at a given position required to be identical to form a consensus [0.7]
+# --partitions PARTITIONS   Number of on-disk hash partitions [64]
+# --tmpdir TMPDIR           Directory for partition files (Default: system temporary directory)
+#
+# Inputs:
+# 1. A barcode extracted FASTQ file containing first-in-pair (Read 1) reads
+# 2. A barcode extracted FASTQ file containing second-in-pair (Read 2) reads
+#
+# Outputs:
+# 1. A Read 1 FASTQ file with one provisional consensus per family - "_collapsed_R1.fastq"
+# 2. A Read 2 FASTQ file with one provisional consensus per family - "_collapsed_R2.fastq"
+# 3. A sidecar text file mapping each consensus read to its family size and member reads - "_collapsed_families.txt"
+#
+# Family size is also stored as a FASTQ comment (XF:i:<size>), which is carried over to the BAM file when aligning
+# with 'bwa mem -C' and used by SSCS_maker.py --collapsed.
+#
+###############################################################
+
+################
+#    Modules   #
+################
+from argparse import ArgumentParser
+from itertools import zip_longest
+import collections
+import tempfile
+import shutil
+import zlib
+import sys
+import os
+
+
+###############################
+#       Helper Functions      #
+###############################
+def header_barcode(header):
+    """(str) -> str
+    Return molecular barcode from barcode extracted FASTQ header (read name or RX tag comment).
+
+    >>> header_barcode('@H1080:278:C8RE3ACXX:6:1308:18882:18072|TTTG/1')
+    'TTTG'
+    >>> header_barcode('@H1080:278:C8RE3ACXX:6:1308:18882:18072/1\tRX:Z:TTTG')
+    'TTTG'
+    """
+    if 'RX:Z:' in header:
+        return header.split('RX:Z:')[1].split()[0]
+
+    return header.split('|')[1].split('/')[0]
+
+
+def collapse_key(barcode, r1_seq, r2_seq, plen):
+    """(str, str, str, int) -> str
+    Return grouping key for a read pair from its barcode and sequence prefixes.
+
+    >>> collapse_key('ATGC', 'TTAGGCA', 'CCGATTA', 3)
+    'ATGC_TTA_CCG'
+    """
+    return '{}_{}_{}'.format(barcode, r1_seq[:plen], r2_seq[:plen])
+
+
+def fastq_consensus(seqs, quals, cutoff):
+    """(list, list, float) -> str, str
+    Return provisional consensus sequence and quality string for reads of the same family.
+
+    Bases below Q30 are excluded, and the most common base is only called if its proportion is >= cutoff (otherwise
+    'N'). Consensus quality is the sum of qualities supporting the base, capped at Q60. Consensus length is trimmed to
+    the shortest read.
+
+    >>> fastq_consensus(['ACGT', 'ACGA', 'ACGT'], ['IIII', 'IIII', 'IIII'], 0.7)
+    ('ACGN', ']]]!')
+    >>> fastq_consensus(['ACGT'], ['I#II'], 0.7)
+    ('ANGT', 'I!II')
+    """
+    consensus_seq = []
+    consensus_qual = []
+
+    for i in range(min(len(seq) for seq in seqs)):
+        nuc_count = collections.Counter()
+        qual_sum = collections.Counter()
+        for seq, qual in zip(seqs, quals):
+            phred = ord(qual[i]) - 33
+            if phred >= 30:
+                nuc_count[seq[i]] += 1
+                qual_sum[seq[i]] += phred
+
+        phred_pass_reads = sum(nuc_count.values())
+        if phred_pass_reads != 0:
+            nuc, count = nuc_count.most_common(1)[0]
+            if count / phred_pass_reads >= cutoff:
+                consensus_seq.append(nuc)
+                consensus_qual.append(chr(min(qual_sum[nuc], 60) + 33))
+                continue
+
+        consensus_seq.append('N')
+        consensus_qual.append('!')
+
+    return ''.join(consensus_seq), ''.join(consensus_qual)
+
+
+def partition_reads(read1, read2, partition_files, plen):
+    """(file, file, list, int) -> int
+    Spill read pairs to hash partitions based on their grouping key and return number of read pairs.
+
+    Each partition line holds the header, sequence and quality of Read 1 and Read 2, separated by null characters
+    (headers may contain tabs between FASTQ comments).
+    """
+    readpair_count = 0
+
+    for r1, r2 in zip(zip_longest(*[read1] * 4), zip_longest(*[read2] * 4)):
+        readpair_count += 1
+
+        r1_header = r1[0].rstrip()
+        r2_header = r2[0].rstrip()
+        if r1_header.split()[0].split('/')[0] != r2_header.split()[0].split('/')[0]:
+            raise ValueError("Read 1 and Read 2 out of sync: {} {}".format(r1_header, r2_header))
+
+        r1_seq = r1[1].rstrip()
+        r2_seq = r2[1].rstrip()
+
+        barcode = header_barcode(r1_header)
+        key = collapse_key(barcode, r1_seq, r2_seq, plen)
+
+        partition = partition_files[zlib.crc32(key.encode()) % len(partition_files)]
+        partition.write('{}\0{}\0{}\0{}\0{}\0{}\0{}\n'.format(key, r1_header, r1_seq, r1[3].rstrip(),
+                                                             r2_header, r2_seq, r2[3].rstrip()))
+
+    return readpair_count
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    # Command-line parameters
+    parser = ArgumentParser()
+    parser.add_argument("--read1", action="store", dest="read1", type=str,
+                        help="Barcode extracted FASTQ file for Read 1", required=True)
+    parser.add_argument("--read2", action="store", dest="read2", type=str,
+                        help="Barcode extracted FASTQ file for Read 2", required=True)
+    parser.add_argument("--outfile", action="store", dest="outfile", help="Output collapsed FASTQ files", type=str,
+                        required=True)
+    parser.add_argument("--plen", action="store", dest="plen", type=int, default=8,
+                        help="Length of sequence prefix used with the barcode to group reads [8]")
+    parser.add_argument("--cutoff", action="store", dest="cutoff", type=float, default=0.7,
+                        help="Proportion of bases required to be identical to form a consensus [0.7]")
+    parser.add_argument("--partitions", action="store", dest="partitions", type=int, default=64,
+                        help="Number of on-disk hash partitions [64]")
+    parser.add_argument("--tmpdir", action="store", dest="tmpdir", type=str, default=None,
+                        help="Directory for partition files")
+    args = parser.parse_args()
+
+    ######################
+    #       SETUP        #
+    ######################
+    read1 = open(args.read1, "r")
+    read2 = open(args.read2, "r")
+    r1_output = open('{}_collapsed_R1.fastq'.format(args.outfile), "w")
+    r2_output = open('{}_collapsed_R2.fastq'.format(args.outfile), "w")
+    family_output = open('{}_collapsed_families.txt'.format(args.outfile), "w")
+    family_output.write('read_name\tfamily_size\tmembers\n')
+
+    partition_dir = tempfile.mkdtemp(prefix='collapse_', dir=args.tmpdir)
+    partition_paths = [os.path.join(partition_dir, '{}.txt'.format(i)) for i in range(args.partitions)]
+
+    ######################
+    #     PARTITION      #
+    ######################
+    partition_files = [open(path, "w") for path in partition_paths]
+    readpair_count = partition_reads(read1, read2, partition_files, args.plen)
+    for partition in partition_files:
+        partition.close()
+    read1.close()
+    read2.close()
+
+    ######################
+    #      COLLAPSE      #
+    ######################
+    family_count = 0
+    for path in partition_paths:
+        families = collections.OrderedDict()
+        with open(path) as partition:
+            for line in partition:
+                record = line.rstrip('\n').split('\0')
+                families.setdefault(record[0], []).append(record[1:])
+        os.remove(path)
+
+        for members in families.values():
+            family_count += 1
+            family_size = len(members)
+            r1_header, r2_header = members[0][0], members[0][3]
+            # Multiple SAM tag comments are tab separated
+            comment_sep = '\t' if 'RX:Z:' in r1_header else ' '
+
+            if family_size == 1:
+                r1_seq, r1_qual, r2_seq, r2_qual = members[0][1], members[0][2], members[0][4], members[0][5]
+            else:
+                r1_seq, r1_qual = fastq_consensus([m[1] for m in members], [m[2] for m in members], args.cutoff)
+                r2_seq, r2_qual = fastq_consensus([m[4] for m in members], [m[5] for m in members], args.cutoff)
+
+            # Family size added as SAM tag formatted comment (retained with 'bwa mem -C')
+            r1_output.write('{}{}XF:i:{}\n{}\n+\n{}\n'.format(r1_header, comment_sep, family_size, r1_seq, r1_qual))
+            r2_output.write('{}{}XF:i:{}\n{}\n+\n{}\n'.format(r2_header, comment_sep, family_size, r2_seq, r2_qual))
+            family_output.write('{}\t{}\t{}\n'.format(r1_header[1:].split()[0].split('/')[0], family_size,
+                                                      ','.join(m[0][1:].split()[0].split('/')[0] for m in members)))
+
+    shutil.rmtree(partition_dir)
+    r1_output.close()
+    r2_output.close()
+    family_output.close()
+
+    # System output
+    sys.stderr.write("Total sequences: {}\n".format(readpair_count))
+    sys.stderr.write("Collapsed families: {}\n".format(family_count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        FASTQ Helper
+#
+###############################################################
+# Function:
+# Helper functions for reading and writing paired FASTQ files in barcode extraction (extract_barcodes.py and
+# tag_to_header.py).
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Reads are parsed from large binary blocks split into lines (4 lines per record), avoiding per-line text decoding
+#   - Gzip/BGZF input (.gz/.bgz) is decompressed in a background thread while records are being processed
+#   - BGZF output is gzip compatible (readable by bwa, zcat and htslib based tools)
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import gzip
+import queue
+import struct
+import threading
+import zlib
+
+BLOCK_SIZE = 4 * 1024 * 1024  # Bytes read from FASTQ file at a time
+
+
+###############################
+#          Functions          #
+###############################
+class ThreadedReader(object):
+    """Read blocks from a (decompressing) file handle in a background thread.
+
+    read() returns the next block of up to BLOCK_SIZE bytes, or b'' at end of file.
+    """
+    def __init__(self, handle, block_size=BLOCK_SIZE, queue_size=8):
+        self.handle = handle
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.eof = False
+        self.thread = threading.Thread(target=self._fill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while True:
+                block = self.handle.read(self.block_size)
+                self.blocks.put(block)
+                if not block:
+                    break
+        except Exception as e:
+            self.error = e
+            self.blocks.put(b'')
+
+    def read(self, size=-1):
+        if self.eof:
+            return b''
+        block = self.blocks.get()
+        if self.error is not None:
+            raise self.error
+        if not block:
+            self.eof = True
+        return block
+
+    def close(self):
+        self.handle.close()
+
+
+def open_fastq(filename):
+    """(str) -> file
+    Return binary file handle for FASTQ file, gzip/BGZF compressed files are decompressed in a background thread.
+
+    Compression is determined from the gzip magic number, so file extensions (.gz/.bgz) are not required.
+    """
+    handle = open(filename, 'rb')
+    if handle.peek(2)[:2] == b'\x1f\x8b':
+        return ThreadedReader(gzip.GzipFile(fileobj=handle))
+
+    return handle
+
+
+class FastqReader(object):
+    """Read lines of 4-line FASTQ records from a binary file handle in large blocks.
+
+    Blocks are split into lines with bytes.split (carrying over incomplete lines to the next block), which is several
+    times faster than iterating over a text file line by line.
+    """
+    def __init__(self, handle, block_size=BLOCK_SIZE):
+        self.handle = handle
+        self.block_size = block_size
+        self.lines = []
+        self.pos = 0
+        self.remainder = b''
+
+    def read_lines(self, n):
+        """Return list of the next n lines (without line endings), fewer lines are returned at end of file.
+
+        >>> import io
+        >>> FastqReader(io.BytesIO(b'@r1\\r\\nACGT\\r\\n+\\r\\nIIII\\r\\n'), block_size=19).read_lines(4)
+        [b'@r1', b'ACGT', b'+', b'IIII']
+        """
+        while len(self.lines) - self.pos < n:
+            block = self.handle.read(self.block_size)
+            if not block:
+                if self.remainder:
+                    self.lines.append(self.remainder.rstrip(b'\r'))
+                    self.remainder = b''
+                break
+
+            data = self.remainder + block
+            lines = data.split(b'\n')
+            self.remainder = lines.pop()
+            if b'\r' in data:  # Not just block, '\r' of the last line may be carried over
+                lines = [line.rstrip(b'\r') for line in lines]
+            self.lines = self.lines[self.pos:] + lines
+            self.pos = 0
+
+        lines = self.lines[self.pos:self.pos + n]
+        self.pos += len(lines)
+        return lines
+
+    def close(self):
+        self.handle.close()
+
+
+def read_name(header):
+    """(bytes) -> bytes
+    Return read name from FASTQ header without comments and read number.
+
+    >>> read_name(b'@HWI-D00331:196:C900FANXX:5:1101:1684:1993 1:N:0:ACGTCACA')
+    b'@HWI-D00331:196:C900FANXX:5:1101:1684:1993'
+    >>> read_name(b'@HWUSI-EAS100R:6:73:941:1973#ATCGAT/2')
+    b'@HWUSI-EAS100R:6:73:941:1973#ATCGAT'
+    """
+    name = header.split(None, 1)[0]
+    if name[-2:-1] == b'/':
+        name = name[:-2]
+
+    return name
+
+
+def check_pair(r1_header, r2_header):
+    """(bytes, bytes) -> None
+    Raise ValueError if Read 1 and Read 2 records are malformed or out of sync.
+    """
+    if r1_header[:1] != b'@' or r2_header[:1] != b'@':
+        raise ValueError("Records in FASTQ files should start with a '@' character. Files may be malformed or out of "
+                         "sync: {} {}".format(r1_header, r2_header))
+    if read_name(r1_header) != read_name(r2_header):
+        raise ValueError("Read names of Read 1 and Read 2 do not match. Files may be out of sync: {} {}".format(
+            r1_header, r2_header))
+
+
+def paired_batches(read1, read2, batch_size):
+    """(FastqReader, FastqReader, int) -> generator
+    Yield lists of FASTQ lines for Read 1 and Read 2 in batches of read pairs (4 lines per record).
+    """
+    while True:
+        r1_lines = read1.read_lines(batch_size * 4)
+        r2_lines = read2.read_lines(batch_size * 4)
+        if not r1_lines and not r2_lines:
+            return
+        if len(r1_lines) != len(r2_lines) or len(r1_lines) % 4 != 0:
+            raise ValueError("Read 1 and Read 2 FASTQ files contain a different number of reads or are truncated")
+        yield r1_lines, r2_lines
+
+
+def paired_records(read1, read2, batch_size=10000):
+    """(FastqReader, FastqReader, int) -> generator
+    Yield (title1, title2, seq1, seq2, qual1, qual2) of each read pair with names checked for synchronization.
+
+    Titles are returned without the leading '@'.
+    """
+    for r1_lines, r2_lines in paired_batches(read1, read2, batch_size):
+        for i in range(0, len(r1_lines), 4):
+            check_pair(r1_lines[i], r2_lines[i])
+            if r1_lines[i + 2][:1] != b'+' or r2_lines[i + 2][:1] != b'+':
+                raise ValueError("Quality header '+' missing. Files may be malformed or out of sync: {} {}".format(
+                    r1_lines[i], r2_lines[i]))
+            yield r1_lines[i][1:], r2_lines[i][1:], r1_lines[i + 1], r2_lines[i + 1], r1_lines[i + 3], r2_lines[i + 3]
+
+
+class BgzfWriter(object):
+    """Write BGZF (blocked gzip) compressed output.
+
+    Data is compressed in independent gzip members of up to 64 KB with the BGZF 'BC' extra field, followed by an empty
+    end-of-file block (see SAM specification, section 4.1).
+    """
+    BLOCK_DATA_SIZE = 65280
+    EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+    def __init__(self, filename, level=6):
+        self.handle = open(filename, 'wb')
+        self.level = level
+        self.buffer = []
+        self.buffer_size = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        if self.buffer_size >= self.BLOCK_DATA_SIZE:
+            data = b''.join(self.buffer)
+            end = len(data) - len(data) % self.BLOCK_DATA_SIZE
+            for start in range(0, end, self.BLOCK_DATA_SIZE):
+                self._write_block(data[start:start + self.BLOCK_DATA_SIZE])
+            self.buffer = [data[end:]]
+            self.buffer_size = len(data) - end
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        header = struct.pack('<BBBBIBBHBBHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25)
+        self.handle.write(header + compressed + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def close(self):
+        data = b''.join(self.buffer)
+        if data:
+            self._write_block(data)
+        self.handle.write(self.EOF_BLOCK)
+        self.handle.close()
+
+
+def open_output(filename, compress=False):
+    """(str, bool) -> file
+    Return binary output handle, BGZF compressed if compress is True.
+    """
+    if compress:
+        return BgzfWriter(filename)
+
+    return open(filename, 'wb')
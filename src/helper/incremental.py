@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Incremental Lanes
+#
+###############################################################
+# Function:
+# Add a new lane of a sample (e.g. a top-up run) to a previous SSCS_maker.py run without re-merging raw BAM files and
+# making consensus sequences of all families again. Reads of the lane are grouped into families and folded into the
+# families of the previous run kept in its family store (SSCS_maker.py --store). Only families that gained reads are
+# made into consensus reads again, and SSCS, singleton and bad read BAM files, stats and family sizes are patched.
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Changed families: families of the lane (consensus tags of read pairs completed in the lane), merged with stored
+#     families sharing their consensus tag. Families only found in the lane are new
+#   - Consensus reads of changed families replace the previous ones (matched by query name "<consensus tag>:<size>")
+#     in the SSCS and singleton BAM files. Coordinate-sorted BAM files (e.g. "sscs.sorted.bam") stay sorted, and BAM
+#     (.bai) and family indexes (.fidx.npy) are rebuilt if present
+#   - Stats of later stages are removed from "stats.txt", as DCS_maker.py and singleton_correction.py are rerun on
+#     the patched BAM files (they take collapsed reads, which are a fraction of the raw reads)
+#   - Family store is updated with the merged families (unchanged families are copied column by column), so further
+#     lanes can be added. The updated store replaces the previous one once complete (the previous store is moved aside
+#     and removed after)
+#   - Lane reads are swept in coordinate chunks twice (see lane_families): first for consensus tags of changed
+#     families, then to merge and make consensus reads of families completed in each chunk. Consensus tags are kept as
+#     sorted arrays of digests and consensus reads are sorted through temporary BAM files next to the prefix (see
+#     consensus_helper.SortedBamWriter), so memory doesn't grow with the number of lane reads
+#   - Lane reads must be coordinate-sorted, with the same references as the previous run
+#   - Stores made with --umi_cluster or --targets aren't supported, as adding reads to a family can change clusters of
+#     neighbouring families and lane reads aren't restricted to targets
+#
+# Usage:
+# python3 incremental.py --store STORE --lane LANE --sscs SSCS --singleton SINGLETON --prefix PREFIX --cutoff CUTOFF
+#                        [--collapsed] [--seed SEED]
+#
+# Arguments:
+# --store STORE         Family store directory of previous run (SSCS_maker.py --store)
+# --lane LANE           Coordinate-sorted BAM file of new lane (uncollapsed reads with barcodes, as input of SSCS_maker)
+# --sscs SSCS           SSCS BAM file of previous run (e.g. "sample.sscs.sorted.bam"), patched in place
+# --singleton SINGLETON Singleton BAM file of previous run (e.g. "sample.singleton.sorted.bam"), patched in place
+# --prefix PREFIX       Prefix of stats, bad read and family size files of previous run (SSCS_maker.py --prefix)
+# --cutoff CUTOFF       Consensus cutoff of previous run
+# --collapsed           Previous run was made with --collapsed
+# --seed SEED           Deterministic mode with given seed (see SSCS_maker.py --seed)
+#
+# Outputs:
+# Patched SSCS, singleton and bad read ("badReads.bam") BAM files, "stats.txt", "read_families.txt" and family store.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import collections
+import hashlib
+import heapq
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import numpy as np
+import pysam
+
+from consensus_helper import *
+from family_store import FamilyStore, FamilyStoreWriter, input_digest, COPY_CHUNK
+from SSCS_maker import consensus_maker
+
+
+###############################
+#          Functions          #
+###############################
+class NullWriter(object):
+    """Writer discarding reads (bad reads of the first sweep of the lane)."""
+    def write(self, read):
+        pass
+
+
+def lane_families(bamfile, umi_tag=None, bad_reads=NullWriter(), counters=None):
+    """(pysam.AlignmentFile, str, pysam.AlignmentFile, list) -> generator
+    Yield families of read pairs completed in each coordinate chunk of lane ([(consensus_tag, [(tag, reads),
+    (tag, reads)])]) with the streaming watermark after the chunk (see stream_watermark), writing bad reads to bad_reads
+    and adding read counters (total, unmapped, multiple mapping) to counters.
+    """
+    read_dict = collections.OrderedDict()
+    tag_dict = collections.defaultdict(int)
+    pair_dict = collections.defaultdict(list)
+    csn_pair_dict = collections.defaultdict(list)
+
+    for chunk in chunk_reads(bamfile.fetch(until_eof=True)):
+        chr_data = read_bam(None,
+                            read_dict=read_dict,
+                            tag_dict=tag_dict,
+                            pair_dict=pair_dict,
+                            csn_pair_dict=csn_pair_dict,
+                            badRead_bam=bad_reads,
+                            duplex=None,
+                            bam_lines=chunk,
+                            barcode_tag=umi_tag)
+        if counters is not None:
+            for i in range(3):
+                counters[i] += chr_data[4 + i]
+
+        families = []
+        for readPair in list(csn_pair_dict.keys()):
+            if len(csn_pair_dict[readPair]) == 2:
+                tags = csn_pair_dict.pop(readPair)
+                for tag in tags:
+                    del tag_dict[tag]
+                families.append((readPair, [(tag, read_dict.pop(tag)) for tag in tags]))
+
+        yield families, stream_watermark(pair_dict, chunk, STREAM_MAX_DISTANCE)
+
+
+def tag_digests(consensus_tags):
+    """(iterable) -> numpy.ndarray
+    Return array of 16-byte digests of consensus tags (compared and sorted in place of the tags).
+    """
+    return np.array([hashlib.md5(consensus_tag.encode()).digest() for consensus_tag in consensus_tags], dtype='S16')
+
+
+def in_sorted(values, sorted_values):
+    """(numpy.ndarray, numpy.ndarray) -> numpy.ndarray
+    Return boolean mask of values found in sorted array.
+
+    >>> in_sorted(np.array([b'b', b'd', b'e']), np.array([b'a', b'b', b'c', b'e']))
+    array([ True, False,  True])
+    """
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    index = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[index] == values
+
+
+def family_size(reads, collapsed=False):
+    """(list, bool) -> int
+    Return number of reads in family (sum of XF tags for provisional consensus reads).
+    """
+    return sum(read.get_tag('XF') for read in reads) if collapsed else len(reads)
+
+
+def consensus_name(read):
+    """(pysam.calignedsegment.AlignedSegment) -> str
+    Return consensus tag of SSCS or singleton query name (e.g. TTTG_24_58847416_24_58847448_137M10S_147M_pos:5).
+    """
+    return read.query_name.rsplit(':', 1)[0]
+
+
+def kept_reads(bam, replaced, batch_size=10000):
+    """(pysam.AlignmentFile, numpy.ndarray) -> generator
+    Yield reads of BAM file whose consensus tags aren't replaced (sorted digests, see tag_digests).
+    """
+    iterator = bam.fetch(until_eof=True)
+    while True:
+        reads = list(itertools.islice(iterator, batch_size))
+        if not reads:
+            return
+        yield from itertools.compress(reads, ~in_sorted(tag_digests(consensus_name(read) for read in reads), replaced))
+
+
+def patch_bam(filename, reads, replaced=np.zeros(0, dtype='S16')):
+    """(str, iterable, numpy.ndarray) -> int, int
+    Replace reads of BAM file with consensus tags in replaced (sorted digests, see tag_digests) by reads (coordinate
+    sorted, merged in coordinate order if the BAM file is coordinate-sorted), and return number of reads and N bases in
+    patched file. Indexes are rebuilt if present.
+    """
+    patched_file = '{}.patch.bam'.format(filename.rsplit('.bam', 1)[0])
+    read_count = 0
+    n_bases = 0
+    with pysam.AlignmentFile(filename, "rb", check_sq=False) as bam:
+        kept = kept_reads(bam, replaced)
+        if bam.header.to_dict().get('HD', {}).get('SO') == 'coordinate':
+            patched = heapq.merge(kept, reads, key=read_coordinate)
+        else:
+            patched = itertools.chain(kept, reads)
+
+        with pysam.AlignmentFile(patched_file, "wb", template=bam) as patched_bam:
+            for read in patched:
+                patched_bam.write(read)
+                read_count += 1
+                n_bases += (read.query_sequence or '').count('N')
+    os.replace(patched_file, filename)
+
+    if os.path.exists(filename + '.bai'):
+        pysam.index(filename)
+    if os.path.exists(filename + '.fidx.npy'):
+        from family_index import build_index
+        build_index(filename)
+
+    return read_count, n_bases
+
+
+def temporary_reads(filename):
+    """(str) -> generator
+    Yield reads of temporary BAM file.
+    """
+    with pysam.AlignmentFile(filename, "rb", check_sq=False) as bam:
+        yield from bam.fetch(until_eof=True)
+
+
+def read_family_sizes(filename):
+    """(str) -> Counter
+    Return tag family sizes and their frequencies from "read_families.txt".
+    """
+    family_sizes = collections.Counter()
+    with open(filename) as f:
+        next(f)
+        for line in f:
+            if line.strip():
+                size, frequency = line.split('\t')
+                family_sizes[int(size)] += int(frequency)
+
+    return family_sizes
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--store", action="store", dest="store", help="Family store directory of previous run",
+                        required=True)
+    parser.add_argument("--lane", action="store", dest="lane", help="Coordinate-sorted BAM file of new lane",
+                        required=True)
+    parser.add_argument("--sscs", action="store", dest="sscs", help="SSCS BAM file of previous run (patched in place)",
+                        required=True)
+    parser.add_argument("--singleton", action="store", dest="singleton",
+                        help="Singleton BAM file of previous run (patched in place)", required=True)
+    parser.add_argument("--prefix", action="store", dest="prefix",
+                        help="Prefix of stats, bad read and family size files of previous run", required=True)
+    parser.add_argument("--cutoff", action="store", dest="cutoff", type=float,
+                        help="Consensus cutoff of previous run", required=True)
+    parser.add_argument("--collapsed", action="store_true", dest="collapsed",
+                        help="Previous run was made with --collapsed")
+    parser.add_argument("--seed", action="store", dest="seed", type=int,
+                        help="Deterministic mode: break ties of consensus read fields with given seed", required=False)
+    args = parser.parse_args()
+
+    store = FamilyStore(args.store)
+    if store.meta is None:
+        sys.exit("No complete family store in {} (see SSCS_maker.py --store)".format(args.store))
+    params = store.meta['params']
+    if params.get('umi_cluster') or params.get('targets') is not None:
+        sys.exit("Stores made with --umi_cluster or --targets can't be updated incrementally")
+
+    if args.seed is not None:
+        set_tie_seed(args.seed)
+
+    # ===== Consensus tags of lane families =====
+    sscs_bam = pysam.AlignmentFile(args.sscs, "rb", check_sq=False)
+    header = sscs_bam.header
+    lane_bam = pysam.AlignmentFile(args.lane, "rb", check_sq=False)
+    if lane_bam.references != header.references:
+        sys.exit("References of {} don't match the previous run".format(args.lane))
+    changed = [tag_digests([])]
+    for families, _ in lane_families(lane_bam, params.get('umi_tag')):
+        changed.append(tag_digests(consensus_tag for consensus_tag, tags in families))
+    changed = np.unique(np.concatenate(changed))  # sorted digests
+
+    # ===== Stored families sharing consensus tags with lane families =====
+    # Digests of changed stored families, sorted with their store index (in store order for the same consensus tag)
+    changed_mask = np.zeros(store.meta['families'], dtype=bool)
+    stored_digests = [tag_digests([])]
+    for start in range(0, store.meta['families'], COPY_CHUNK):
+        end = min(start + COPY_CHUNK, store.meta['families'])
+        digests = tag_digests(store._strings('consensus_tags', start, end))
+        changed_mask[start:end] = in_sorted(digests, changed)
+        stored_digests.append(digests[changed_mask[start:end]])
+    stored_digests = np.concatenate(stored_digests)
+    order = np.argsort(stored_digests, kind='stable')
+    stored_digests, stored_index = stored_digests[order], np.flatnonzero(changed_mask)[order]
+
+    # ===== Merge and make consensus of changed families by lane chunk =====
+    digest = hashlib.sha1((store.meta['digest'] + input_digest(args.lane, params)).encode()).hexdigest()
+    store_writer = FamilyStoreWriter('{}.incremental'.format(args.store.rstrip('/')), digest, params)
+    store_writer.add_stored(store, ~changed_mask)
+
+    tmpdir = tempfile.mkdtemp(prefix='incremental_', dir=os.path.dirname(os.path.abspath(args.prefix)))
+    sscs_writer = SortedBamWriter(pysam.AlignmentFile(os.path.join(tmpdir, 'sscs.bam'), "wb", template=sscs_bam),
+                                  sscs_bam, tmpdir)
+    singleton_writer = SortedBamWriter(pysam.AlignmentFile(os.path.join(tmpdir, 'singleton.bam'), "wb",
+                                                           template=sscs_bam), sscs_bam, tmpdir)
+    bad_bam = pysam.AlignmentFile(os.path.join(tmpdir, 'badReads.bam'), "wb", template=sscs_bam)
+    sscs_bam.close()
+
+    lane_counters = [0, 0, 0]
+    lane_bam.reset()
+    stored_sizes = collections.Counter()
+    merged_sizes = collections.Counter()
+    changed_families = 0
+    read_length = None
+    for families, watermark in lane_families(lane_bam, params.get('umi_tag'), bad_bam, lane_counters):
+        for consensus_tag, lane_tags in families:
+            merged = collections.OrderedDict()
+            tag_digest = tag_digests([consensus_tag])[0]
+            lower, upper = (np.searchsorted(stored_digests, tag_digest, side=side) for side in ('left', 'right'))
+            for index in stored_index[lower:upper]:
+                stored_tag, tag, reads = store.family(header, int(index))
+                if stored_tag == consensus_tag:
+                    merged[tag] = reads
+                    stored_sizes[family_size(reads, args.collapsed)] += 1
+            for tag, reads in lane_tags:
+                merged.setdefault(tag, []).extend(reads)
+
+            for tag, reads in merged.items():
+                store_writer.add_family(consensus_tag, tag, reads)
+                size = family_size(reads, args.collapsed)
+                merged_sizes[size] += 1
+                changed_families += 1
+                query_name = '{}:{}'.format(consensus_tag, size)
+                if read_length is None:
+                    read_length = reads[0].infer_query_length()
+
+                if size == 1:
+                    reads[0].query_name = query_name
+                    singleton_writer.write(reads[0])
+                else:
+                    consensus_seq, consensus_qual = consensus_maker(reads, args.cutoff, read_length)
+                    sscs_writer.write(create_aligned_segment(reads, consensus_seq, consensus_qual, query_name))
+
+        sscs_writer.flush(watermark)
+        singleton_writer.flush(watermark)
+    lane_bam.close()
+    sscs_writer.close()
+    singleton_writer.close()
+    bad_bam.close()
+
+    # ===== Patch outputs =====
+    SSCS_count, N_bases = patch_bam(args.sscs, temporary_reads(os.path.join(tmpdir, 'sscs.bam')), changed)
+    singletons = patch_bam(args.singleton, temporary_reads(os.path.join(tmpdir, 'singleton.bam')), changed)[0]
+    patch_bam('{}.badReads.bam'.format(args.prefix), temporary_reads(os.path.join(tmpdir, 'badReads.bam')))
+
+    counters = store.meta['stats']
+    counter = counters['counter'] + lane_counters[0]
+    unmapped = counters['unmapped'] + lane_counters[1]
+    multiple_mapping = counters['multiple_mapping'] + lane_counters[2]
+    summary_stats = '''# === SSCS MAKER ===
+Consensus cut-off: {}
+Uncollapsed - Total reads: {}
+Uncollapsed - Unmapped reads: {}
+Uncollapsed - Secondary/Supplementary reads: {}
+SSCS reads: {}
+SSCS N bases: {}
+Singletons: {} \n'''.format(args.cutoff, counter, unmapped, multiple_mapping, SSCS_count, N_bases, singletons)
+    # Stats of DCS_maker.py and singleton_correction.py are dropped, as they're rerun on patched files
+    with open('{}.stats.txt'.format(args.prefix), 'w') as stats:
+        stats.write(summary_stats)
+    print(summary_stats)
+    print('Families changed: {} (new: {})'.format(changed_families, changed_families - int(changed_mask.sum())))
+
+    family_sizes = read_family_sizes('{}.read_families.txt'.format(args.prefix))
+    family_sizes.subtract(stored_sizes)
+    family_sizes.update(merged_sizes)
+    with open('{}.read_families.txt'.format(args.prefix), 'w') as stat_file:
+        stat_file.write('family_size\tfrequency\n')
+        stat_file.write('\n'.join('%s\t%s' % x for x in sorted(family_sizes.items()) if x[1] > 0))
+
+    # ===== Update family store =====
+    store_writer.close({'counter': counter, 'unmapped': unmapped, 'multiple_mapping': multiple_mapping},
+                       temporary_reads(os.path.join(tmpdir, 'badReads.bam')), stored_bad_reads=store)
+    shutil.rmtree(tmpdir)
+    # Previous store is only removed once the updated store is in its place
+    previous_store = '{}.previous'.format(args.store.rstrip('/'))
+    os.rename(args.store, previous_store)
+    os.rename(store_writer.directory, args.store)
+    shutil.rmtree(previous_store)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Partition
+#
+###############################################################
+# Function:
+# Hash partitioning of a sample for running SSCS_maker.py, DCS_maker.py and singleton_correction.py on separate nodes,
+# independent of genome layout (unlike regions of bed_separator).
+# - scatter: assign every read pair to one of N partition BAM files by a stable hash of its family key
+# - gather: merge outputs and stats of partitions into outputs of the whole sample
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Family key of a read pair is its consensus tag (see consensus_helper.sscs_qname and cigar_order, coordinates and
+#     cigars are ordered the same way for both reads and both strands) with the strand removed and the barcode
+#     replaced by the lower of the barcode and its duplex barcode, so duplex complements (needed by DCS_maker.py and
+#     singleton_correction.py) share the key. Translocated pairs are kept together as keys are made from pairs
+#   - Partition: CRC32 of family key modulo number of partitions (stable across runs and machines)
+#   - With --umi_cluster, the key has no barcode, so families with barcodes clustered by SSCS_maker.py --umi_cluster
+#     (same coordinates) are in the same partition
+#   - Reads filtered by SSCS_maker.py (unmapped, multiple mapping) and reads whose mate is missing are assigned by hash
+#     of query name, so read counters sum up to those of the whole sample
+#   - Partition BAM files are coordinate-sorted (reads are released below the streaming watermark, see
+#     consensus_helper.stream_watermark) and indexed. Pairs pending for more than STREAM_MAX_DISTANCE (e.g. mates on
+#     another chromosome) do not hold back the watermark: their reads are spilled to temporary files next to the
+#     partitions and merged in on close (see consensus_helper.SortedBamWriter)
+#   - Gather merges each BAM file type (e.g. "dcs.bam") of partitions: sorted files ("*.sorted.bam") by coordinate
+#     (and indexed), others by concatenation. Counts in "stats.txt" and "read_families.txt" are summed (family sizes
+#     kept in order of family size), and percentages are recomputed from the summed counts
+#
+# Usage:
+# python3 partition.py --mode scatter --infile INFILE --partitions N --prefix PREFIX [--umi_tag UMITAG] [--umi_cluster]
+# python3 partition.py --mode gather --partition_prefixes PREFIX [PREFIX ...] --prefix PREFIX
+#
+# Arguments:
+# --mode MODE           scatter: split input BAM file into partitions; gather: merge outputs of partitions
+# --infile INFILE       Coordinate-sorted input BAM file (as input of SSCS_maker.py, scatter mode)
+# --partitions N        Number of partitions (scatter mode)
+# --prefix PREFIX       Prefix of partition BAM files ("<prefix>.part<i>.bam", scatter mode) or merged outputs (gather
+#                       mode)
+# --umi_tag UMITAG      Tag containing molecular barcode (e.g. RX) instead of query name (as SSCS_maker.py --umi_tag)
+# --umi_cluster         Partitions for SSCS_maker.py --umi_cluster (families at the same coordinates are kept together)
+# --partition_prefixes  Prefixes of outputs of each partition (e.g. "sample.part0"), gather mode
+#
+# Example:
+# python3 partition.py --mode scatter --infile sample.bam --partitions 4 --prefix sample
+# (on each node) SSCS_maker.py --infile sample.part<i>.bam --outfile sample.part<i>.sscs.bam ..., DCS_maker.py ...
+# python3 partition.py --mode gather --partition_prefixes sample.part0 sample.part1 sample.part2 sample.part3 \
+#     --prefix sample
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import collections
+import glob
+import heapq
+import itertools
+import os
+import re
+import zlib
+import pysam
+
+from consensus_helper import *
+
+
+# Flags of reads with unmapped mates (see read_bam)
+MATE_UNMAPPED = [73, 89, 121, 153, 185, 137]
+
+
+###############################
+#          Functions          #
+###############################
+def family_key(read, mate, barcode, umi_cluster=False):
+    """(pysam.calignedsegment.AlignedSegment, pysam.calignedsegment.AlignedSegment, str, bool) -> str
+    Return family key of read pair shared with its duplex complement: consensus tag without strand, with the lower of
+    barcode and duplex barcode (no barcode with umi_cluster).
+    """
+    consensus_tag = sscs_qname(read, mate, barcode, cigar_order(read, mate))
+    position = consensus_tag.split('_', 1)[1].rsplit('_', 1)[0]
+    if umi_cluster:
+        return position
+
+    barcode_bases = int(len(barcode) / 2)
+    return '{}_{}'.format(min(barcode, barcode[barcode_bases:] + barcode[:barcode_bases]), position)
+
+
+def partition(key, partitions):
+    """(str, int) -> int
+    Return partition of key.
+
+    >>> partition('ACAA_0_7768_0_7898_50M_50M', 4)
+    2
+    """
+    return zlib.crc32(key.encode()) % partitions
+
+
+def is_bad_read(read):
+    """(pysam.calignedsegment.AlignedSegment) -> bool
+    Return True for reads filtered out of consensus making by read_bam (unmapped, mate unmapped, multiple mapping).
+    """
+    return read.is_unmapped or read.flag in MATE_UNMAPPED or read.is_secondary or read.is_supplementary
+
+
+def scatter(bamfile, prefix, partitions, barcode_tag=None, umi_cluster=False):
+    """(pysam.AlignmentFile, str, int, str, bool) -> tuple
+    Write read pairs of coordinate-sorted BAM file to partition BAM files, and return number of reads in each partition
+    and peak number of reads buffered by a partition writer.
+    """
+    filenames = ['{}.part{}.bam'.format(prefix, i) for i in range(partitions)]
+    directory = os.path.dirname(os.path.abspath(prefix))
+    writers = [SortedBamWriter(pysam.AlignmentFile(filename, "wb", template=bamfile), bamfile, directory)
+               for filename in filenames]
+    counts = [0] * partitions
+    buffered = 0
+    pair_dict = collections.OrderedDict()
+
+    def write(reads, i):
+        for read in reads:
+            writers[i].write(read)
+        counts[i] += len(reads)
+
+    for chunk in stream_chunks(bamfile):
+        for read in chunk:
+            if is_bad_read(read):
+                write([read], partition(read.query_name, partitions))
+            elif read.query_name not in pair_dict:
+                pair_dict[read.query_name] = [read]
+            else:
+                read_1, mate = pair_dict.pop(read.query_name)[0], read
+                barcode = read_1.get_tag(barcode_tag) if barcode_tag is not None else read_1.query_name.split('|')[1]
+                write([read_1, mate], partition(family_key(read_1, mate, barcode, umi_cluster), partitions))
+
+        watermark = stream_watermark(pair_dict, chunk, STREAM_MAX_DISTANCE)
+        for writer in writers:
+            buffered = max(buffered, writer.flush(watermark))
+
+    # Reads whose mate is missing
+    for query_name, reads in pair_dict.items():
+        write(reads, partition(query_name, partitions))
+
+    for writer, filename in zip(writers, filenames):
+        writer.close()
+        pysam.index(filename)
+
+    return counts, buffered
+
+
+def merge_bams(filenames, outfile):
+    """(list, str) -> None
+    Merge BAM files, by coordinate for sorted BAM files ("*.sorted.bam", indexed after merging), otherwise by
+    concatenation.
+    """
+    bams = [pysam.AlignmentFile(filename, "rb", check_sq=False) for filename in filenames]
+    reads = [bam.fetch(until_eof=True) for bam in bams]
+    is_sorted = outfile.endswith('.sorted.bam')
+
+    with pysam.AlignmentFile(outfile, "wb", template=bams[0]) as merged:
+        for read in heapq.merge(*reads, key=read_coordinate) if is_sorted else itertools.chain(*reads):
+            merged.write(read)
+    for bam in bams:
+        bam.close()
+
+    if is_sorted:
+        pysam.index(outfile)
+
+
+def read_stats(filename):
+    """(str) -> list
+    Return blocks of stats file as lists of (label, value, suffix) lines, with block headers (e.g. '# === DCS ===') as
+    (header, None, '').
+    """
+    lines = []
+    with open(filename) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            match = re.match(r'(.*?): (\S+)(\s*)$', line)
+            if match is None:
+                lines.append((line, None, ''))
+            else:
+                lines.append(match.groups())
+
+    return lines
+
+
+def merge_stats(stats):
+    """(list) -> str
+    Return stats file of summed counts from stats of partitions (see read_stats). Cutoffs are kept and percentages
+    (e.g. % Singleton Correction by SSCS) are recomputed as the previous count over the first count of the block
+    (e.g. Total singletons).
+
+    >>> merge_stats([[('# === X ===', None, ''), ('Consensus cut-off', '0.7', ''), ('Total', '4', ''),
+    ...               ('Corrected', '1', ''), ('% Corrected', '25.0', ' ')],
+    ...              [('# === X ===', None, ''), ('Consensus cut-off', '0.7', ''), ('Total', '4', ''),
+    ...               ('Corrected', '2', ''), ('% Corrected', '50.0', ' ')]])
+    '# === X ===\\nConsensus cut-off: 0.7\\nTotal: 8\\nCorrected: 3\\n% Corrected: 37.5 \\n'
+    """
+    merged = []
+    counts = []  # values of current block
+    for lines in zip(*stats):
+        label, value, suffix = lines[0]
+        if value is None:
+            merged.append(label)
+            counts = []
+            continue
+
+        if label == 'Consensus cut-off':
+            merged.append('{}: {}{}'.format(label, value, suffix))
+            continue
+
+        if label.startswith('%'):
+            value = (counts[-1] / counts[0]) * 100
+        else:
+            value = sum(int(line[1]) for line in lines)
+        counts.append(value)
+        merged.append('{}: {}{}'.format(label, value, suffix))
+
+    return '\n'.join(merged) + '\n'
+
+
+def merge_family_sizes(filenames):
+    """(list) -> list
+    Return summed (family size, frequency) pairs of "read_families.txt" files, by family size.
+    """
+    family_sizes = collections.Counter()
+    for filename in filenames:
+        with open(filename) as f:
+            next(f)
+            for line in f:
+                if line.strip():
+                    size, frequency = line.split('\t')
+                    family_sizes[int(size)] += int(frequency)
+
+    return sorted(family_sizes.items())
+
+
+def gather(prefixes, prefix):
+    """(list, str) -> list
+    Merge BAM files, stats and family sizes of partition outputs (by prefix), and return merged BAM file types.
+    """
+    suffixes = sorted(filename[len(prefixes[0]) + 1:] for filename in glob.glob('{}.*.bam'.format(prefixes[0])))
+    for suffix in suffixes:
+        merge_bams(['{}.{}'.format(partition_prefix, suffix) for partition_prefix in prefixes],
+                   '{}.{}'.format(prefix, suffix))
+
+    with open('{}.stats.txt'.format(prefix), 'w') as stats:
+        stats.write(merge_stats([read_stats('{}.stats.txt'.format(partition_prefix))
+                                 for partition_prefix in prefixes]))
+
+    with open('{}.read_families.txt'.format(prefix), 'w') as stat_file:
+        stat_file.write('family_size\tfrequency\n')
+        stat_file.write('\n'.join('%s\t%s' % x for x in merge_family_sizes(
+            ['{}.read_families.txt'.format(partition_prefix) for partition_prefix in prefixes])))
+
+    return suffixes
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--mode", action="store", dest="mode", choices=['scatter', 'gather'], required=True,
+                        help="Split input BAM file into partitions (scatter) or merge outputs of partitions (gather)")
+    parser.add_argument("--infile", action="store", dest="infile", help="Coordinate-sorted input BAM file")
+    parser.add_argument("--partitions", action="store", dest="partitions", type=int, help="Number of partitions")
+    parser.add_argument("--prefix", action="store", dest="prefix",
+                        help="Prefix of partition BAM files (scatter) or merged outputs (gather)", required=True)
+    parser.add_argument("--umi_tag", action="store", dest="umi_tag",
+                        help="Tag containing molecular barcode (e.g. RX) instead of query name", required=False)
+    parser.add_argument("--umi_cluster", action="store_true", dest="umi_cluster",
+                        help="Keep families at the same coordinates together (for SSCS_maker.py --umi_cluster)")
+    parser.add_argument("--partition_prefixes", action="store", dest="partition_prefixes", nargs='+',
+                        help="Prefixes of outputs of each partition (gather)")
+    args = parser.parse_args()
+
+    if args.mode == 'scatter':
+        if args.infile is None or args.partitions is None or args.partitions < 1:
+            parser.error("scatter requires --infile and --partitions (1 or more)")
+        with pysam.AlignmentFile(args.infile, "rb", check_sq=False) as bamfile:
+            counts, buffered = scatter(bamfile, args.prefix, args.partitions, args.umi_tag, args.umi_cluster)
+        for i, count in enumerate(counts):
+            print('{}.part{}.bam: {} reads'.format(args.prefix, i, count))
+        print('Peak buffered reads: {}'.format(buffered))
+    else:
+        if args.partition_prefixes is None:
+            parser.error("gather requires --partition_prefixes")
+        for suffix in gather(args.partition_prefixes, args.prefix):
+            print('{}.{}'.format(args.prefix, suffix))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                          Profiler
+#
+###############################################################
+# Function:
+# Profiling of consensus making and barcode extraction (--profile), to find where time is spent in long runs
+# (e.g. consensus_maker, read_bam tag construction or BAM compression).
+#
+# Written for Python 3.5.1
+#
+# Concepts:
+#   - Deterministic profile of the whole run with cProfile, written as pstats ("profile.pstats"), which can be read with
+#     'python3 -m pstats' or snakeviz
+#   - Stack sampling on CPU time (SIGPROF timer), with each sampled stack rooted at the active named scope (phase, e.g.
+#     decode/group/consensus/write, see consensus_helper.RegionMetrics). Stacks of background threads are rooted at
+#     their thread name. Samples are written as collapsed stacks ("profile.collapsed": 'scope;frame;frame count'),
+#     the input format of flamegraph.pl and speedscope
+#   - Only imported when --profile is set, so there's no overhead when profiling is disabled
+#   - Worker processes (e.g. extract_barcodes.py --threads) are not profiled
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+import cProfile
+import collections
+import os
+import signal
+import sys
+import threading
+
+
+###############################
+#          Functions          #
+###############################
+def frame_name(frame):
+    """(frame) -> str
+    Return function name and location of stack frame for collapsed stacks.
+    """
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Profiler(object):
+    """cProfile profile and scope-rooted stack samples of a run, written to "<prefix>.profile.pstats" and
+    "<prefix>.profile.collapsed" by stop().
+
+    The active scope is set with the scope attribute (or scoped() for iterators).
+    """
+    def __init__(self, prefix, interval=0.005):
+        self.prefix = prefix
+        self.interval = interval
+        self.scope = 'other'
+        self.profile = cProfile.Profile()
+        self.stacks = collections.Counter()
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.profile.enable()
+
+    def _sample(self, signum, frame):
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, thread_frame in sys._current_frames().items():
+            if ident == threading.main_thread().ident:
+                # Skip sampler frame
+                thread_frame, root = frame, self.scope
+            else:
+                root = 'thread:{}'.format(thread_names.get(ident, ident))
+            stack = []
+            while thread_frame is not None:
+                stack.append(frame_name(thread_frame))
+                thread_frame = thread_frame.f_back
+            stack.append(root)
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def scoped(self, iterable, scope):
+        """Yield items from iterable, with iteration (e.g. lazy map over batches) charged to scope."""
+        iterator = iter(iterable)
+        while True:
+            previous, self.scope = self.scope, scope
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.scope = previous
+            yield item
+
+    def stop(self):
+        """Stop profiling and write pstats and collapsed stack files."""
+        self.profile.disable()
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+        self.profile.dump_stats('{}.profile.pstats'.format(self.prefix))
+        with open('{}.profile.collapsed'.format(self.prefix), 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
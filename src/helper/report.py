@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                           Report
+#
+###############################################################
+# Function:
+# To plot the tag family size distribution of a sample from the family size table written by SSCS_maker.py. Plotting
+# is a separate step so matplotlib is only loaded for reports, not when making consensus sequences.
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 report.py [--prefix PREFIX]
+#
+# Arguments:
+# --prefix PREFIX     Sample prefix used by SSCS_maker.py (e.g. output/sample for output/sample.sscs.bam)
+#
+# Inputs:
+# 1. A text file of tag family sizes and their frequencies - "read_families.txt"
+#
+# Outputs:
+# 1. A tag family size distribution plot (x-axis: family size, y-axis: fraction of reads) - "tag_fam_size.png"
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import math
+
+
+###############################
+#          Functions          #
+###############################
+def read_families(filename):
+    """(str) -> list
+    Return list of (family size, frequency) in order of family size table.
+    """
+    with open(filename) as f:
+        next(f)  # header
+        return [tuple(int(x) for x in line.split('\t')) for line in f if line.strip()]
+
+
+def read_fractions(families):
+    """(list) -> list
+    Return fraction of reads in each family size (family size * frequency of family / total reads).
+
+    >>> read_fractions([(1, 6), (2, 1)])
+    [0.75, 0.25]
+    """
+    total_reads = sum(size * frequency for size, frequency in families)
+    return [(size * frequency)/total_reads for size, frequency in families]
+
+
+def plot_family_sizes(families, outfile):
+    """Plot fraction of reads in each family size."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    plt.bar([size for size, frequency in families], read_fractions(families))
+    # Determine read family size range to standardize plot axis
+    plt.xlim([0, math.ceil(families[-1][0]/10) * 10])
+    plt.savefig(outfile)
+    plt.close()
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--prefix", action="store", dest="prefix",
+                        help="Sample prefix used by SSCS_maker.py (e.g. output/sample)", required=True)
+    args = parser.parse_args()
+
+    families = read_families('{}.read_families.txt'.format(args.prefix))
+    if not families:
+        print('No read families in {}.read_families.txt'.format(args.prefix))
+        return
+
+    plot_family_sizes(families, '{}_tag_fam_size.png'.format(args.prefix))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,12 +14,36 @@
 # Written for Python 3.5.1
 #
 # Usage:
-# Python3 singleton_correction.py [--singleton Singleton BAM] [--bedfile BEDFILE]
+# Python3 singleton_correction.py [--singleton Singleton BAM] [--sscs SSCS BAM] [--prefix PREFIX] [--bedfile BEDFILE]
+#                                  [--targets TARGETS] [--padding PADDING] [--offtarget] [--profile] [--seed SEED]
+#                                  [--family_table [FORMAT]] [--family_index]
 #
 # Arguments:
 # --singleton SingletonBAM  input singleton BAM file
+# --sscs SSCSBAM            SSCS BAM file to correct singletons with (Default: singleton BAM file with '.singleton'
+#                           replaced by '.sscs'). Singletons of SSCS_maker.py runs with multiple cutoffs are shared by
+#                           all cutoffs ("<prefix>.singleton.bam"), and corrected with the SSCS BAM file of each cutoff
+#                           (e.g. --sscs sample_cutoff0.7.sscs.sorted.bam --prefix sample_cutoff0.7)
+# --prefix PREFIX           Prefix of output, stats and metrics files (Default: singleton BAM file without
+#                           '.singleton' extension)
 # --bedfile BEDFILE         Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt -
 #                           See bed_separator.R for making your own bed file based on specific coordinates)
+# --targets TARGETS         Target panel BED file (e.g. hybrid capture intervals). Intervals are padded and merged, and
+#                           only target regions are fetched from the BAM files instead of the whole genome (replaces
+#                           --bedfile)
+# --padding PADDING         Number of bases added to each side of target intervals [0]
+# --offtarget               Also process regions outside targets, with off-target read pairs written to separate BAM
+#                           files (".offtarget.bam", e.g. "uncorrected.offtarget.bam")
+# --profile                 Profile run, writing cProfile stats ("singleton_correction.profile.pstats") and collapsed
+#                           stacks rooted at each phase (decode/group/consensus/write) for flame graphs
+#                           ("singleton_correction.profile.collapsed"), see profiler.py
+# --seed SEED               Deterministic mode: ties in consensus read fields are broken with given seed instead of
+#                           randomly (see SSCS_maker.py)
+# --family_table FMT        Write a table with one row per singleton (outcome SSCS_corrected, singleton_corrected or
+#                           uncorrected) as Parquet (default), Arrow IPC or compressed TSV
+#                           ("singleton_correction.families.parquet"/".arrow"/".tsv.gz"), see family_table.py
+# --family_index            Index corrected and uncorrected BAM files by family key (barcode and coordinates) to BGZF
+#                           virtual offsets ("<bam>.fidx.npy") for lookups with family_index.py
 #
 # Inputs:
 # 1. A position-sorted BAM file containing paired-end single reads with barcode identifiers in the header/query name
@@ -33,6 +57,8 @@
 # 4. A text file containing summary statistics (Total singletons, Singleton Correction by SSCS, % Singleton Correction by SSCS,
 #    Singleton Correction by Singletons, % Singleton Correction by Singletons, Uncorrected Singletons)
 #    - "stats.txt" (Stats pended to same stats file as SSCS)
+# 5. A JSON lines file with per-region metrics and a stage summary - "metrics.jsonl" (Pended to same metrics file as
+#    SSCS, see SSCS_maker.py)
 #
 # Concepts:
 #    - Read family: reads that share the same molecular barcode, chr, and start
@@ -119,29 +145,93 @@ def main():
     parser = ArgumentParser()
     parser.add_argument("--singleton", action="store", dest="singleton", help="input singleton BAM file",
                         required=True, type=str)
+    parser.add_argument("--sscs", action="store", dest="sscs",
+                        help="SSCS BAM file (Default: singleton BAM file with '.singleton' replaced by '.sscs')")
+    parser.add_argument("--prefix", action="store", dest="prefix",
+                        help="Prefix of output files (Default: singleton BAM file without '.singleton' extension)")
     parser.add_argument("--bedfile", action="store", dest="bedfile",
                         help="Bedfile containing coordinates to subdivide the BAM file (Recommendation: cytoband.txt - \
                         See bed_separator.R for making your own bed file based on a target panel/specific coordinates)",
                         required=False)
+    parser.add_argument("--targets", action="store", dest="targets",
+                        help="Target panel BED file, only (padded and merged) target intervals are fetched",
+                        required=False)
+    parser.add_argument("--padding", action="store", dest="padding", type=int, default=0,
+                        help="Number of bases added to each side of target intervals [0]")
+    parser.add_argument("--offtarget", action="store_true", dest="offtarget",
+                        help="Also process off-target regions, writing off-target reads to separate BAM files")
+    parser.add_argument("--profile", action="store_true", dest="profile",
+                        help="Write cProfile stats and collapsed stacks per phase for flame graphs (see profiler.py)")
+    parser.add_argument("--seed", action="store", dest="seed", type=int,
+                        help="Deterministic mode: break ties of consensus read fields with given seed", required=False)
+    parser.add_argument("--family_table", action="store", dest="family_table", nargs='?', const='parquet',
+                        choices=['parquet', 'arrow', 'tsv'],
+                        help="Write table of families as Parquet (default), Arrow IPC or compressed TSV")
+    parser.add_argument("--family_index", action="store_true", dest="family_index",
+                        help="Index corrected and uncorrected BAM files by family key (see family_index.py)")
     args = parser.parse_args()
 
+    if args.targets is not None and args.bedfile is not None:
+        parser.error("--targets can't be combined with --bedfile")
+
+    # Infer SSCS bam and prefix from singleton bamfile (by removing extensions)
+    if args.sscs is None:
+        args.sscs = '{}.sscs{}'.format(args.singleton.split('.singleton')[0], args.singleton.split('.singleton')[1])
+    if args.prefix is None:
+        args.prefix = args.singleton.split('.singleton')[0]
+
+    if args.offtarget and args.targets is None:
+        parser.error("--offtarget requires --targets")
+
     ######################
     #       SETUP        #
     ######################
+    if args.seed is not None:
+        set_tie_seed(args.seed)
+
+    profiler = None
+    if args.profile:
+        from profiler import Profiler
+        profiler = Profiler('{}.singleton_correction'.format(args.prefix))
+        profiler.start()
+
     start_time = time.time()
     # ===== Initialize input and output bam files =====
     singleton_bam = pysam.AlignmentFile(args.singleton, "rb")
-    # Infer SSCS bam from singleton bamfile (by removing extensions)
-    sscs_bam = pysam.AlignmentFile('{}.sscs{}'.format(args.singleton.split('.singleton')[0],
-                                                      args.singleton.split('.singleton')[1]), "rb")
-    sscs_correction_bam = pysam.AlignmentFile('{}.sscs.correction.bam'.format(args.singleton.split('.singleton')[0]), 'wb',
-                                          template=singleton_bam)
-    singleton_correction_bam = pysam.AlignmentFile('{}.singleton.correction.bam'.format(args.singleton.split('.singleton')[0]),
-                                               'wb', template=singleton_bam)
-    uncorrected_bam = pysam.AlignmentFile('{}.uncorrected.bam'.format(args.singleton.split('.singleton')[0]),
-                                               'wb', template=singleton_bam)
-
-    stats = open('{}.stats.txt'.format(args.singleton.split('.singleton')[0]), 'a')
+    sscs_bam = pysam.AlignmentFile(args.sscs, "rb")
+    sscs_correction_file = '{}.sscs.correction.bam'.format(args.prefix)
+    sscs_correction_bam = pysam.AlignmentFile(sscs_correction_file, 'wb', template=singleton_bam)
+    singleton_correction_file = '{}.singleton.correction.bam'.format(args.prefix)
+    singleton_correction_bam = pysam.AlignmentFile(singleton_correction_file, 'wb', template=singleton_bam)
+    uncorrected_file = '{}.uncorrected.bam'.format(args.prefix)
+    uncorrected_bam = pysam.AlignmentFile(uncorrected_file, 'wb', template=singleton_bam)
+    if args.family_index:
+        from family_index import IndexedWriter
+        sscs_correction_bam = IndexedWriter(sscs_correction_bam, sscs_correction_file)
+        singleton_correction_bam = IndexedWriter(singleton_correction_bam, singleton_correction_file)
+        uncorrected_bam = IndexedWriter(uncorrected_bam, uncorrected_file)
+
+    # Target panel intervals, off-target reads are written to separate BAM files
+    if args.targets is not None:
+        targets = TargetIndex(args.targets, singleton_bam.header, args.padding)
+        if args.offtarget:
+            sscs_correction_bam = TargetSplitWriter(sscs_correction_bam, sscs_correction_file, singleton_bam, targets)
+            singleton_correction_bam = TargetSplitWriter(singleton_correction_bam, singleton_correction_file,
+                                                         singleton_bam, targets)
+            uncorrected_bam = TargetSplitWriter(uncorrected_bam, uncorrected_file, singleton_bam, targets)
+
+    stats = open('{}.stats.txt'.format(args.prefix), 'a')
+    metrics = RegionMetrics('Singleton Correction', '{}.metrics.jsonl'.format(args.prefix),
+                            profiler=profiler)
+    sscs_correction_bam = metrics.timed(sscs_correction_bam)
+    singleton_correction_bam = metrics.timed(singleton_correction_bam)
+    uncorrected_bam = metrics.timed(uncorrected_bam)
+
+    family_table = None
+    if args.family_table is not None:
+        from family_table import FamilyTable, family_size
+        family_table = FamilyTable('{}.singleton_correction'.format(args.prefix),
+                                   singleton_bam.references, args.family_table)
 
     # ===== Initialize dictionaries =====
     singleton_dict = collections.OrderedDict()  # dict that remembers order of entries
@@ -176,6 +266,8 @@ def main():
     #######################
     if args.bedfile is not None:
         division_coor = bed_separator(args.bedfile)
+    elif args.targets is not None:
+        division_coor = targets.regions(offtarget=args.offtarget)
     else:
         division_coor = [1]
 
@@ -185,10 +277,10 @@ def main():
             read_chr = None
             read_start = None
             read_end = None
+            region_name = 'all'
         else:
-            read_chr = x.split('_', 1)[0]
-            read_start = division_coor[x][0]
-            read_end = division_coor[x][1]
+            region_name = x
+            read_chr, read_start, read_end = division_coor[x]
             
             # === Reset dictionaries ===
             if last_chr != read_chr:
@@ -202,6 +294,7 @@ def main():
                 last_chr = read_chr
 
         # === Store singleton reads in dictionaries ===
+        metrics.switch('group')
         singleton = read_bam(singleton_bam,
                              pair_dict=singleton_pair,
                              read_dict=singleton_dict,  # keeps track of paired tags
@@ -211,7 +304,8 @@ def main():
                              duplex=True,
                              read_chr=read_chr,
                              read_start=read_start,
-                             read_end=read_end
+                             read_end=read_end,
+                             metrics=metrics
                              )
 
         singleton_dict = singleton[0]
@@ -233,8 +327,10 @@ def main():
                         duplex=True,
                         read_chr=read_chr,
                         read_start=read_start,
-                        read_end=read_end
+                        read_end=read_end,
+                        metrics=metrics
                         )
+        metrics.switch(None)
 
         sscs_dict = sscs[0]
         sscs_tag = sscs[1]
@@ -244,10 +340,13 @@ def main():
         sscs_counter += sscs[4]
         sscs_unmapped += sscs[5]
         sscs_multiple_mappings += sscs[6]
+        metrics.peak(singleton_dict=len(singleton_dict), singleton_pair=len(singleton_pair),
+                     sscs_dict=len(sscs_dict), sscs_pair=len(sscs_pair))
 
         ######################
         #       RESCUE       #
         ######################
+        metrics.switch('consensus')
         for readPair in list(singleton_csn_pair.keys()):
             for tag in singleton_csn_pair[readPair]:
                 counter += 1
@@ -261,6 +360,9 @@ def main():
                     corrected_read = strand_correction(tag, duplex, query_name, singleton_dict, sscs_dict=sscs_dict)
                     sscs_dup_correction += 1
                     sscs_correction_bam.write(corrected_read)
+                    if family_table is not None:
+                        family_table.add(readPair, tag, 1, family_size(sscs_dict[duplex][0]), 'SSCS_corrected',
+                                         corrected_read.query_sequence.count('N'))
 
                     del sscs_dict[duplex]
                     del singleton_dict[tag]
@@ -270,6 +372,9 @@ def main():
                     corrected_read = strand_correction(tag, duplex, query_name, singleton_dict)
                     singleton_dup_correction += 1
                     singleton_correction_bam.write(corrected_read)
+                    if family_table is not None:
+                        family_table.add(readPair, tag, 1, 1, 'singleton_corrected',
+                                         corrected_read.query_sequence.count('N'))
                     correction_dict[tag] = duplex
 
                     if duplex in correction_dict.keys():
@@ -282,10 +387,16 @@ def main():
                 else:
                     uncorrected_bam.write(singleton_dict[tag][0])
                     uncorrected_singleton += 1
+                    if family_table is not None:
+                        family_table.add(readPair, tag, 1, 0, 'uncorrected',
+                                         singleton_dict[tag][0].query_sequence.count('N'))
                     del singleton_dict[tag]
 
             del singleton_csn_pair[readPair]
+        metrics.switch(None)
 
+        metrics.finish(region_name, families=counter, singletons=uncorrected_singleton,
+                       consensus_reads=sscs_dup_correction + singleton_dup_correction)
 
     ######################
     #       SUMMARY      #
@@ -311,6 +422,12 @@ Uncorrected Singletons: {} \n'''.format(counter, sscs_dup_correction, sscs_corre
     singleton_correction_bam.close()
     uncorrected_bam.close()
     stats.close()
+    metrics.close()
+    if family_table is not None:
+        family_table.close()
+
+    if profiler is not None:
+        profiler.stop()
 
 
 ###############################
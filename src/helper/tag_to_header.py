@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 #
 # Tag To Header
 # Version 2.0.1
@@ -28,72 +28,31 @@
 #                        		   		  low quality scores.
 #  --tagstats 			 		Optional: Output tagstats file and make distribution plot of tag family sizes.
 #								   		  Requires matplotlib to be installed
+#  --reduce 			 		Optional: Only output reads that will make a final DCS read (requires --tagstats).
+#								   		  Reads are spooled to disk grouped by barcode and filtered in a second pass
+#  --sketch 			 		Optional: Estimate tagstats from a fixed-size sketch instead of exact barcode counts
+#								   		  (requires --tagstats and numpy, see barcode_sketch.py). Estimates with 95% bounds
+#								   		  are written to ".sketch.txt"
 
 
+import os
 import sys
-import gzip
+import shutil
+import tempfile
 from argparse import ArgumentParser
 from collections import defaultdict
 
+from fastq_helper import *
 
-def fastq_general_iterator(read1_fastq, read2_fastq):
-	read1_readline = read1_fastq.readline
-	read2_readline = read2_fastq.readline
-
-	while True:
-		read1_line = read1_readline()
-		read2_line = read2_readline()
-
-		if not read1_line and read2_line:
-			return
-		if read1_line[0] == '@' and read2_line[0] == '@':
-			break
-		if isinstance(read1_line[0], int) or isinstance(read2_line[0], int):
-			raise ValueError("FASTQ files may contain binary information or are compressed")
-
-	while read1_line and read2_line:
-
-		if read1_line[0] != '@' or read2_line[0] != '@':
-			print read1_line, read2_line
-			raise ValueError("Records in FASTQ files should start with a '@' character. Files may be malformed or out of synch.")
-
-		title_read1_line = read1_line[1:].rstrip()
-		title_read2_line = read2_line[1:].rstrip()
-
-		read1_seq_string = read1_readline().rstrip()
-		read2_seq_string = read2_readline().rstrip()
-
-		while True:
-			read1_line = read1_readline()
-			read2_line = read2_readline()
-
-			if not read1_line and read2_line:
-				raise ValueError("End of file without quality information. Files may be malformed or out of synch")
-			if read1_line[0] == '+' and read2_line[0] == '+':
-				break
 
-			read1_seq_string += read1_line.rstrip()
-			read2_seq_string += read2_line.rstrip()
-
-		read1_quality_string = read1_readline().rstrip()
-		read2_quality_string = read2_readline().rstrip()
-
-		while True:
-			read1_line = read1_readline()
-			read2_line = read2_readline()
-
-			if not read1_line or read2_line:
-				break  # end of file
-			if read1_line[0] == '@' and read2_line[0] == '@' and read1_line.isalpha() is not True \
-				and read2_line.isalpha() is not True:
-				break
-
-			read1_quality_string += read1_line.rstrip()
-			read2_quality_string += read2_line.rstrip()
-
-		yield (title_read1_line, title_read2_line, read1_seq_string, read2_seq_string, read1_quality_string, read2_quality_string)
+def fastq_general_iterator(read1_fastq, read2_fastq):
+	# Yields titles (without '@'), sequences and qualities of paired reads as strings. Records are parsed from large
+	# binary blocks and read names are checked to be in sync (see fastq_helper.paired_records).
+	read1_fastq = FastqReader(read1_fastq)
+	read2_fastq = FastqReader(read2_fastq)
 
-	raise StopIteration
+	for read_record in paired_records(read1_fastq, read2_fastq):
+		yield tuple(field.decode() for field in read_record)
 
 
 def tag_extract_fxn(read_seq, blen):
@@ -126,6 +85,57 @@ def hdr_rename_fxn(read_title, read1_tag, read2_tag):
 		raise ValueError("Unknown read name format: %s" % read_title)
 
 
+NUC_BITS = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+TAG_BASES = frozenset(NUC_BITS)  # Tags with other bases (N, IUPAC codes) are bad tags
+SPOOL_PARTITIONS = 64  # Number of on-disk partitions used to group reads by barcode for --reduce
+SKETCH_BATCH = 100000  # Number of packed barcodes added to the sketch at a time
+
+
+def pack_barcode(tag):
+	# Packs a barcode into an integer using 2 bits per base (A=00, C=01, G=10, T=11). Barcodes are uppercased and
+	# barcodes with bases other than ACGT are discarded before packing, so every base fits in 2 bits and packed
+	# barcodes of the same length are unique.
+	packed = 0
+	for nuc in tag:
+		packed = (packed << 2) | NUC_BITS[nuc]
+	return packed
+
+
+def duplex_barcode(packed, taglen):
+	# Returns packed barcode of the duplex partner (tag1 + tag2 -> tag2 + tag1) by swapping the two halves.
+	half_bits = 2 * taglen
+	return ((packed & ((1 << half_bits) - 1)) << half_bits) | (packed >> half_bits)
+
+
+def spool_reads(spool_files, packed, read1_title, read2_title, read1_seq, read2_seq, read1_qual, read2_qual):
+	# Writes read pair to an on-disk spool partition selected by its packed barcode, so all reads of a barcode family
+	# are found in the same partition for the second pass of --reduce.
+	spool_files[packed % len(spool_files)].write('%d\t%s\t%s\t%s\t%s\t%s\t%s\n' % (
+		packed, read1_title, read1_seq, read1_qual, read2_title, read2_seq, read2_qual))
+
+
+def reduce_spool(spool_paths, dcs_tags, read1_output, read2_output):
+	# Streams spool partitions one at a time and writes reads of DCS-eligible barcodes grouped by barcode.
+	# Barcode membership is a set lookup, so the filter is linear in the number of reads.
+	reduced = 0
+	for path in spool_paths:
+		families = defaultdict(list)
+		with open(path) as spool:
+			for line in spool:
+				packed, record = line.rstrip('\n').split('\t', 1)
+				if int(packed) in dcs_tags:
+					families[packed].append(record)
+		os.remove(path)
+
+		for records in families.values():
+			for record in records:
+				read1_title, read1_seq, read1_qual, read2_title, read2_seq, read2_qual = record.split('\t')
+				read1_output.write('@%s\n%s\n+\n%s\n' % (read1_title, read1_seq, read1_qual))
+				read2_output.write('@%s\n%s\n+\n%s\n' % (read2_title, read2_seq, read2_qual))
+				reduced += 1
+	return reduced
+
+
 def tag_stats(barcode_counts, outfile):
 	family_size_dict = defaultdict(int)
 	tagstat_file =  open(outfile + '.tagstats', 'w')
@@ -164,15 +174,19 @@ def main():
 						Requires matplotlib to be installed.')
 	parser.add_argument('--reduce', dest='reduce', action="store_true", help='Optional: Only output reads that will make \
 						a final DCS read.  Will only work when the --tagstats option is invoked.')
+	parser.add_argument('--sketch', dest='sketch', action="store_true", help='Optional: Estimate tagstats in fixed memory \
+						with a count-min sketch and HyperLogLog instead of exact barcode counts. Requires numpy.')
 	o = parser.parse_args()
 
 
 	if o.reduce and not o.tagstats:
 		raise ValueError("--reduce option must be invoked with the --tagstats option.")
+	if o.sketch and (o.reduce or not o.tagstats):
+		raise ValueError("--sketch option must be invoked with the --tagstats option and without --reduce.")
 
 
-	read1_fastq = open(o.infile1, 'rb')
-	read2_fastq = open(o.infile2, 'rb')
+	read1_fastq = open_fastq(o.infile1)
+	read2_fastq = open_fastq(o.infile2)
 
 	read1_output = open(o.outfile + '.seq1.smi.fq', 'w')
 	read2_output = open(o.outfile + '.seq2.smi.fq', 'w')
@@ -183,7 +197,19 @@ def main():
 	goodreads = 0
 	badtag = 0
 	oldBad = 0
-	barcode_dict = defaultdict(int)
+	barcode_dict = defaultdict(int)  # Packed barcode (see pack_barcode) -> number of reads
+
+	# Packed barcodes are added to the sketch in batches instead of counted in barcode_dict
+	if o.sketch:
+		from barcode_sketch import BarcodeSketch, write_report
+		sketch = BarcodeSketch(o.taglen)
+		sketch_batch = []
+
+	# Reads are spooled to disk partitions by barcode during the first pass, so --reduce doesn't re-read the output
+	if o.reduce:
+		spool_dir = tempfile.mkdtemp(prefix='tag2header_', dir=os.path.dirname(os.path.abspath(o.outfile)))
+		spool_paths = [os.path.join(spool_dir, '{}.txt'.format(i)) for i in range(SPOOL_PARTITIONS)]
+		spool_files = [open(path, 'w') for path in spool_paths]
 
 	nuc_lst = ['A', 'C', 'G', 'T', 'N']
 	r1_base_count = [0, 0, 0, 0, 0]  # A, C, G, T, N
@@ -191,6 +217,7 @@ def main():
 
 
 	for read1_title, read2_title, read1_seq, read2_seq, read1_qual, read2_qual in fastq_general_iterator(read1_fastq, read2_fastq):
+		readctr += 1
 		r1_base_index = nuc_lst.index(read1_seq[o.taglen:o.taglen + o.spclen])
 		r1_base_count[r1_base_index] += 1
 		r2_base_index = nuc_lst.index(read2_seq[o.taglen:o.taglen + o.spclen])
@@ -198,11 +225,11 @@ def main():
 
 		if o.spacer_seq is not None and (read1_seq[o.taglen:o.taglen + o.spclen] not in o.spacer_seq or read2_seq[o.taglen:o.taglen + o.spclen] not in o.spacer_seq):
 			nospacer += 1
-			readctr += 1
 		else:
 			tag1, tag2 = tag_extract_fxn((read1_seq, read2_seq), o.taglen)
+			tag1, tag2 = tag1.upper(), tag2.upper()
 
-			if (tag1.isalpha() and tag1.count('N') == 0) and (tag2.isalpha() and tag2.count('N') == 0):
+			if tag1.isalpha() and tag2.isalpha() and set(tag1 + tag2) <= TAG_BASES:
 				renamed_read1_title =  hdr_rename_fxn(read1_title, tag1, tag2)
 				renamed_read2_title =  hdr_rename_fxn(read2_title, tag1, tag2)
 				read1_output.write('@%s\n%s\n+\n%s\n' % (renamed_read1_title, read1_seq[o.taglen+o.spclen:], read1_qual[o.taglen + o.spclen:]))
@@ -210,12 +237,24 @@ def main():
 				goodreads += 1
 
 				if o.tagstats:
-					barcode_dict[tag1 + tag2] += 1
+					packed = pack_barcode(tag1 + tag2)
+					if o.sketch:
+						sketch_batch.append(packed)
+						if len(sketch_batch) == SKETCH_BATCH:
+							sketch.update(sketch_batch)
+							sketch_batch = []
+					else:
+						barcode_dict[packed] += 1
+
+					if o.reduce:
+						spool_reads(spool_files, packed, renamed_read1_title, renamed_read2_title,
+									read1_seq[o.taglen+o.spclen:], read2_seq[o.taglen+o.spclen:],
+									read1_qual[o.taglen+o.spclen:], read2_qual[o.taglen+o.spclen:])
 
 			else:
 				badtag += 1
 
-		if readctr % o.readout is 0:
+		if readctr % o.readout == 0:
 			sys.stderr.write("Total sequences processed: %s\n" % readctr)
 			sys.stderr.write("Sequences with passing tags: %s\n" % goodreads)
 			sys.stderr.write("Missing spacers: %s\n" % nospacer)
@@ -228,6 +267,9 @@ def main():
 	read2_fastq.close()
 	read1_output.close()
 	read2_output.close()
+	if o.reduce:
+		for spool in spool_files:
+			spool.close()
 
 	sys.stderr.write("Total sequences processed: %s\n" % readctr)
 	sys.stderr.write("Sequences with passing tags: %s\n" % goodreads)
@@ -238,20 +280,31 @@ def main():
 		read_data_file = open(o.outfile + '_data.txt', 'w')
 		sscs_count = 0
 		dcs_count = 0
-		dcs_tags_list = []
-		family_size_dict, total_tags = tag_stats(barcode_dict.values(), o.outfile)
+		dcs_tags = set()  # Packed barcodes of reads that will make a DCS read
+
+		if o.sketch:
+			# Family size distribution from sampled families, SSCS/DCS counts scaled to the estimated number of families
+			sketch.update(sketch_batch)
+			report = sketch.summary()
+			write_report(report, o.outfile + '.sketch.txt')
+			family_size_dict, total_tags = tag_stats(sketch.sample_family_sizes()[0].tolist(), o.outfile)
+			sscs_count = int(round(report['sscs'][0]))
+			dcs_count = int(round(report['dcs'][0]))
+		else:
+			family_size_dict, total_tags = tag_stats(barcode_dict.values(), o.outfile)
 
 		for tag in barcode_dict.keys():
 
 			if barcode_dict[tag] >= 3:
 				sscs_count += 1
+				duplex_tag = duplex_barcode(tag, o.taglen)
 
-				if tag[o.taglen:] + tag[:o.taglen] in barcode_dict and barcode_dict[tag[o.taglen:] + tag[:o.taglen]] >= 3:
+				if barcode_dict.get(duplex_tag, 0) >= 3:
 					dcs_count += 1
 
-					if o.reduce and tag not in dcs_tags_list:
-						dcs_tags_list.append(tag)
-						dcs_tags_list.append(tag[o.taglen:] + tag[:o.taglen])
+					if o.reduce:
+						dcs_tags.add(tag)
+						dcs_tags.add(duplex_tag)
 
 		read_data_file.write('# Passing Reads\t# SSCS Reads\t# DCS Reads\tSSCS:DCS\n%d\t%d\t%d\t%f\n'
 							 % (goodreads, sscs_count, dcs_count, float(sscs_count)/float(dcs_count)))
@@ -259,8 +312,8 @@ def main():
 
 		try:
 			import matplotlib
-                        matplotlib.use('Agg')
-                        import matplotlib.pyplot as plt
+			matplotlib.use('Agg')
+			import matplotlib.pyplot as plt
 
 			x_value = []
 			y_value = []
@@ -274,32 +327,25 @@ def main():
 			plt.ylabel('Proportion of Total Reads')
 			plt.savefig(o.outfile + '.png', bbox_inches='tight')
 
-                        plt.bar(x_value, y_value)
-                        plt.xlabel('Family Size')
-                        plt.ylabel('Proportion of Total Reads')
-                        plt.xlim([0,40])
-                        plt.savefig(o.outfile + '.zoom.png', bbox_inches='tight')
+			plt.bar(x_value, y_value)
+			plt.xlabel('Family Size')
+			plt.ylabel('Proportion of Total Reads')
+			plt.xlim([0,40])
+			plt.savefig(o.outfile + '.zoom.png', bbox_inches='tight')
 
 		except ImportError:
 			sys.stderr.write('matplotlib not present. Only tagstats file will be generated.')
 
 		if o.reduce:
-
-			read1_fastq = open(o.outfile + '.seq1.smi.fq', 'r')
-			read2_fastq = open(o.outfile + '.seq2.smi.fq', 'r')
 			read1_output = open(o.outfile + '.seq1.reduced.fq', 'w')
 			read2_output = open(o.outfile + '.seq2.reduced.fq', 'w')
 
-			for read1_title, read2_title, read1_seq, read2_seq, read1_qual, read2_qual in fastq_general_iterator(read1_fastq, read2_fastq):
-
-				if read1_title.split('|')[1].split('/')[0] in dcs_tags_list and read2_title.split('|')[1].split('/')[0] in dcs_tags_list:
-					read1_output.write('@%s\n%s\n+\n%s\n' % (read1_title, read1_seq, read1_qual))
-					read2_output.write('@%s\n%s\n+\n%s\n' % (read2_title, read2_seq, read2_qual))
+			reduced = reduce_spool(spool_paths, dcs_tags, read1_output, read2_output)
+			shutil.rmtree(spool_dir)
 
-			read1_fastq.close()
-			read2_fastq.close()
 			read1_output.close()
 			read2_output.close()
+			sys.stderr.write("Sequences in DCS families: %s\n" % reduced)
 
 	R1_summary="{} Read1 - A:{:,}; C:{:,}; G:{:,}; T:{:,}; N:{:,} \n".format(o.outfile, r1_base_count[0], r1_base_count[1], r1_base_count[2], r1_base_count[3], r1_base_count[4])
 	R2_summary="{} Read2 - A:{:,}; C:{:,}; G:{:,}; T:{:,}; N:{:,} \n\n".format(o.outfile, r2_base_count[0], r2_base_count[1], r2_base_count[2], r2_base_count[3], r2_base_count[4])
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                         Benchmarks
+#
+###############################################################
+# Function:
+# To measure throughput (reads/sec) and peak memory (RSS) of each pipeline stage on simulated data at several scales,
+# so performance changes can be measured offline and tracked across versions.
+# - Data is simulated with simulate_reads.py (not timed) for each number of molecules
+# - Stages are run as separate processes, in pipeline order, with the same options as ConsensusCruncher.sh:
+#     extract_barcodes  raw FASTQs -> barcode extracted FASTQs
+#     SSCS_maker        simulated BAM -> SSCS and singleton BAMs
+#     DCS_maker         sorted SSCS BAM -> DCS BAM
+#     singleton_correction  sorted singleton (and SSCS) BAM -> corrected singleton BAMs
+# - Peak RSS is measured for each stage process by polling its VmHWM (/proc/<pid>/status), which is reset on exec.
+#   The ru_maxrss of wait4 (only used where /proc isn't available) includes the memory of this script at fork
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 run_benchmarks.py [--outdir OUTDIR] [--scales SCALES [SCALES ...]] [--stages STAGES [STAGES ...]]
+#                           [--repeat REPEAT] [--label LABEL] [simulate_reads.py options]
+#
+# Arguments:
+# --outdir OUTDIR     Directory for simulated data and stage outputs
+# --scales SCALES     Numbers of simulated molecules [1000 10000 100000]
+# --stages STAGES     Stages to run [extract_barcodes SSCS_maker DCS_maker singleton_correction]
+# --repeat REPEAT     Number of runs of each stage, the fastest run is reported [1]
+# --label LABEL       Label of results, e.g. version or branch (Default: git commit of repository)
+# Simulation options (--genome_size, --family_mean, --duplex_rate, --error_rate, etc.) are passed to simulate_reads.py
+#
+# Outputs:
+# 1. A table of results printed to stdout
+# 2. A tab separated file of results, appended to on each run to compare versions - "benchmarks.tsv"
+#    (label, molecules, stage, reads, seconds, reads_per_second, peak_rss_mb)
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import subprocess
+import pysam
+import time
+import sys
+import os
+
+from simulate_reads import simulate
+
+HELPER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src', 'helper')
+STAGES = ['extract_barcodes', 'SSCS_maker', 'DCS_maker', 'singleton_correction']
+POLL_INTERVAL = 0.01  # Seconds between peak RSS reads of stage process
+
+
+###############################
+#          Functions          #
+###############################
+def peak_rss(pid):
+    """(int) -> float
+    Return peak RSS (MB) of running process (VmHWM), or None if not available (no /proc, or process has exited).
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def run_stage(script, args, log):
+    """(str, list, str) -> float, float
+    Run helper script with arguments and return wall time (seconds) and peak RSS (MB) of the process.
+    """
+    env = dict(os.environ, MPLBACKEND='Agg')
+    start = time.perf_counter()
+    with open(log, 'w') as f:
+        process = subprocess.Popen([sys.executable, os.path.join(HELPER_DIR, script + '.py')] + args, stdout=f,
+                                   stderr=subprocess.STDOUT, env=env)
+        peak = None
+        while True:
+            rss = peak_rss(process.pid)
+            if rss is not None:
+                peak = rss if peak is None else max(peak, rss)
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            time.sleep(POLL_INTERVAL)
+    seconds = time.perf_counter() - start
+    if status != 0:
+        raise RuntimeError("{} failed, see {}".format(script, log))
+
+    # ru_maxrss is in kilobytes on Linux
+    return seconds, peak if peak is not None else usage.ru_maxrss / 1024
+
+
+def bam_reads(filename):
+    """(str) -> int
+    Return number of reads in indexed BAM file.
+    """
+    with pysam.AlignmentFile(filename) as bam:
+        return bam.mapped + bam.unmapped
+
+
+def sort_index(filename, sorted_filename):
+    pysam.sort('-o', sorted_filename, filename)
+    pysam.index(sorted_filename)
+
+
+def git_label():
+    """Return short git commit of repository (with '+' if there are uncommitted changes), or 'unknown'."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HELPER_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=HELPER_DIR,
+                                        stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return commit + ('+' if dirty else '')
+
+
+def benchmark_scale(outdir, molecules, stages, repeat, sim_args):
+    """(str, int, list, int, dict) -> list
+    Simulate data and run stages, returning list of (stage, reads, seconds, peak RSS).
+    """
+    scale_dir = os.path.join(outdir, 'molecules_{}'.format(molecules))
+    os.makedirs(scale_dir, exist_ok=True)
+    prefix = os.path.join(scale_dir, 'sim')
+    truth = simulate(prefix, molecules=molecules, **sim_args)
+
+    # Stage inputs (reads) and arguments, in pipeline order
+    stage_args = {
+        'extract_barcodes': (2 * truth['read_pairs'],
+                             ['--read1', prefix + '_R1.fastq', '--read2', prefix + '_R2.fastq',
+                              '--outfile', prefix, '--blen', str(sim_args['blen']), '--slen', str(sim_args['slen']),
+                              '--sfilt', 'T' * sim_args['slen']]),
+        'SSCS_maker': (2 * truth['read_pairs'],
+                       ['--cutoff', '0.7', '--infile', prefix + '.bam', '--outfile', prefix + '.sscs.bam'])
+    }
+
+    results = []
+    for stage in stages:
+        if stage == 'DCS_maker':
+            sort_index(prefix + '.sscs.bam', prefix + '.sscs.sorted.bam')
+            stage_args[stage] = (bam_reads(prefix + '.sscs.sorted.bam'),
+                                 ['--infile', prefix + '.sscs.sorted.bam', '--outfile', prefix + '.dcs.bam'])
+        elif stage == 'singleton_correction':
+            if not os.path.exists(prefix + '.sscs.sorted.bam.bai'):
+                sort_index(prefix + '.sscs.bam', prefix + '.sscs.sorted.bam')
+            sort_index(prefix + '.singleton.bam', prefix + '.singleton.sorted.bam')
+            stage_args[stage] = (bam_reads(prefix + '.singleton.sorted.bam') + bam_reads(prefix + '.sscs.sorted.bam'),
+                                 ['--singleton', prefix + '.singleton.sorted.bam'])
+
+        reads, args = stage_args[stage]
+        runs = [run_stage(stage, args, '{}.{}.log'.format(prefix, stage)) for i in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        peak_rss = max(run[1] for run in runs)
+        results.append((stage, reads, seconds, peak_rss))
+
+    return results
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--outdir", action="store", dest="outdir", help="Directory for simulated data and outputs",
+                        required=True)
+    parser.add_argument("--scales", action="store", dest="scales", type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="Numbers of simulated molecules [1000 10000 100000]")
+    parser.add_argument("--stages", action="store", dest="stages", nargs='+', choices=STAGES, default=STAGES,
+                        help="Stages to run (in pipeline order, SSCS_maker is required by later stages)")
+    parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=1,
+                        help="Number of runs of each stage, the fastest run is reported [1]")
+    parser.add_argument("--label", action="store", dest="label", help="Label of results (Default: git commit)")
+    # Simulation options
+    parser.add_argument("--genome_size", action="store", dest="genome_size", type=int, default=10000000)
+    parser.add_argument("--chromosomes", action="store", dest="chromosomes", type=int, default=4)
+    parser.add_argument("--read_length", action="store", dest="read_length", type=int, default=100)
+    parser.add_argument("--insert_size", action="store", dest="insert_size", type=int, default=250)
+    parser.add_argument("--family_dist", action="store", dest="family_dist", choices=['geometric', 'poisson'],
+                        default='geometric')
+    parser.add_argument("--family_mean", action="store", dest="family_mean", type=float, default=3)
+    parser.add_argument("--duplex_rate", action="store", dest="duplex_rate", type=float, default=0.6)
+    parser.add_argument("--error_rate", action="store", dest="error_rate", type=float, default=0.005)
+    parser.add_argument("--translocations", action="store", dest="translocations", type=float, default=0.01)
+    parser.add_argument("--blen", action="store", dest="blen", type=int, default=2)
+    parser.add_argument("--slen", action="store", dest="slen", type=int, default=1)
+    parser.add_argument("--seed", action="store", dest="seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if any(stage in args.stages for stage in STAGES[2:]) and 'SSCS_maker' not in args.stages:
+        parser.error("DCS_maker and singleton_correction require SSCS_maker")
+
+    sim_args = {key: getattr(args, key) for key in ['genome_size', 'chromosomes', 'read_length', 'insert_size',
+                                                    'family_dist', 'family_mean', 'duplex_rate', 'error_rate',
+                                                    'translocations', 'blen', 'slen', 'seed']}
+    label = args.label if args.label is not None else git_label()
+    stages = [stage for stage in STAGES if stage in args.stages]
+
+    os.makedirs(args.outdir, exist_ok=True)
+    results_file = os.path.join(args.outdir, 'benchmarks.tsv')
+    new_file = not os.path.exists(results_file)
+    with open(results_file, 'a') as f:
+        if new_file:
+            f.write('label\tmolecules\tstage\treads\tseconds\treads_per_second\tpeak_rss_mb\n')
+
+        print('{:<12}{:>10}  {:<22}{:>10}{:>10}{:>12}{:>10}'.format('label', 'molecules', 'stage', 'reads', 'seconds',
+                                                                  'reads/sec', 'RSS (MB)'))
+        for molecules in args.scales:
+            for stage, reads, seconds, peak_rss in benchmark_scale(args.outdir, molecules, stages, args.repeat,
+                                                                   sim_args):
+                f.write('{}\t{}\t{}\t{}\t{:.3f}\t{:.1f}\t{:.1f}\n'.format(label, molecules, stage, reads, seconds,
+                                                                         reads / seconds, peak_rss))
+                print('{:<12}{:>10}  {:<22}{:>10}{:>10.2f}{:>12.0f}{:>10.1f}'.format(label, molecules, stage, reads,
+                                                                                  seconds, reads / seconds, peak_rss))
+
+
+if __name__ == "__main__":
+    main()
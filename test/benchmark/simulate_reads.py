@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                   Synthetic Duplex Read Simulator
+#
+###############################################################
+# Function:
+# To generate synthetic duplex sequencing data of any size for benchmarking (see run_benchmarks.py), with known family
+# sizes, duplex recovery and error rate.
+# - Molecules are random fragments of a random genome, tagged with a barcode (and spacer) on each end
+# - Each strand of a molecule is sequenced as a family of PCR duplicates, with substitution errors at a fixed rate
+# - The same read pairs are written as raw paired FASTQs (input of extract_barcodes.py) and as a coordinate-sorted,
+#   indexed BAM file of aligned barcode extracted reads (input of SSCS_maker.py)
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 simulate_reads.py [--outfile OUTFILE] [--molecules MOLECULES] [--genome_size GENOMESIZE]
+#                           [--chromosomes CHROMOSOMES] [--read_length READLENGTH] [--insert_size INSERTSIZE]
+#                           [--family_dist {geometric,poisson}] [--family_mean FAMILYMEAN] [--duplex_rate DUPLEXRATE]
+#                           [--error_rate ERRORRATE] [--translocations TRANSLOCATIONS] [--blen BARCODELEN]
+#                           [--slen SPACERLEN] [--seed SEED]
+#
+# Arguments:
+# --outfile OUTFILE             Prefix of output files
+# --molecules MOLECULES         Number of DNA molecules [10000]
+# --genome_size GENOMESIZE      Total length of the random genome [10000000]
+# --chromosomes CHROMOSOMES     Number of chromosomes the genome is split into [4]
+# --read_length READLENGTH      Length of reads after barcode and spacer removal [100]
+# --insert_size INSERTSIZE      Mean fragment length (normally distributed, sd = 10%) [250]
+# --family_dist DIST            Family size distribution of each sequenced strand [geometric]:
+#                                 geometric - 1 + geometric number of duplicates (many singletons)
+#                                 poisson   - 1 + poisson number of duplicates
+# --family_mean FAMILYMEAN      Mean family size of each sequenced strand [3]
+# --duplex_rate DUPLEXRATE      Proportion of molecules with both strands sequenced, the others have a single strand [0.6]
+# --error_rate ERRORRATE        Per base substitution rate of reads [0.005]
+# --translocations TRANSLOC     Proportion of molecules with mates on different chromosomes [0.01]
+# --blen BARCODELEN             Barcode length [2]
+# --slen SPACERLEN              Spacer length (spacer bases are 'T') [1]
+# --seed SEED                   Random seed [1]
+#
+# Outputs:
+# 1. Raw paired FASTQ files with barcode and spacer at the start of each read - "_R1.fastq", "_R2.fastq"
+# 2. A coordinate-sorted and indexed BAM file of barcode extracted reads ("<read name>|<barcode>") - ".bam"
+# 3. Reference genome FASTA file - ".fa"
+# 4. A text file of simulated molecule, family and read pair counts - "_truth.txt"
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import numpy as np
+import pysam
+import os
+
+NUC = np.frombuffer(b'ACGT', dtype=np.uint8)
+COMPLEMENT = bytes.maketrans(b'ACGT', b'TGCA')
+
+
+###############################
+#          Functions          #
+###############################
+def reverse_complement(seq):
+    """(bytes) -> bytes
+    Return reverse complement of sequence.
+
+    >>> reverse_complement(b'AACGT')
+    b'ACGTT'
+    """
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def family_sizes(rng, n, dist, mean):
+    """(numpy.random.RandomState, int, str, float) -> numpy.ndarray
+    Return n family sizes (>= 1) with given mean.
+    """
+    if dist == 'poisson':
+        return 1 + rng.poisson(mean - 1, n)
+
+    return rng.geometric(1 / mean, n)
+
+
+class ReadMaker(object):
+    """Read sequences with substitution errors and random qualities (Q25-Q40)."""
+    def __init__(self, rng, error_rate, pool_size=1000003):
+        self.rng = rng
+        self.error_rate = error_rate
+        self.qual_pool = rng.randint(25, 41, pool_size).astype(np.uint8)
+
+    def read(self, seq):
+        """(bytes) -> bytes, numpy.ndarray
+        Return read sequence with errors and phred qualities.
+        """
+        read = np.frombuffer(seq, dtype=np.uint8).copy()
+        errors = self.rng.binomial(len(read), self.error_rate)
+        if errors:
+            positions = self.rng.randint(0, len(read), errors)
+            read[positions] = NUC[(np.searchsorted(NUC, read[positions]) + self.rng.randint(1, 4, errors)) % 4]
+        offset = self.rng.randint(0, len(self.qual_pool) - len(read))
+        return read.tobytes(), self.qual_pool[offset:offset + len(read)]
+
+
+def aligned_read(header, name, flag, ref, pos, mate_ref, mate_pos, tlen, seq, qual):
+    """Return aligned read (pysam.AlignedSegment) with full length match."""
+    read = pysam.AlignedSegment(header)
+    read.query_name = name
+    read.flag = flag
+    read.reference_id = ref
+    read.reference_start = pos
+    read.mapping_quality = 60
+    read.cigarstring = '{}M'.format(len(seq))
+    read.next_reference_id = mate_ref
+    read.next_reference_start = mate_pos
+    read.template_length = tlen
+    read.query_sequence = seq.decode()
+    read.query_qualities = qual
+    read.set_tag('RG', '1')
+    return read
+
+
+def fastq_record(name, seq, qual):
+    return '@{}\n{}\n+\n{}\n'.format(name, seq.decode(), (qual + 33).tobytes().decode())
+
+
+def simulate(outfile, molecules=10000, genome_size=10000000, chromosomes=4, read_length=100, insert_size=250,
+             family_dist='geometric', family_mean=3, duplex_rate=0.6, error_rate=0.005, translocations=0.01,
+             blen=2, slen=1, seed=1):
+    """Write simulated FASTQ, BAM and reference files with given prefix and return dictionary of truth counts."""
+    rng = np.random.RandomState(seed)
+    read_maker = ReadMaker(rng, error_rate)
+
+    # === Reference genome ===
+    chr_length = genome_size // chromosomes
+    chr_names = ['chr{}'.format(i + 1) for i in range(chromosomes)]
+    genome = [NUC[rng.randint(0, 4, chr_length)].tobytes() for i in range(chromosomes)]
+    with open('{}.fa'.format(outfile), 'w') as fasta:
+        for name, seq in zip(chr_names, genome):
+            fasta.write('>{}\n'.format(name))
+            fasta.write('\n'.join(seq[i:i + 60].decode() for i in range(0, chr_length, 60)) + '\n')
+
+    header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6', 'SO': 'unsorted'},
+                                              'SQ': [{'SN': name, 'LN': chr_length} for name in chr_names],
+                                              'RG': [{'ID': '1', 'SM': os.path.basename(outfile)}]})
+    unsorted_bam = '{}.unsorted.bam'.format(outfile)
+    bam = pysam.AlignmentFile(unsorted_bam, 'wb', header=header)
+    spacer = b'T' * slen
+    spacer_qual = np.full(blen + slen, 40, dtype=np.uint8)
+
+    # === Molecules ===
+    sizes = family_sizes(rng, 2 * molecules, family_dist, family_mean).reshape(molecules, 2)
+    duplex = rng.random_sample(molecules) < duplex_rate
+    # Molecules without duplex have a single (random) strand sequenced
+    sizes[~duplex, rng.randint(0, 2, molecules)[~duplex]] = 0
+
+    truth = {'molecules': molecules, 'duplex_molecules': int(np.count_nonzero(duplex)), 'families': 0,
+             'singletons': 0, 'read_pairs': int(sizes.sum()), 'translocations': 0}
+    r1_fastq = open('{}_R1.fastq'.format(outfile), 'w')
+    r2_fastq = open('{}_R2.fastq'.format(outfile), 'w')
+    fastq_pairs = []
+
+    for mol in range(molecules):
+        ref = rng.randint(0, chromosomes)
+        length = max(int(rng.normal(insert_size, insert_size / 10)), read_length)
+        start = rng.randint(0, chr_length - length)
+        fragment = genome[ref][start:start + length]
+        # R1 end (forward) and R2 end (reverse) of fragment
+        left = fragment[:read_length]
+        right = fragment[-read_length:]
+        left_ref, left_pos = ref, start
+        right_ref, right_pos = ref, start + length - read_length
+        tlen = length
+        if rng.random_sample() < translocations:
+            # Mate end of fragment aligned to a different chromosome
+            right_ref = (ref + rng.randint(1, chromosomes)) % chromosomes if chromosomes > 1 else ref
+            right_pos = rng.randint(0, chr_length - read_length)
+            right = genome[right_ref][right_pos:right_pos + read_length]
+            tlen = 0
+            truth['translocations'] += 1
+        proper = 2 if tlen else 0
+        bc1 = NUC[rng.randint(0, 4, blen)].tobytes()
+        bc2 = NUC[rng.randint(0, 4, blen)].tobytes()
+
+        for strand, size in enumerate(sizes[mol]):
+            if size == 0:
+                continue
+            truth['families'] += 1
+            truth['singletons'] += int(size == 1)
+            for dup in range(size):
+                name = 'SIM:{}:{}:{}'.format(mol, strand, dup)
+                left_seq, left_qual = read_maker.read(left)
+                right_seq, right_qual = read_maker.read(right)
+                if strand == 0:
+                    # (+) strand: R1 from bc1 end (forward), R2 from bc2 end (reverse)
+                    barcode = (bc1 + bc2).decode()
+                    r1 = (bc1 + spacer + left_seq, np.concatenate((spacer_qual, left_qual)))
+                    r2 = (bc2 + spacer + reverse_complement(right_seq),
+                          np.concatenate((spacer_qual, right_qual[::-1])))
+                    left_flag, right_flag = 97 + proper, 145 + proper
+                else:
+                    # (-) strand: R1 from bc2 end (reverse), R2 from bc1 end (forward)
+                    barcode = (bc2 + bc1).decode()
+                    r1 = (bc2 + spacer + reverse_complement(right_seq),
+                          np.concatenate((spacer_qual, right_qual[::-1])))
+                    r2 = (bc1 + spacer + left_seq, np.concatenate((spacer_qual, left_qual)))
+                    left_flag, right_flag = 161 + proper, 81 + proper
+
+                bam_name = '{}|{}'.format(name, barcode)
+                bam.write(aligned_read(header, bam_name, left_flag, left_ref, left_pos, right_ref, right_pos, tlen,
+                                       left_seq, left_qual))
+                bam.write(aligned_read(header, bam_name, right_flag, right_ref, right_pos, left_ref, left_pos, -tlen,
+                                       right_seq, right_qual))
+                fastq_pairs.append((fastq_record(name + ' 1:N:0:1', *r1), fastq_record(name + ' 2:N:0:1', *r2)))
+
+    # Read pairs come off the sequencer in random order
+    for i in rng.permutation(len(fastq_pairs)):
+        r1_fastq.write(fastq_pairs[i][0])
+        r2_fastq.write(fastq_pairs[i][1])
+    r1_fastq.close()
+    r2_fastq.close()
+
+    bam.close()
+    pysam.sort('-o', '{}.bam'.format(outfile), unsorted_bam)
+    pysam.index('{}.bam'.format(outfile))
+    os.remove(unsorted_bam)
+
+    with open('{}_truth.txt'.format(outfile), 'w') as f:
+        for key in ['molecules', 'duplex_molecules', 'families', 'singletons', 'read_pairs', 'translocations']:
+            f.write('{}\t{}\n'.format(key, truth[key]))
+
+    return truth
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--outfile", action="store", dest="outfile", help="Prefix of output files", required=True)
+    parser.add_argument("--molecules", action="store", dest="molecules", type=int, default=10000,
+                        help="Number of DNA molecules [10000]")
+    parser.add_argument("--genome_size", action="store", dest="genome_size", type=int, default=10000000,
+                        help="Total length of the random genome [10000000]")
+    parser.add_argument("--chromosomes", action="store", dest="chromosomes", type=int, default=4,
+                        help="Number of chromosomes [4]")
+    parser.add_argument("--read_length", action="store", dest="read_length", type=int, default=100,
+                        help="Length of reads after barcode and spacer removal [100]")
+    parser.add_argument("--insert_size", action="store", dest="insert_size", type=int, default=250,
+                        help="Mean fragment length [250]")
+    parser.add_argument("--family_dist", action="store", dest="family_dist", choices=['geometric', 'poisson'],
+                        default='geometric', help="Family size distribution of each sequenced strand [geometric]")
+    parser.add_argument("--family_mean", action="store", dest="family_mean", type=float, default=3,
+                        help="Mean family size of each sequenced strand [3]")
+    parser.add_argument("--duplex_rate", action="store", dest="duplex_rate", type=float, default=0.6,
+                        help="Proportion of molecules with both strands sequenced [0.6]")
+    parser.add_argument("--error_rate", action="store", dest="error_rate", type=float, default=0.005,
+                        help="Per base substitution rate [0.005]")
+    parser.add_argument("--translocations", action="store", dest="translocations", type=float, default=0.01,
+                        help="Proportion of molecules with mates on different chromosomes [0.01]")
+    parser.add_argument("--blen", action="store", dest="blen", type=int, default=2, help="Barcode length [2]")
+    parser.add_argument("--slen", action="store", dest="slen", type=int, default=1, help="Spacer length [1]")
+    parser.add_argument("--seed", action="store", dest="seed", type=int, default=1, help="Random seed [1]")
+    args = parser.parse_args()
+
+    if args.family_mean < 1:
+        parser.error("--family_mean must be at least 1")
+
+    truth = simulate(args.outfile, args.molecules, args.genome_size, args.chromosomes, args.read_length,
+                     args.insert_size, args.family_dist, args.family_mean, args.duplex_rate, args.error_rate,
+                     args.translocations, args.blen, args.slen, args.seed)
+    print('Read pairs: {}'.format(truth['read_pairs']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Startup Time
+#
+###############################################################
+# Function:
+# To measure startup time (imports and argument parsing, i.e. 'consensuscruncher SUBCOMMAND --help') of each
+# consensuscruncher subcommand and check it against its budget, so heavy imports (e.g. matplotlib, pandas) don't creep
+# back into the consensus steps.
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 startup_time.py [--repeat REPEAT] [--subcommands SUBCOMMAND [SUBCOMMAND ...]]
+#
+# Arguments:
+# --repeat REPEAT           Number of runs of each subcommand, the fastest run is reported [5]
+# --subcommands SUBCOMMAND  Subcommands to measure (Default: all subcommands with a budget)
+#
+# Outputs:
+# Startup time and budget of each subcommand (stdout). Exit status is 1 if any subcommand is over budget.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import subprocess
+import time
+import sys
+import os
+
+HELPER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src', 'helper')
+# Startup budget (seconds) of each subcommand, including Python interpreter startup. Consensus steps only need pysam
+# (and numpy for extract_barcodes); report loads matplotlib.
+BUDGETS = {'extract_barcodes': 0.3,
+           'sscs': 0.2,
+           'dcs': 0.2,
+           'singleton_correction': 0.2,
+           'report': 0.2,
+           'worker': 0.3,
+           'compare_bams': 0.2,
+           'family_index': 0.3,
+           'incremental': 0.3,
+           'partition': 0.2}
+
+
+###############################
+#          Functions          #
+###############################
+def startup_time(subcommand, repeat):
+    """(str, int) -> float
+    Return fastest time (seconds) of 'consensuscruncher SUBCOMMAND --help'.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, os.path.join(HELPER_DIR, 'consensuscruncher.py'), subcommand, '--help'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=5,
+                        help="Number of runs of each subcommand, the fastest run is reported [5]")
+    parser.add_argument("--subcommands", action="store", dest="subcommands", nargs='+', choices=sorted(BUDGETS),
+                        default=sorted(BUDGETS), help="Subcommands to measure")
+    args = parser.parse_args()
+
+    over_budget = 0
+    print('{:<22}{:>10}{:>10}'.format('subcommand', 'seconds', 'budget'))
+    for subcommand in args.subcommands:
+        seconds = startup_time(subcommand, args.repeat)
+        over_budget += seconds > BUDGETS[subcommand]
+        print('{:<22}{:>10.3f}{:>10.1f}{}'.format(subcommand, seconds, BUDGETS[subcommand],
+                                                  '  OVER BUDGET' if seconds > BUDGETS[subcommand] else ''))
+
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
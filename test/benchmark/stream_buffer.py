@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Stream Buffer
+#
+###############################################################
+# Function:
+# To check that consensus reads buffered for coordinate order by SSCS_maker.py --stream and DCS_maker.py --stream (and
+# reads buffered by partition.py scatter) stay bounded on input with translocated read pairs (mates on different
+# chromosomes), whose reads are spilled to disk instead of holding back every later read (see
+# consensus_helper.SortedBamWriter).
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 stream_buffer.py [--outdir OUTDIR] [--molecules MOLECULES] [--translocations TRANSLOC] [--limit LIMIT]
+#
+# Arguments:
+# --outdir OUTDIR               Directory for simulated data and outputs (Default: temporary directory, removed after)
+# --molecules MOLECULES         Number of simulated DNA molecules [20000]
+# --translocations TRANSLOC     Proportion of molecules with mates on different chromosomes [0.01]
+# --limit LIMIT                 Largest number of buffered consensus reads allowed, i.e. reads of two streamed chunks
+#                               [20000]
+#
+# Outputs:
+# Peak buffered and total (consensus) reads of each stage (stdout, from "metrics.jsonl" and partition.scatter). Exit
+# status is 1 if a stage buffers more than the limit, its streamed output differs from the sorted output of a regular
+# run, or scattered partitions are unsorted or do not add up to the input.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import subprocess
+import tempfile
+import shutil
+import json
+import sys
+import os
+import pysam
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+HELPER_DIR = os.path.join(BENCHMARK_DIR, '..', '..', 'src', 'helper')
+sys.path.insert(0, HELPER_DIR)
+from compare_bams import compare_bams
+from consensus_helper import read_coordinate
+from partition import scatter
+
+
+###############################
+#          Functions          #
+###############################
+def run(script, *args):
+    subprocess.check_call([sys.executable, os.path.join(HELPER_DIR, script)] + list(args), stdout=subprocess.DEVNULL,
+                          env=dict(os.environ, MPLBACKEND='Agg'))
+
+
+def stage_summary(metrics_file, stage):
+    """(str, str) -> dict
+    Return summary record of stage in metrics file.
+    """
+    with open(metrics_file) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['type'] == 'summary' and record['stage'] == stage:
+                return record
+
+
+def is_sorted(filename):
+    """(str) -> bool
+    Return True if reads of BAM file are in coordinate order.
+    """
+    with pysam.AlignmentFile(filename, "rb", check_sq=False) as bam:
+        coordinates = [read_coordinate(read) for read in bam.fetch(until_eof=True)]
+    return coordinates == sorted(coordinates)
+
+
+def check_scatter(prefix, limit, partitions=4):
+    """(str, int, int) -> int
+    Scatter simulated reads into partitions, print peak buffered reads and return number of failed checks.
+    """
+    with pysam.AlignmentFile(prefix + '.bam', "rb", check_sq=False) as bamfile:
+        total = sum(1 for _ in bamfile.fetch(until_eof=True))
+        bamfile.reset()
+        counts, buffered = scatter(bamfile, prefix + '.scatter', partitions)
+    ordered = all(is_sorted('{}.scatter.part{}.bam'.format(prefix, i)) for i in range(partitions))
+    complete = sum(counts) == total
+
+    print('{:<8}{:>12}{:>12}{:>10}  {}{}{}'.format('scatter', buffered, sum(counts), limit,
+                                                   'sorted' if ordered else 'UNSORTED',
+                                                   '' if complete else '  MISSING READS',
+                                                   '  OVER LIMIT' if buffered > limit else ''))
+    return (buffered > limit) + (not ordered) + (not complete)
+
+
+def check(outdir, molecules, translocations, limit):
+    """(str, int, float, int) -> int
+    Simulate reads, run SSCS_maker.py and DCS_maker.py with and without --stream, print peak buffered consensus reads
+    of streamed stages and return number of failed checks.
+    """
+    prefix = os.path.join(outdir, 'sim')
+    subprocess.check_call([sys.executable, os.path.join(BENCHMARK_DIR, 'simulate_reads.py'), '--outfile', prefix,
+                           '--molecules', str(molecules), '--translocations', str(translocations)],
+                          stdout=subprocess.DEVNULL)
+
+    run('SSCS_maker.py', '--cutoff', '0.7', '--infile', prefix + '.bam', '--outfile', prefix + '.stream.sscs.bam',
+        '--stream', '--seed', '1')
+    run('DCS_maker.py', '--infile', prefix + '.stream.sscs.bam', '--outfile', prefix + '.stream.dcs.bam', '--stream',
+        '--seed', '1')
+    run('SSCS_maker.py', '--cutoff', '0.7', '--infile', prefix + '.bam', '--outfile', prefix + '.sscs.bam', '--seed',
+        '1')
+    pysam.sort('-o', prefix + '.sscs.sorted.bam', prefix + '.sscs.bam')
+    pysam.index(prefix + '.sscs.sorted.bam')
+    run('DCS_maker.py', '--infile', prefix + '.sscs.sorted.bam', '--outfile', prefix + '.dcs.bam', '--seed', '1')
+    pysam.sort('-o', prefix + '.dcs.sorted.bam', prefix + '.dcs.bam')
+
+    failed = 0
+    print('{:<8}{:>12}{:>12}{:>10}  {}'.format('stage', 'buffered', 'reads', 'limit', 'output'))
+    for stage, metrics_file, streamed, regular in [
+            ('SSCS', prefix + '.stream.metrics.jsonl', prefix + '.stream.sscs.bam', prefix + '.sscs.sorted.bam'),
+            ('DCS', prefix + '.stream.metrics.jsonl', prefix + '.stream.dcs.bam', prefix + '.dcs.sorted.bam')]:
+        summary = stage_summary(metrics_file, stage)
+        buffered = summary['peak'].get('sorted_buffer', 0)
+        result = compare_bams(streamed, regular)
+        failed += (buffered > limit) + (not result['identical'])
+        print('{:<8}{:>12}{:>12}{:>10}  {}{}'.format(stage, buffered, summary['consensus_reads'], limit,
+                                                     'identical' if result['identical'] else 'DIFFERENT',
+                                                     '  OVER LIMIT' if buffered > limit else ''))
+
+    return failed + check_scatter(prefix, limit)
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--outdir", action="store", dest="outdir", help="Directory for simulated data and outputs")
+    parser.add_argument("--molecules", action="store", dest="molecules", type=int, default=20000,
+                        help="Number of simulated DNA molecules [20000]")
+    parser.add_argument("--translocations", action="store", dest="translocations", type=float, default=0.01,
+                        help="Proportion of molecules with mates on different chromosomes [0.01]")
+    parser.add_argument("--limit", action="store", dest="limit", type=int, default=20000,
+                        help="Largest number of buffered consensus reads allowed [20000]")
+    args = parser.parse_args()
+
+    outdir = args.outdir if args.outdir is not None else tempfile.mkdtemp()
+    os.makedirs(outdir, exist_ok=True)
+    try:
+        failed = check(outdir, args.molecules, args.translocations, args.limit)
+    finally:
+        if args.outdir is None:
+            shutil.rmtree(outdir)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+###############################################################
+#
+#                        Fixture Corpus
+#
+###############################################################
+# Function:
+# To build a corpus of reference outputs and check that a modified pipeline (e.g. a faster consensus_maker,
+# duplex_consensus or read_bam) still produces the same outputs.
+# - FASTQ cases: test FASTQs (test/fastq) through extract_barcodes.py (2 bp barcodes, 1 bp 'T' spacer)
+# - BAM cases: simulated BAM files (../benchmark/simulate_reads.py, fixed seeds) and any aligned BAM files provided
+#   with --bam (e.g. test FASTQs aligned with fastq_to_bam.sh), through SSCS_maker.py, DCS_maker.py and
+#   singleton_correction.py in deterministic mode (--seed)
+# - BAM outputs are compared record by record regardless of order (compare_bams.py), FASTQ outputs by record and
+#   stats files line by line
+#
+# Build the corpus with the reference implementation (e.g. a git worktree of the last release), then check changes
+# against it:
+#   python3 fixture_corpus.py --mode build --corpus CORPUS   (reference checkout)
+#   python3 fixture_corpus.py --mode check --corpus CORPUS --outdir OUTDIR   (modified checkout)
+#
+# Written for Python 3.5.1
+#
+# Usage:
+# python3 fixture_corpus.py [--mode {build,check}] [--corpus CORPUS] [--outdir OUTDIR] [--bam BAM [BAM ...]]
+#
+# Arguments:
+# --mode MODE         build: create corpus inputs and expected outputs; check: rerun inputs and compare with expected
+# --corpus CORPUS     Corpus directory ("inputs" and "expected" subdirectories)
+# --outdir OUTDIR     Directory for outputs of check mode
+# --bam BAM           Additional aligned BAM files (barcodes in query names) added to the corpus in build mode
+#
+# Outputs:
+# PASS/FAIL for each output file of each case (stdout). Exit status is 1 if any output differs.
+#
+###############################################################
+
+##############################
+#        Load Modules        #
+##############################
+from argparse import ArgumentParser
+import subprocess
+import shutil
+import glob
+import pysam
+import sys
+import os
+
+TEST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HELPER_DIR = os.path.join(os.path.dirname(TEST_DIR), 'src', 'helper')
+sys.path.insert(0, os.path.join(TEST_DIR, 'benchmark'))
+sys.path.insert(0, HELPER_DIR)
+
+from simulate_reads import simulate
+from compare_bams import compare_bams
+
+SEED = 1
+# Simulated BAM cases: (name, simulate_reads.simulate parameters)
+SIMULATED_CASES = [('sim_default', {'molecules': 2000, 'genome_size': 1000000, 'seed': 1}),
+                   ('sim_noisy', {'molecules': 2000, 'genome_size': 1000000, 'family_dist': 'poisson',
+                                  'family_mean': 4, 'error_rate': 0.02, 'translocations': 0.05, 'seed': 2})]
+FASTQ_OUTPUTS = ['_barcode_R1.fastq', '_barcode_R2.fastq']
+BAM_OUTPUTS = ['.sscs.bam', '.singleton.bam', '.badReads.bam', '.dcs.bam', '.sscs.singleton.bam',
+               '.sscs.correction.bam', '.singleton.correction.bam', '.uncorrected.bam']
+
+
+###############################
+#          Functions          #
+###############################
+def run(script, args):
+    """Run helper script with arguments (output hidden unless it fails)."""
+    result = subprocess.run([sys.executable, os.path.join(HELPER_DIR, script + '.py')] + args,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dict(os.environ, MPLBACKEND='Agg'))
+    if result.returncode != 0:
+        sys.stderr.write(result.stdout.decode())
+        raise RuntimeError("{} {} failed".format(script, ' '.join(args)))
+
+
+def run_fastq_case(read1, read2, prefix):
+    run('extract_barcodes', ['--read1', read1, '--read2', read2, '--outfile', prefix, '--blen', '2', '--slen', '1',
+                             '--sfilt', 'T'])
+
+
+def run_bam_case(bamfile, prefix):
+    """Make SSCS, DCS and singleton corrected BAM files (outputs named as in ConsensusCruncher.sh)."""
+    seed = ['--seed', str(SEED)]
+    run('SSCS_maker', ['--cutoff', '0.7', '--infile', bamfile, '--outfile', prefix + '.sscs.bam'] + seed)
+    for name in ['.sscs', '.singleton']:
+        pysam.sort('-o', prefix + name + '.sorted.bam', prefix + name + '.bam')
+        pysam.index(prefix + name + '.sorted.bam')
+    run('DCS_maker', ['--infile', prefix + '.sscs.sorted.bam', '--outfile', prefix + '.dcs.bam'] + seed)
+    run('singleton_correction', ['--singleton', prefix + '.singleton.sorted.bam'] + seed)
+
+
+def fastq_records(filename):
+    """Return sorted list of FASTQ records (4 lines each)."""
+    with open(filename) as f:
+        lines = f.read().splitlines()
+    return sorted(tuple(lines[i:i + 4]) for i in range(0, len(lines), 4))
+
+
+def compare_file(expected, observed):
+    """(str, str) -> bool, str
+    Return whether output file matches expected file, and description of differences.
+    """
+    if not os.path.exists(observed):
+        return False, 'missing'
+    if expected.endswith('.bam'):
+        result = compare_bams(expected, observed, max_diffs=1)
+        if result['identical']:
+            return True, '{} records'.format(result['records'][0])
+        return False, '{} records only in expected, {} only in output'.format(result['only1'][0], result['only2'][0])
+    if expected.endswith('.fastq'):
+        same = fastq_records(expected) == fastq_records(observed)
+    else:
+        with open(expected) as f1, open(observed) as f2:
+            same = f1.read() == f2.read()
+
+    return same, '' if same else 'contents differ'
+
+
+def cases(input_dir):
+    """(str) -> list
+    Return list of (name, type, input files) in corpus input directory.
+    """
+    corpus = []
+    for read1 in sorted(glob.glob(os.path.join(input_dir, '*_R1.fastq'))):
+        name = os.path.basename(read1)[:-len('_R1.fastq')]
+        corpus.append((name, 'fastq', [read1, read1[:-len('_R1.fastq')] + '_R2.fastq']))
+    for bamfile in sorted(glob.glob(os.path.join(input_dir, '*.bam'))):
+        corpus.append((os.path.basename(bamfile)[:-len('.bam')], 'bam', [bamfile]))
+
+    return corpus
+
+
+def build_inputs(input_dir, bamfiles):
+    """Copy test FASTQs and aligned BAM files, and simulate BAM files, into corpus input directory."""
+    os.makedirs(input_dir, exist_ok=True)
+    for fastq in glob.glob(os.path.join(TEST_DIR, 'fastq', '*.fastq')):
+        shutil.copy(fastq, input_dir)
+    for bamfile in bamfiles:
+        shutil.copy(bamfile, input_dir)
+        pysam.index(os.path.join(input_dir, os.path.basename(bamfile)))
+    for name, params in SIMULATED_CASES:
+        prefix = os.path.join(input_dir, name)
+        simulate(prefix, **params)
+        # Only the BAM file is part of the corpus
+        for extra in ['_R1.fastq', '_R2.fastq', '.fa', '_truth.txt']:
+            os.remove(prefix + extra)
+
+
+def run_corpus(input_dir, output_dir):
+    """Run all corpus cases with outputs written to output directory."""
+    os.makedirs(output_dir, exist_ok=True)
+    for name, case_type, inputs in cases(input_dir):
+        prefix = os.path.join(output_dir, name)
+        if case_type == 'fastq':
+            run_fastq_case(inputs[0], inputs[1], prefix)
+        else:
+            run_bam_case(inputs[0], prefix)
+
+
+###############################
+#        Main Function        #
+###############################
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--mode", action="store", dest="mode", choices=['build', 'check'], required=True,
+                        help="Build corpus (reference implementation) or check outputs against corpus")
+    parser.add_argument("--corpus", action="store", dest="corpus", help="Corpus directory", required=True)
+    parser.add_argument("--outdir", action="store", dest="outdir", help="Directory for outputs of check mode")
+    parser.add_argument("--bam", action="store", dest="bam", nargs='+', default=[],
+                        help="Additional aligned BAM files added to the corpus in build mode")
+    args = parser.parse_args()
+
+    input_dir = os.path.join(args.corpus, 'inputs')
+    expected_dir = os.path.join(args.corpus, 'expected')
+
+    if args.mode == 'build':
+        build_inputs(input_dir, args.bam)
+        run_corpus(input_dir, expected_dir)
+        print('Corpus built: {} cases'.format(len(cases(input_dir))))
+        return
+
+    if args.outdir is None:
+        parser.error("--outdir is required in check mode")
+
+    run_corpus(input_dir, args.outdir)
+    failures = 0
+    for name, case_type, inputs in cases(input_dir):
+        for extension in FASTQ_OUTPUTS if case_type == 'fastq' else BAM_OUTPUTS + ['.stats.txt']:
+            same, detail = compare_file(os.path.join(expected_dir, name + extension),
+                                        os.path.join(args.outdir, name + extension))
+            failures += not same
+            print('{}\t{}{}\t{}'.format('PASS' if same else 'FAIL', name, extension, detail))
+
+    print('{} failed'.format(failures) if failures else 'All outputs match')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()